@@ -0,0 +1,172 @@
+'''
+Runs the Manta and the sequencer on an asyncio event loop, so they can share
+it with other services. Python 3 only, with pyOSC3 in place of pyOSC:
+
+    python3 asyncmanta.py [midi backend]
+'''
+import asyncio
+import sys
+from clock import LoopClock
+from manta import Manta, _read_kernel_drops, encode_osc
+from mantaseq import MantaSeq
+from midibackends import open_backend
+
+class AsyncManta(Manta, asyncio.DatagramProtocol):
+    '''
+    A Manta that receives and sends through an asyncio datagram endpoint
+    instead of pyOSC's sockets. Call open() to create the endpoint. Each
+    datagram is decoded as it arrives, then event_handler is called, which
+    should collect the events with process(). Messages sent before the
+    endpoint is open are held until it is.
+    '''
+    def __init__(self, receive_port=31416, send_port=31417,
+                 send_address='127.0.0.1', **kwargs):
+        self.transport = None
+        self.event_handler = None
+        # set once the events have been handed out by process(), so the next
+        # datagram starts a new batch
+        self._handed_out = False
+        self._unsent = []
+        Manta.__init__(self, receive_port, send_port, send_address, 0,
+                       **kwargs)
+
+    def _open(self, receive_port, send_port, send_address, timeout):
+        self.osc_server = None
+        self.osc_client = None
+        self._receive_address = ('127.0.0.1', receive_port)
+        self._send_address = (send_address, send_port)
+
+    async def open(self, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        await loop.create_datagram_endpoint(lambda: self,
+                                            local_addr=self._receive_address)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        for data in self._unsent:
+            transport.sendto(data, self._send_address)
+        del self._unsent[:]
+
+    def datagram_received(self, data, source):
+        if self._handed_out:
+            self._reset_events()
+            self._handed_out = False
+        if self.recorder is not None:
+            self.recorder.record(self.recorder.clock.now(), data)
+        self._datagram_time = self.clock.now()
+        self._handle_datagram(data, source)
+        self.datagrams_received += 1
+        if self.event_handler is not None:
+            self.event_handler()
+
+    def process(self):
+        '''
+        Returns the events decoded since the last call. As with Manta, the
+        list and events are reused once the next datagram comes in.
+        '''
+        if self._handed_out:
+            self._reset_events()
+        self._handed_out = True
+        return self.event_queue
+
+    def _send_datagram(self, data):
+        if self.transport is None:
+            self._unsent.append(data)
+        else:
+            self.transport.sendto(data, self._send_address)
+        self.datagrams_sent += 1
+
+    def reply(self, address, path, *args):
+        self.transport.sendto(encode_osc(path, *args), address)
+
+    def kernel_drops(self):
+        return _read_kernel_drops(self.transport.get_extra_info('socket'))
+
+class AsyncMantaSeq(MantaSeq):
+    '''
+    A MantaSeq that runs as a task on an asyncio event loop, timed by the
+    loop's clock. Input is handled as it arrives, and steps and note-offs run
+    from a timer set with loop.call_at() for the next deadline, so nothing
+    polls and any number of sequencers (on different ports) can share a loop.
+    '''
+    def __init__(self, loop=None, receive_port=31416, send_port=31417,
+                 **kwargs):
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._timer = None
+        self._timer_deadline = None
+        manta = AsyncManta(receive_port, send_port, buffer_leds=True,
+                           bundle_output=True)
+        MantaSeq.__init__(self, clock=LoopClock(self._loop), manta=manta,
+                          **kwargs)
+        manta.event_handler = self.process
+
+    async def run(self):
+        '''Runs until the task is cancelled'''
+        await self._manta.open(self._loop)
+        self._schedule_next()
+        try:
+            # everything happens in callbacks from here on
+            await self._loop.create_future()
+        finally:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self.cleanup()
+            self._manta.close()
+
+    def start(self):
+        MantaSeq.start(self)
+        self._schedule_next()
+
+    def process(self):
+        MantaSeq.process(self)
+        self._schedule_next()
+
+    def _set_step_duration(self, duration):
+        # the tempo can be changed from outside process(), e.g. by another
+        # service on the loop, so the timer has to follow the next step
+        MantaSeq._set_step_duration(self, duration)
+        self._schedule_next()
+
+    def _schedule_next(self):
+        deadline = self.next_deadline()
+        if deadline == self._timer_deadline:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_deadline = deadline
+        if deadline is None:
+            self._timer = None
+        else:
+            self._timer = self._loop.call_at(deadline, self._on_timer)
+
+    def _on_timer(self):
+        # the loop can run timers a hair early, in which case process() finds
+        # nothing due and sets the same deadline again
+        self._timer = None
+        self._timer_deadline = None
+        self.process()
+
+def main():
+    backend = sys.argv[1] if len(sys.argv) > 1 else None
+    loop = asyncio.get_event_loop()
+    seq = AsyncMantaSeq(loop, midi_source=open_backend(backend))
+    task = loop.create_task(seq.run())
+    try:
+        loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        # let run() clean up
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''
+Measures how CPU use grows with the number of sequencers. Each one plays a
+full pattern, first hosted together in a MantaSeqHost and then each polling
+on its own thread with a 1ms timeout, the way separate mantaseq processes
+used to. Run directly:
+
+    python bench_host.py
+'''
+import os
+import socket
+import threading
+import time
+from mantahost import MantaSeqHost
+from midibackends import MIDIBackend
+
+COUNTS = [1, 2, 4, 8, 16]
+RUN_TIME = 2.0
+STEP_DURATION = 0.05
+POLL_TIMEOUT = 0.001
+
+class _NullMIDIBackend(MIDIBackend):
+    def _write(self, messages):
+        pass
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+def make_host(count, led_port):
+    host = MantaSeqHost()
+    for i in range(count):
+        seq = host.add_instance(0, led_port, _NullMIDIBackend())
+        seq.step_duration = STEP_DURATION
+        for step in range(16):
+            seq._seq.select_step(step)
+            seq._seq.set_fields(note=60 + i, velocity=100)
+            seq._seq.deselect_step(step)
+    return host
+
+def run_hosted(host):
+    host.start()
+    end = time.time() + RUN_TIME
+    while time.time() < end:
+        deadline = host.next_deadline()
+        timeout = max(0, deadline - host._clock.now())
+        host.process(min(timeout, end - time.time()))
+
+def run_polling(host):
+    end = time.time() + RUN_TIME
+    def poll(seq):
+        seq.start()
+        while time.time() < end:
+            seq._manta.wait(POLL_TIMEOUT)
+            seq.process()
+    threads = [threading.Thread(target=poll, args=(seq,))
+               for seq in host.instances]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def measure(count, run, led_port):
+    '''Returns the CPU seconds used per second of playback'''
+    host = make_host(count, led_port)
+    try:
+        start = cpu_time()
+        run(host)
+        return (cpu_time() - start) / RUN_TIME
+    finally:
+        host.cleanup()
+
+def main():
+    # somewhere for the LED messages to go
+    led_sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    led_sink.bind(('127.0.0.1', 0))
+    led_port = led_sink.getsockname()[1]
+    print('instances   hosted CPU   polling CPU   (% of one core)')
+    try:
+        for count in COUNTS:
+            hosted = measure(count, run_hosted, led_port)
+            polling = measure(count, run_polling, led_port)
+            print('%9d %11.1f %13.1f' % (count, hosted * 100, polling * 100))
+    finally:
+        led_sink.close()
+
+if __name__ == '__main__':
+    main()
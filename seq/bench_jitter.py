@@ -0,0 +1,359 @@
+'''
+Measures how accurately the step clock keeps time. MantaSeq plays a full
+16-step pattern at a range of tempos, including one where the tempo adjust
+state keeps changing step_duration, with and without background load: GC
+pressure from another thread, a flood of continuous pad values from a fake
+Manta (see fakemanta.py), and LED storms. Run directly:
+
+    python bench_jitter.py [--tempo fast] [--load gc] [--duration 600]
+                           [--output results.json]
+
+Every note-on and note-off is stamped as it's written and compared against
+its ideal time. Each step plays a different note, so steps that were skipped
+or played twice show up too. For each run we report the error percentiles,
+a histogram of the absolute errors, and the drift, which is the slope of the
+error over the run.
+'''
+import argparse
+import bisect
+import collections
+import gc
+import json
+import math
+import platform
+import socket
+import threading
+import time
+from clock import SystemClock
+from fakemanta import FakeMantaClient, pad_values
+from manta import Manta
+from mantaseq import MantaSeq
+from midibackends import CaptureBackend
+
+FIRST_NOTE = 60
+# (step duration, whether the tempo is swept) for each tempo
+TEMPOS = collections.OrderedDict([
+    ('slow', (0.25, False)),
+    ('medium', (0.125, False)),
+    ('fast', (0.05, False)),
+    ('very-fast', (0.02, False)),
+    ('extreme', (0.005, False)),
+    ('sweep', (0.05, True)),
+])
+# how often the swept tempo changes, and how long one sweep up and down takes
+SWEEP_INTERVAL = 0.01
+SWEEP_PERIOD = 2.0
+PAD_FLOOD_RATE = 2000
+LED_STORM_INTERVAL = 0.001
+# steps due this close to the end of a run aren't counted as missed
+END_MARGIN = 0.005
+# upper edges of the histogram buckets, in ms
+HISTOGRAM_EDGES = [0.1, 0.25, 0.5, 1, 2, 5, 10]
+
+class _Load(object):
+    '''Background load applied during a run'''
+    # how often poll() should be called, or None if it shouldn't
+    interval = None
+
+    def start(self, seq, duration):
+        pass
+
+    def poll(self, seq):
+        pass
+
+    def stop(self):
+        pass
+
+class _GCPressure(_Load):
+    '''
+    Churns out reference cycles on another thread, with a large live heap so
+    that the full collections take a while
+    '''
+    def start(self, seq, duration):
+        self._heap = [[i] for i in range(200000)]
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._churn)
+        self._thread.start()
+
+    def _churn(self):
+        while not self._stopped.is_set():
+            for i in range(1000):
+                cycle = []
+                cycle.append(cycle)
+            time.sleep(0.001)
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self._heap = None
+        gc.collect()
+
+class _PadFlood(_Load):
+    '''Continuous pad values from a fake Manta, as fast as it'll play them'''
+    def start(self, seq, duration):
+        count = int(duration * PAD_FLOOD_RATE)
+        self._client = FakeMantaClient(
+                seq._manta.osc_server.socket.getsockname())
+        self._client.start(pad_values(count, PAD_FLOOD_RATE), delay=0)
+
+    def stop(self):
+        self._client.join()
+
+class _LEDStorm(_Load):
+    '''Turns every pad LED on or off each millisecond'''
+    interval = LED_STORM_INTERVAL
+
+    def start(self, seq, duration):
+        self._active = False
+
+    def poll(self, seq):
+        self._active = not self._active
+        for pad_num in range(48):
+            seq.set_pad_active(pad_num, self._active)
+
+LOADS = collections.OrderedDict([
+    ('none', _Load),
+    ('gc', _GCPressure),
+    ('pad-flood', _PadFlood),
+    ('led-storm', _LEDStorm),
+])
+
+class _TempoSweep(object):
+    '''
+    Drives the tempo adjust state the way moving the slider with shift held
+    does, keeping a record of when step_duration changed
+    '''
+    def __init__(self, seq):
+        self._seq = seq
+        self._state = seq._tempo_adjust_state
+        self._state.begin(0.5, seq.step_duration)
+        seq._state = self._state
+        self._start = seq._clock.now()
+
+    def poll(self, changes):
+        now = self._seq._clock.now()
+        phase = 2 * math.pi * (now - self._start) / SWEEP_PERIOD
+        self._state.process_slider_value(0, 0.5 + 0.5 * math.sin(phase))
+        changes.append((now, self._seq.step_duration))
+
+class _IdealClock(object):
+    '''
+    Works out when each step should have happened given the start time and
+    the tempo changes, where a tempo change keeps our position within the
+    current step
+    '''
+    def __init__(self, start, step_duration, changes):
+        # each segment is (start time, steps played by then, step duration)
+        self._segments = [(start, 0.0, step_duration)]
+        for timestamp, duration in changes:
+            begin, steps, last_duration = self._segments[-1]
+            steps += (timestamp - begin) / last_duration
+            self._segments.append((timestamp, steps, duration))
+        self._steps = [steps for _, steps, _ in self._segments]
+        self._times = [begin for begin, _, _ in self._segments]
+
+    def step_time(self, step):
+        '''Returns when step should happen'''
+        index = bisect.bisect_right(self._steps, step) - 1
+        begin, steps, duration = self._segments[index]
+        return begin + (step - steps) * duration
+
+    def step_duration(self, step):
+        return self._segments[bisect.bisect_right(self._steps, step) - 1][2]
+
+    def steps_at(self, timestamp):
+        '''Returns how many steps should have played by timestamp'''
+        index = max(0, bisect.bisect_right(self._times, timestamp) - 1)
+        begin, steps, duration = self._segments[index]
+        return steps + (timestamp - begin) / duration
+
+def populate(seq):
+    '''Gives each step its own note, so we can tell which step played'''
+    for i in range(16):
+        seq._seq.select_step(i)
+        seq._seq.set_fields(note=FIRST_NOTE + i, velocity=100)
+        seq._seq.deselect_step(i)
+
+def play(seq, load, duration, sweep):
+    '''
+    Plays for duration seconds under load, then lets the last note-offs go
+    out. Returns the times of the first step and the end, and any tempo
+    changes.
+    '''
+    clock = seq._clock
+    changes = []
+    load.start(seq, duration)
+    try:
+        seq.start()
+        start = seq.next_step_timestamp
+        end = start + duration
+        tempo_sweep = _TempoSweep(seq) if sweep else None
+        next_poll = next_sweep = start
+        while clock.now() < end:
+            now = clock.now()
+            if load.interval is not None and now >= next_poll:
+                load.poll(seq)
+                next_poll = now + load.interval
+            if tempo_sweep is not None and now >= next_sweep:
+                tempo_sweep.poll(changes)
+                next_sweep = now + SWEEP_INTERVAL
+            wake = [end, seq.next_deadline()]
+            if load.interval is not None:
+                wake.append(next_poll)
+            if tempo_sweep is not None:
+                wake.append(next_sweep)
+            timeout = min(t for t in wake if t is not None) - clock.now()
+            seq._manta.wait(max(0, timeout))
+            seq.process()
+        seq.stop()
+        while seq.next_deadline() is not None:
+            time.sleep(max(0, seq.next_deadline() - clock.now()))
+            seq.process()
+    finally:
+        load.stop()
+    return start, end, changes
+
+def percentile(values, fraction):
+    '''values must be sorted'''
+    index = min(len(values) - 1, int(fraction * len(values)))
+    return values[index]
+
+def histogram(errors):
+    '''Counts the absolute errors falling in each bucket'''
+    counts = [0] * (len(HISTOGRAM_EDGES) + 1)
+    for error in errors:
+        counts[bisect.bisect_left(HISTOGRAM_EDGES, abs(error) * 1000)] += 1
+    return counts
+
+def drift(samples):
+    '''
+    Returns the least squares slope of (time, error) samples, in ms of error
+    per minute
+    '''
+    if len(samples) < 2:
+        return 0.0
+    mean_t = sum(t for t, _ in samples) / len(samples)
+    mean_e = sum(e for _, e in samples) / len(samples)
+    covariance = sum((t - mean_t) * (e - mean_e) for t, e in samples)
+    variance = sum((t - mean_t) ** 2 for t, _ in samples)
+    if variance == 0:
+        return 0.0
+    return covariance / variance * 60 * 1000
+
+def analyze(sent, ideal, end, step_count=16):
+    '''
+    Compares the notes in sent, as (timestamp, message) tuples, against the
+    steps the ideal clock says should have played before end
+    '''
+    on_errors = []
+    off_errors = []
+    samples = []
+    missed = doubled = 0
+    last_step = -1
+    # ideal note-off times of the sounding notes, oldest first
+    note_offs = collections.defaultdict(collections.deque)
+    for timestamp, message in sent:
+        if message[0] != 0x90:
+            continue
+        index = message[1] - FIRST_NOTE
+        if message[2] == 0:
+            if note_offs[index]:
+                off_errors.append(timestamp - note_offs[index].popleft())
+            continue
+        # steps can only be skipped or repeated, not reordered, so this is
+        # the next step after the last one that plays this note. Playing the
+        # same note again is a repeat, unless we're a whole loop behind
+        step = last_step + (index - last_step - 1) % step_count + 1
+        if (step == last_step + step_count and
+                ideal.steps_at(timestamp) < last_step + step_count // 2):
+            doubled += 1
+            continue
+        missed += step - last_step - 1
+        last_step = step
+        ideal_time = ideal.step_time(step)
+        on_errors.append(timestamp - ideal_time)
+        samples.append((ideal_time, timestamp - ideal_time))
+        note_offs[index].append(ideal_time + 0.9 * ideal.step_duration(step))
+    expected = int(math.ceil(ideal.steps_at(end - END_MARGIN)))
+    missed += max(0, expected - last_step - 1)
+    on_errors.sort()
+    off_errors.sort()
+    return {
+        'steps': last_step + 1,
+        'missed': missed,
+        'doubled': doubled,
+        'on_p50_ms': percentile(on_errors, 0.5) * 1000,
+        'on_p99_ms': percentile(on_errors, 0.99) * 1000,
+        'on_max_ms': max(on_errors[-1], -on_errors[0]) * 1000,
+        'off_p99_ms': percentile(off_errors, 0.99) * 1000,
+        'drift_ms_per_min': drift(samples),
+        'on_histogram': histogram(on_errors),
+        'off_histogram': histogram(off_errors),
+    }
+
+def run(tempo, load_name, duration, led_port):
+    step_duration, sweep = TEMPOS[tempo]
+    clock = SystemClock()
+    capture = CaptureBackend(clock)
+    manta = Manta(receive_port=0, send_port=led_port, timeout=0,
+                  buffer_leds=True, bundle_output=True)
+    seq = MantaSeq(clock=clock, midi_source=capture, manta=manta)
+    seq.step_duration = step_duration
+    populate(seq)
+    try:
+        start, end, changes = play(seq, LOADS[load_name](), duration, sweep)
+    finally:
+        seq.cleanup()
+        manta.osc_server.close()
+    return analyze(capture.sent, _IdealClock(start, step_duration, changes),
+                   end)
+
+def main():
+    parser = argparse.ArgumentParser(description='Step clock jitter benchmark')
+    parser.add_argument('--tempo', action='append', choices=list(TEMPOS),
+                        help='run just this tempo (can be repeated)')
+    parser.add_argument('--load', action='append', choices=list(LOADS),
+                        help='run just this load (can be repeated)')
+    parser.add_argument('--duration', type=float, default=3.0,
+                        help='seconds to play for in each run')
+    parser.add_argument('--output', metavar='JSON',
+                        help='save the results here')
+    args = parser.parse_args()
+
+    # somewhere for the LED messages to go
+    led_sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    led_sink.bind(('127.0.0.1', 0))
+    results = collections.OrderedDict()
+    print('%-22s %6s %6s %6s %8s %8s %8s %8s %9s' % (
+            'run', 'steps', 'missed', 'double', 'p50 ms', 'p99 ms', 'max ms',
+            'off p99', 'drift/min'))
+    buckets = ['<%g' % edge for edge in HISTOGRAM_EDGES]
+    buckets.append('>=%g' % HISTOGRAM_EDGES[-1])
+    try:
+        for tempo in args.tempo or TEMPOS:
+            for load in args.load or LOADS:
+                key = '%s/%s' % (tempo, load)
+                result = run(tempo, load, args.duration,
+                             led_sink.getsockname()[1])
+                results[key] = result
+                print('%-22s %6d %6d %6d %8.3f %8.3f %8.3f %8.3f %9.3f' % (
+                        key, result['steps'], result['missed'],
+                        result['doubled'], result['on_p50_ms'],
+                        result['on_p99_ms'], result['on_max_ms'],
+                        result['off_p99_ms'], result['drift_ms_per_min']))
+                for kind in ('on', 'off'):
+                    print('    |%s error| ms  %s' % (kind, '  '.join(
+                            '%s:%d' % bucket for bucket in
+                            zip(buckets, result[kind + '_histogram']))))
+    finally:
+        led_sink.close()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'duration': args.duration,
+                       'results': results}, output, indent=2)
+
+if __name__ == '__main__':
+    main()
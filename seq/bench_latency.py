@@ -0,0 +1,212 @@
+'''
+Measures end-to-end latency from a datagram leaving a fake Manta to the MIDI
+it causes leaving MantaSeq, over loopback UDP. Each scenario plays an input
+pattern from another process (see fakemanta.py) and MIDI goes to a capture
+backend, stamped when it's written. Run directly:
+
+    python bench_latency.py [--mode threaded] [--output results.json]
+                            [--baseline baseline.json]
+
+For each scenario we report p50/p99/max latency, how many datagrams per
+second were handled, and CPU time per datagram. Results can be saved as JSON
+and compared against an earlier run, in which case the exit status is
+nonzero if anything got worse by more than the threshold.
+'''
+import argparse
+import collections
+import json
+import platform
+import resource
+import socket
+import sys
+from clock import SystemClock
+from fakemanta import FakeMantaClient, pressure_sweep, single_hits, slider_drag
+from manta import Manta
+from mantaseq import MantaSeq
+from midibackends import CaptureBackend
+
+# how long to keep processing after the last datagram is due
+DRAIN_TIME = 0.2
+
+SCENARIOS = collections.OrderedDict([
+    ('single-hits', lambda: single_hits(200, 100)),
+    ('pressure-sweep', lambda: pressure_sweep(2000)),
+    ('pressure-flood', lambda: pressure_sweep(0, passes=4)),
+    ('slider-drag', lambda: slider_drag(1000, 1000)),
+])
+
+# for comparing against a baseline: whether higher is better, and whether
+# getting worse counts as a regression. The max is shown but too noisy to
+# gate on
+METRICS = [('p50_ms', False, True), ('p99_ms', False, True),
+           ('max_ms', False, False), ('throughput', True, True),
+           ('cpu_us_per_event', False, True)]
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def percentile(values, fraction):
+    '''values must be sorted'''
+    index = min(len(values) - 1, int(fraction * len(values)))
+    return values[index]
+
+def _run_single(seq, end):
+    clock = seq._clock
+    while clock.now() < end:
+        timeout = end - clock.now()
+        deadline = seq.next_deadline()
+        if deadline is not None:
+            timeout = min(timeout, deadline - clock.now())
+        seq._manta.wait(max(0, timeout))
+        seq.process()
+
+def _run_threaded(seq, end):
+    clock = seq._clock
+    seq.start_threads()
+    try:
+        while clock.now() < end:
+            seq.process_ui(max(0, min(0.01, end - clock.now())))
+    finally:
+        seq.stop_threads()
+
+MODES = {'single': _run_single, 'threaded': _run_threaded}
+
+def run_scenario(pattern, mode, led_port):
+    '''Plays pattern into a new MantaSeq and returns the results'''
+    clock = SystemClock()
+    capture = CaptureBackend(clock)
+    manta = Manta(receive_port=0, send_port=led_port, timeout=0,
+                  buffer_leds=True, bundle_output=True)
+    seq = MantaSeq(clock=clock, midi_source=capture, manta=manta)
+    try:
+        client = FakeMantaClient(manta.osc_server.socket.getsockname())
+        start = client.start(pattern)
+        cpu_start = cpu_time()
+        MODES[mode](seq, start + pattern[-1][0] + DRAIN_TIME)
+        cpu = cpu_time() - cpu_start
+        send_times = client.join()
+    finally:
+        seq.cleanup()
+        manta.osc_server.close()
+
+    # match each expected message to the next output of the same message
+    outputs = collections.defaultdict(collections.deque)
+    for timestamp, message in capture.sent:
+        outputs[message].append(timestamp)
+    latencies = []
+    missing = 0
+    last_output = send_times[0]
+    for send_time, (offset, datagram, expected) in zip(send_times, pattern):
+        if expected is None:
+            continue
+        if outputs[expected]:
+            output_time = outputs[expected].popleft()
+            latencies.append(output_time - send_time)
+            last_output = max(last_output, output_time)
+        else:
+            missing += 1
+    latencies.sort()
+    handled = manta.datagrams_received
+    result = {
+        'datagrams': len(pattern),
+        'handled': handled,
+        'missing_outputs': missing,
+        'cpu_us_per_event': cpu / max(handled, 1) * 1e6,
+    }
+    if not latencies:
+        # everything was lost, e.g. the kernel dropped the whole flood, so
+        # there are no latencies to report
+        result.update(p50_ms=None, p99_ms=None, max_ms=None, throughput=0.0)
+        return result
+    result.update(
+        p50_ms=percentile(latencies, 0.5) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000,
+        max_ms=latencies[-1] * 1000,
+        throughput=handled / max(last_output - send_times[0], 1e-9))
+    return result
+
+def compare(results, baseline, threshold):
+    '''
+    Prints how each metric changed from the baseline, returning the number
+    that got worse by more than threshold (a fraction)
+    '''
+    regressions = 0
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for metric, higher_is_better, gated in METRICS:
+            if not old.get(metric):
+                continue
+            if result[metric] is None:
+                print('%-28s %-17s %10.3f -> all missing%s' % (
+                        name, metric, old[metric],
+                        '  REGRESSION' if gated else ''))
+                regressions += gated
+                continue
+            change = result[metric] / old[metric] - 1
+            worse = -change if higher_is_better else change
+            flag = ''
+            if gated and worse > threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            print('%-28s %-17s %10.3f -> %10.3f (%+.0f%%)%s' % (
+                    name, metric, old[metric], result[metric], change * 100,
+                    flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Manta to MIDI latency benchmarks')
+    parser.add_argument('--scenario', action='append',
+                        choices=list(SCENARIOS),
+                        help='run just this scenario (can be repeated)')
+    parser.add_argument('--mode', choices=sorted(MODES), default='single')
+    parser.add_argument('--output', metavar='JSON',
+                        help='save the results here')
+    parser.add_argument('--baseline', metavar='JSON',
+                        help='compare against results saved earlier')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='fractional change counted as a regression')
+    args = parser.parse_args()
+
+    # somewhere for the LED messages to go
+    led_sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    led_sink.bind(('127.0.0.1', 0))
+    results = collections.OrderedDict()
+    print('%-28s %8s %8s %8s %11s %10s %8s' % (
+            'scenario', 'p50 ms', 'p99 ms', 'max ms', 'events/s', 'cpu us/ev',
+            'missing'))
+    try:
+        for name in args.scenario or SCENARIOS:
+            result = run_scenario(SCENARIOS[name](), args.mode,
+                                  led_sink.getsockname()[1])
+            key = '%s/%s' % (name, args.mode)
+            results[key] = result
+            if result['p50_ms'] is None:
+                print('%-28s %26s %11.0f %10.1f %8d' % (
+                        key, 'all missing', result['throughput'],
+                        result['cpu_us_per_event'],
+                        result['missing_outputs']))
+                continue
+            print('%-28s %8.3f %8.3f %8.3f %11.0f %10.1f %8d' % (
+                    key, result['p50_ms'], result['p99_ms'], result['max_ms'],
+                    result['throughput'], result['cpu_us_per_event'],
+                    result['missing_outputs']))
+    finally:
+        led_sink.close()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'results': results}, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            baseline = json.load(baseline)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+'''
+Measures the tradeoff between lookahead and output timing. The sequencer
+plays a full 16-step pattern while the loop is randomly stalled, to stand in
+for GC pauses and slow LED updates. For each lookahead setting we report how
+far note-ons landed from their ideal times. Pattern edits take effect up to
+lookahead later, so that's the latency we pay. Run directly:
+
+    python bench_lookahead.py
+'''
+import random
+import time
+from clock import SystemClock
+from mantaseq import MantaSeq
+from midibackends import CaptureBackend
+
+LOOKAHEADS = [0, 0.002, 0.005, 0.01, 0.02]
+RUN_TIME = 2.0
+STEP_DURATION = 0.05
+# chance of a stall before each process() call, and how long it can be
+STALL_PROBABILITY = 0.2
+MAX_STALL = 0.008
+
+def populate(seq):
+    for i in range(16):
+        seq._seq.select_step(i)
+        seq._seq.set_note(60)
+        seq._seq.set_velocity(100)
+        seq._seq.deselect_step(i)
+
+def measure(seq, lookahead):
+    '''
+    Returns the errors (actual - ideal) in seconds of every note-on sent over
+    RUN_TIME seconds of playback
+    '''
+    clock = seq._clock
+    capture = CaptureBackend(clock)
+    seq.set_midi_source(capture)
+    seq.set_lookahead(lookahead)
+    seq.start()
+    start = seq.next_step_timestamp
+    while clock.now() < start + RUN_TIME:
+        deadline = seq.next_deadline()
+        if deadline is not None:
+            time.sleep(max(0, deadline - clock.now()))
+        if random.random() < STALL_PROBABILITY:
+            time.sleep(random.uniform(0, MAX_STALL))
+        seq.process()
+    seq.stop()
+    # let the output thread send anything still queued
+    time.sleep(lookahead + STEP_DURATION)
+    seq.set_lookahead(0)
+    note_ons = [t for t, message in capture.sent
+                if message[0] == 0x90 and message[2] > 0]
+    return [t - (start + i * STEP_DURATION) for i, t in enumerate(note_ons)]
+
+def main():
+    seq = MantaSeq(midi_source=CaptureBackend(SystemClock()))
+    seq.step_duration = STEP_DURATION
+    populate(seq)
+    print('lookahead    mean err     stdev   max |err|   (ms)')
+    try:
+        for lookahead in LOOKAHEADS:
+            errors = measure(seq, lookahead)
+            mean = sum(errors) / len(errors)
+            stdev = (sum((e - mean) ** 2 for e in errors) / len(errors)) ** 0.5
+            worst = max(abs(e) for e in errors)
+            print('%9.1f %11.3f %9.3f %11.3f' % (
+                    lookahead * 1000, mean * 1000, stdev * 1000, worst * 1000))
+    finally:
+        seq.cleanup()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+'''
+Micro-benchmarks for the Manta OSC input and output paths. Run directly:
+
+    python bench_osc.py
+'''
+import socket
+import struct
+import time
+from manta import Manta, OSCMessage, osc_prefix, OFF, AMBER, RED
+
+DECODE_COUNT = 50000
+SEND_COUNT = 50000
+
+def _continuous_pad_datagrams(count):
+    prefix = osc_prefix('/manta/continuous/pad', 'ii')
+    return [prefix + struct.pack('>ii', i % 48, i % 200)
+            for i in range(count)]
+
+def bench_decode(fast_decode, datagrams):
+    '''Returns the number of datagrams decoded per second'''
+    manta = Manta(receive_port=0, timeout=0, fast_decode=fast_decode)
+    source = ('127.0.0.1', 0)
+    try:
+        start = time.time()
+        for data in datagrams:
+            manta._handle_datagram(data, source)
+        elapsed = time.time() - start
+    finally:
+        manta.osc_server.close()
+    assert len(manta.event_queue) == len(datagrams)
+    return len(datagrams) / elapsed
+
+def _send_generic(manta, led_state, pad_index):
+    '''The way LED messages were sent before the packet cache'''
+    msg = OSCMessage('/manta/led/pad')
+    msg.append((led_state, pad_index))
+    manta.osc_client.send(msg)
+
+def _send_cached(manta, led_state, pad_index):
+    manta.set_led_pad(led_state, pad_index)
+
+def bench_send(send):
+    '''Returns the number of pad LED messages sent per second'''
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    sink.setblocking(False)
+    manta = Manta(receive_port=0, send_port=sink.getsockname()[1], timeout=0)
+    colors = [OFF, AMBER, RED]
+    try:
+        start = time.time()
+        for i in range(SEND_COUNT):
+            send(manta, colors[i % 3], i % 48)
+            # keep the sink's buffer from filling up
+            if i % 64 == 63:
+                try:
+                    while True:
+                        sink.recv(4096)
+                except socket.error:
+                    pass
+        elapsed = time.time() - start
+    finally:
+        manta.osc_server.close()
+        sink.close()
+    return SEND_COUNT / elapsed
+
+def main():
+    datagrams = _continuous_pad_datagrams(DECODE_COUNT)
+    generic = bench_decode(False, datagrams)
+    fast = bench_decode(True, datagrams)
+    print('decode, generic pyOSC path: %10.0f msgs/s' % generic)
+    print('decode, fast path:          %10.0f msgs/s (%.1fx)' % (
+            fast, fast / generic))
+    generic = bench_send(_send_generic)
+    cached = bench_send(_send_cached)
+    print('send, OSCMessage per call:  %10.0f msgs/s' % generic)
+    print('send, cached packets:       %10.0f msgs/s (%.1fx)' % (
+            cached, cached / generic))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+'''
+Micro-benchmarks for the sequencer state machine. Run directly:
+
+    python bench_seq.py
+'''
+import random
+import time
+from stepseq import Seq
+from manta import (PadVelocityEvent,
+                   ButtonVelocityEvent,
+                   PadValueEvent,
+                   SliderValueEvent)
+from mantaseq import MantaSeq
+from midibackends import MIDIBackend
+from mantaseqstates import (MantaSeqState,
+                             MantaSeqIdleState,
+                             MantaSeqStepsSelectedState,
+                             MantaSeqShiftedState,
+                             MantaSeqTempoAdjustState)
+
+SLIDER_EVENTS = 100000
+STRESS_ROUNDS = 200
+
+class _OldStep(object):
+    def __init__(self):
+        self.note = 0
+        self.velocity = 0
+        self.cc1 = 0
+        self.cc2 = 0
+        self.duration = 0.90
+
+class _OldSeq(object):
+    '''The step storage and setters as they were before set_fields()'''
+    def __init__(self):
+        self.steps = [_OldStep() for i in range(16)]
+        self.selected_steps = []
+
+    def select_step(self, step_index):
+        self.selected_steps.append(self.steps[step_index])
+
+    def __getattr__(self, attr):
+        if not attr.startswith('set_'):
+            raise AttributeError()
+        attr = attr[4:]
+        def set_step_value(value):
+            for step in self.selected_steps:
+                setattr(step, attr, value)
+        return set_step_value
+
+class _MantaSeqStandIn(object):
+    '''Just enough of a MantaSeq for the states to edit steps'''
+    def __init__(self, seq):
+        self._seq = seq
+
+def bench_slider_drag(seq):
+    '''
+    Returns the number of slider events per second the selected state can
+    handle with 4 steps selected
+    '''
+    for step_index in (0, 4, 8, 12):
+        seq.select_step(step_index)
+    state = MantaSeqStepsSelectedState(_MantaSeqStandIn(seq))
+    start = time.time()
+    for i in range(SLIDER_EVENTS):
+        state.process_slider_value(i % 2, (i % 1000) / 1000.0)
+    return SLIDER_EVENTS / (time.time() - start)
+
+class _NullMIDIBackend(MIDIBackend):
+    def _write(self, messages):
+        pass
+
+def _fresh_state(state_class):
+    '''
+    A MantaSeq attribute that makes a new state each time it's read, the way
+    every transition used to. Assignments to it are ignored.
+    '''
+    return property(lambda seq: state_class(seq), lambda seq, state: None)
+
+class _IsinstanceDispatchMantaSeq(MantaSeq):
+    '''
+    Dispatches events the way MantaSeq did before the handler table, and
+    allocates a new state on every transition as it did before the states
+    were reused
+    '''
+    _idle_state = _fresh_state(MantaSeqIdleState)
+    _steps_selected_state = _fresh_state(MantaSeqStepsSelectedState)
+    _shifted_state = _fresh_state(MantaSeqShiftedState)
+    _tempo_adjust_state = _fresh_state(MantaSeqTempoAdjustState)
+
+    def _dispatch(self, events):
+        for event in events:
+            if isinstance(event, PadVelocityEvent):
+                self._process_pad_velocity_event(event)
+            if isinstance(event, ButtonVelocityEvent):
+                self._process_button_velocity_event(event)
+            elif isinstance(event, PadValueEvent):
+                self._process_pad_value_event(event)
+            elif isinstance(event, SliderValueEvent):
+                self._process_slider_value_event(event)
+
+def stress_events():
+    '''
+    A tick's worth of mixed input: step presses and releases with note and
+    slider edits in between, a flood of continuous pad values, and shifted
+    erases
+    '''
+    rand = random.Random(0)
+    events = []
+    for i in range(20):
+        step = rand.randrange(16)
+        events.append(PadVelocityEvent(step, 100))
+        for j in range(10):
+            events.append(PadValueEvent(16 + rand.randrange(32),
+                                        rand.randrange(1, 200)))
+            events.append(SliderValueEvent(j % 2, True, rand.random()))
+        events.append(PadValueEvent(16, 0))
+        events.append(PadVelocityEvent(step, 0))
+        events.append(SliderValueEvent(0, False, 0xffff))
+        events.append(SliderValueEvent(1, False, 0xffff))
+        events.append(ButtonVelocityEvent(1, 100))
+        events.append(PadVelocityEvent(step, 100))
+        events.append(PadVelocityEvent(step, 0))
+        events.append(ButtonVelocityEvent(1, 0))
+    return events
+
+def bench_stress(seq_class, no_op_state=False, metrics=False):
+    '''
+    Returns the number of events per second MantaSeq.process() handles. With
+    no_op_state set, the events are routed to a state that ignores them, which
+    isolates the dispatch overhead. With metrics set, process() is
+    instrumented.
+    '''
+    seq = seq_class(midi_source=_NullMIDIBackend())
+    if metrics:
+        seq.enable_metrics()
+    if no_op_state:
+        # the no-op state never changes state, so it's the only one needed
+        seq._state = MantaSeqState(seq)
+    try:
+        seq.stop()
+        # measure our side of the LED output, not the socket
+        seq._manta._send_datagram = lambda data: None
+        events = stress_events()
+        seq._manta.process = lambda: events
+        start = time.time()
+        for i in range(STRESS_ROUNDS):
+            seq.process()
+        elapsed = time.time() - start
+    finally:
+        seq._manta.osc_server.close()
+    return STRESS_ROUNDS * len(events) / elapsed
+
+def main():
+    old = bench_slider_drag(_OldSeq())
+    new = bench_slider_drag(Seq())
+    print('slider drag, __getattr__ setters: %10.0f events/s' % old)
+    print('slider drag, cached setters:      %10.0f events/s (%.1fx)' % (
+            new, new / old))
+    for no_op_state, label in ((True, 'dispatch only'), (False, 'full stress')):
+        old = bench_stress(_IsinstanceDispatchMantaSeq, no_op_state)
+        new = bench_stress(MantaSeq, no_op_state)
+        print('%-13s, isinstance chain: %10.0f events/s' % (label, old))
+        print('%-13s, handler table:    %10.0f events/s (%.2fx)' % (
+                label, new, new / old))
+    off = bench_stress(MantaSeq)
+    on = bench_stress(MantaSeq, metrics=True)
+    print('full stress  , metrics off:      %10.0f events/s' % off)
+    print('full stress  , metrics on:       %10.0f events/s (%.2fx)' % (
+            on, on / off))
+
+if __name__ == '__main__':
+    main()
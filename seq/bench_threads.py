@@ -0,0 +1,90 @@
+'''
+Compares step timing between the single-threaded loop and the threaded mode
+when LED output is slow. Every LED datagram has a chance of blocking for a
+while, to stand in for a congested OSCClient.send. For each mode we report
+how far note-ons landed from their ideal times. Run directly:
+
+    python bench_threads.py
+'''
+import random
+import time
+from clock import SystemClock
+from mantaseq import MantaSeq
+from midibackends import CaptureBackend
+
+RUN_TIME = 2.0
+STEP_DURATION = 0.05
+# chance of an LED datagram blocking, and how long it can block for
+STALL_PROBABILITY = 0.3
+MAX_STALL = 0.03
+
+def slow_send(data):
+    if random.random() < STALL_PROBABILITY:
+        time.sleep(random.uniform(0, MAX_STALL))
+
+def populate(seq):
+    for i in range(16):
+        seq._seq.select_step(i)
+        seq._seq.set_note(60)
+        seq._seq.set_velocity(100)
+        seq._seq.deselect_step(i)
+
+def run_single(seq, clock):
+    seq.start()
+    start = seq.next_step_timestamp
+    while clock.now() < start + RUN_TIME:
+        deadline = seq.next_deadline()
+        if deadline is not None:
+            seq._manta.wait(max(0, deadline - clock.now()))
+        seq.process()
+    seq.stop()
+    seq.process()
+    return start
+
+def run_threaded(seq, clock):
+    seq.start_threads()
+    try:
+        seq.start()
+        # the timing thread anchors the start when it gets to it
+        while not seq.running:
+            seq.process_ui(0.001)
+        start = seq.next_step_timestamp
+        while clock.now() < start + RUN_TIME:
+            seq.process_ui(0.01)
+        seq.stop()
+    finally:
+        seq.stop_threads()
+    return start
+
+def measure(seq, run):
+    '''
+    Returns the errors (actual - ideal) in seconds of every note-on sent over
+    RUN_TIME seconds of playback
+    '''
+    clock = seq._clock
+    capture = CaptureBackend(clock)
+    seq.set_midi_source(capture)
+    start = run(seq, clock)
+    note_ons = [t for t, message in capture.sent
+                if message[0] == 0x90 and message[2] > 0]
+    return [t - (start + i * STEP_DURATION) for i, t in enumerate(note_ons)]
+
+def main():
+    seq = MantaSeq(midi_source=CaptureBackend(SystemClock()))
+    seq.step_duration = STEP_DURATION
+    populate(seq)
+    seq._manta._send_datagram = slow_send
+    print('mode          mean err     stdev   max |err|   (ms)')
+    try:
+        for label, run in (('single', run_single), ('threaded', run_threaded)):
+            errors = measure(seq, run)
+            mean = sum(errors) / len(errors)
+            stdev = (sum((e - mean) ** 2 for e in errors) / len(errors)) ** 0.5
+            worst = max(abs(e) for e in errors)
+            print('%-9s %12.3f %9.3f %11.3f' % (
+                    label, mean * 1000, stdev * 1000, worst * 1000))
+    finally:
+        seq.cleanup()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import ctypes
+import ctypes.util
+import os
+import sys
+import time
+
+# the sequencer needs a clock that never jumps, so NTP adjustments to the
+# wall clock can't throw off step timing. Python 2 doesn't have one built in,
+# so there we read CLOCK_MONOTONIC through clock_gettime() ourselves. There's
+# deliberately no fallback to the wall clock.
+_CLOCK_MONOTONIC = {'linux': 1, 'darwin': 6}
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _clock_gettime_monotonic():
+    platform = sys.platform.rstrip('0123456789')
+    if platform not in _CLOCK_MONOTONIC:
+        raise ImportError('No monotonic clock available on %s' % sys.platform)
+    clock_id = _CLOCK_MONOTONIC[platform]
+    # clock_gettime() is in librt on older Linux systems
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    try:
+        clock_gettime = libc.clock_gettime
+    except AttributeError:
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt'),
+                                    use_errno=True).clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    timespec = _timespec()
+    # made once, as this is called on every step and event
+    timespec_ref = ctypes.byref(timespec)
+    def monotonic():
+        if clock_gettime(clock_id, timespec_ref) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'clock_gettime: %s' % os.strerror(errno))
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+    # fail now rather than on the first step
+    monotonic()
+    return monotonic
+
+try:
+    monotonic = time.perf_counter
+except AttributeError:
+    monotonic = _clock_gettime_monotonic()
+
+class SystemClock(object):
+    '''Reads the highest-resolution monotonic clock available'''
+    def now(self):
+        return monotonic()
+
+class VirtualClock(object):
+    '''A clock that only moves when told to, for tests and offline rendering'''
+    def __init__(self, start=0.0):
+        self._now = start
+
+    def now(self):
+        return self._now
+
+    def advance(self, amount):
+        self._now += amount
+
+    def set(self, timestamp):
+        self._now = timestamp
+
+class LoopClock(object):
+    '''Reads an asyncio event loop's clock, which its timers run on'''
+    def __init__(self, loop):
+        self._loop = loop
+
+    def now(self):
+        return self._loop.time()
@@ -0,0 +1,142 @@
+'''
+Stands in for a Manta (or rather the MantaOSC bridge), sending real OSC
+datagrams over UDP from a separate process. Input is described by patterns:
+lists of (offset, datagram, expected) tuples, where offset is seconds from
+the start, and expected is the MIDI message MantaSeq should send in response
+when idle, or None.
+'''
+import multiprocessing
+import socket
+import struct
+import time
+from clock import SystemClock
+from manta import osc_prefix, note_from_pad
+from mantaseq import make_note, make_cc
+
+_PAD_VELOCITY = osc_prefix('/manta/velocity/pad', 'ii')
+_PAD_VALUE = osc_prefix('/manta/continuous/pad', 'ii')
+_SLIDER_VALUE = osc_prefix('/manta/continuous/slider', 'ii')
+_INT_PAIR = struct.Struct('>ii')
+
+def pad_velocity_datagram(pad_num, velocity):
+    return _PAD_VELOCITY + _INT_PAIR.pack(pad_num, velocity)
+
+def pad_value_datagram(pad_num, value):
+    return _PAD_VALUE + _INT_PAIR.pack(pad_num, value)
+
+def slider_value_datagram(slider_num, value):
+    return _SLIDER_VALUE + _INT_PAIR.pack(slider_num, value)
+
+def _spaced(messages, rate):
+    '''Spreads (datagram, expected) pairs out at rate per second'''
+    interval = 1.0 / rate if rate else 0
+    return [(i * interval, datagram, expected)
+            for i, (datagram, expected) in enumerate(messages)]
+
+def single_hits(count, rate, pad_num=16, velocity=100):
+    '''Presses and releases one note pad count times'''
+    note = note_from_pad(pad_num)
+    messages = []
+    for i in range(count):
+        messages.append((pad_velocity_datagram(pad_num, velocity),
+                         make_note(note, velocity)))
+        messages.append((pad_velocity_datagram(pad_num, 0),
+                         make_note(note, 0)))
+    return _spaced(messages, rate)
+
+def pressure_sweep(rate, passes=1, steps=8):
+    '''
+    Runs across all 48 pads, ramping each one's pressure up and back down.
+    The note pads are also pressed and released, which is what shows up as
+    MIDI. A rate of 0 sends everything as fast as possible.
+    '''
+    ramp = [int(127 * (i + 1) / steps) for i in range(steps)]
+    ramp += ramp[-2::-1] + [0]
+    messages = []
+    for i in range(passes):
+        for pad_num in range(48):
+            # the step pads only take velocities as selections
+            is_note_pad = pad_num >= 16
+            if is_note_pad:
+                note = note_from_pad(pad_num)
+                messages.append((pad_velocity_datagram(pad_num, 100),
+                                 make_note(note, 100)))
+            for value in ramp:
+                messages.append((pad_value_datagram(pad_num, value), None))
+            if is_note_pad:
+                messages.append((pad_velocity_datagram(pad_num, 0),
+                                 make_note(note, 0)))
+    return _spaced(messages, rate)
+
+def pad_values(count, rate):
+    '''
+    Continuous values cycling across the note pads with no presses, so
+    nothing should come out as MIDI
+    '''
+    messages = []
+    for i in range(count):
+        pad_num = 16 + i % 32
+        messages.append((pad_value_datagram(pad_num, (i // 32) % 128), None))
+    return _spaced(messages, rate)
+
+def slider_drag(count, rate):
+    '''
+    Drags both sliders back and forth, alternating between them. Every value
+    moves the slider's CC, so each one should come out as MIDI.
+    '''
+    sweep = list(range(128)) + list(range(126, 0, -1))
+    messages = []
+    for i in range(count):
+        slider_num = i % 2
+        cc_value = sweep[(i // 2) % len(sweep)]
+        # the smallest raw value that maps to cc_value
+        raw = (cc_value * 4096 + 126) // 127
+        messages.append((slider_value_datagram(slider_num, raw),
+                         make_cc(slider_num + 1, cc_value)))
+    return _spaced(messages, rate)
+
+def _send_pattern(address, schedule, start, connection):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    clock = SystemClock()
+    send_times = []
+    for offset, datagram in schedule:
+        delay = start + offset - clock.now()
+        if delay > 0:
+            time.sleep(delay)
+        send_times.append(clock.now())
+        sock.sendto(datagram, address)
+    sock.close()
+    connection.send(send_times)
+    connection.close()
+
+class FakeMantaClient(object):
+    '''
+    Plays a pattern to address from its own process, so it doesn't compete
+    with the code being measured for the interpreter
+    '''
+    def __init__(self, address):
+        self.address = address
+        self._process = None
+        self._connection = None
+
+    def start(self, pattern, delay=0.2):
+        '''
+        Starts sending pattern in delay seconds, which gives the process time
+        to get going, and returns when the first datagram is due
+        '''
+        start = SystemClock().now() + delay
+        schedule = [(offset, datagram) for offset, datagram, _ in pattern]
+        self._connection, child_connection = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+                target=_send_pattern,
+                args=(self.address, schedule, start, child_connection))
+        self._process.start()
+        return start
+
+    def join(self):
+        '''Waits for the pattern to finish, returning when each was sent'''
+        send_times = self._connection.recv()
+        self._process.join()
+        self._connection.close()
+        self._process = self._connection = None
+        return send_times
@@ -0,0 +1,243 @@
+'''
+A journal of everything the sequencer does, for working out after the fact
+what happened when a show glitched. Input events, state changes, MIDI output
+and LED changes are written to a preallocated ring in memory, stamped with
+the monotonic clock, and a background thread appends them to a file. Each
+record is a fixed 15 bytes: the timestamp as a double, the kind of record,
+and three unsigned shorts whose meaning depends on the kind (see KINDS).
+
+Attach one with MantaSeq.set_journal(). To read a journal back, run this
+directly:
+
+    python journal.py show.journal [--format json] [--last 300]
+'''
+import argparse
+import csv
+import json
+import struct
+import sys
+import threading
+import time
+from clock import monotonic
+from manta import (PadVelocityEvent,
+                   ButtonVelocityEvent,
+                   PadValueEvent,
+                   SliderValueEvent,
+                   OFF, AMBER, RED)
+
+MAGIC = b'MSQJ'
+VERSION = 1
+# the monotonic and wall clock times when the journal was started, so the
+# timestamps can be turned into times of day
+_HEADER = struct.Struct('>4sBdd')
+_RECORD = struct.Struct('>dBHHH')
+
+# the name and field names of each kind of record, indexed by kind
+KINDS = [
+    ('pad_velocity', ('pad', 'velocity')),
+    ('button_velocity', ('button', 'velocity')),
+    ('pad_value', ('pad', 'value')),
+    ('slider_value', ('slider', 'value')),
+    ('state', ('state',)),
+    ('midi', ('status', 'data1', 'data2')),
+    ('led_pad', ('pad', 'led')),
+    ('led_slider', ('slider', 'led', 'mask')),
+    ('led_button', ('button', 'led')),
+]
+(PAD_VELOCITY, BUTTON_VELOCITY, PAD_VALUE, SLIDER_VALUE, STATE, MIDI,
+ LED_PAD, LED_SLIDER, LED_BUTTON) = range(len(KINDS))
+# MantaSeq's states, recorded by index
+STATE_NAMES = ('idle', 'steps_selected', 'shifted', 'tempo_adjust')
+LED_STATES = (OFF, AMBER, RED)
+_LED_CODES = dict((state, code) for code, state in enumerate(LED_STATES))
+# slider values are kept as the raw 12-bit value, with 0xffff for a release
+_SLIDER_SCALE = 4096
+
+class Journal(object):
+    '''
+    Journals to the file at path, keeping up to capacity records in memory
+    between flushes. Flushing happens every flush_interval seconds on a
+    thread of its own. If more than capacity records come in between
+    flushes, the oldest are lost and counted in dropped.
+    '''
+    def __init__(self, path, capacity=65536, flush_interval=0.5):
+        self._capacity = capacity
+        self._ring = bytearray(capacity * _RECORD.size)
+        # the total number of records written and flushed so far. Records
+        # are written by whichever thread is sending, but only flushed here
+        self._written = 0
+        self._flushed = 0
+        self._write_lock = threading.Lock()
+        self.dropped = 0
+        self._file = open(path, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION, monotonic(), time.time()))
+        self._flush_interval = flush_interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, kind, a=0, b=0, c=0):
+        with self._write_lock:
+            _RECORD.pack_into(self._ring,
+                              (self._written % self._capacity) * _RECORD.size,
+                              monotonic(), kind, a, b, c)
+            self._written += 1
+
+    def record_event(self, event):
+        event_type = type(event)
+        if event_type is PadVelocityEvent:
+            self.record(PAD_VELOCITY, event.pad_num, event.velocity)
+        elif event_type is ButtonVelocityEvent:
+            self.record(BUTTON_VELOCITY, event.button_num, event.velocity)
+        elif event_type is PadValueEvent:
+            self.record(PAD_VALUE, event.pad_num, event.value)
+        elif event_type is SliderValueEvent:
+            self.record(SLIDER_VALUE, event.slider_num,
+                        int(round(event.value * _SLIDER_SCALE)))
+
+    def record_state(self, state_index):
+        self.record(STATE, state_index)
+
+    def record_midi(self, message):
+        self.record(MIDI, *message)
+
+    def record_led_pad(self, led_state, pad_index):
+        self.record(LED_PAD, pad_index, _LED_CODES[led_state])
+
+    def record_led_slider(self, led_state, slider_index, mask):
+        self.record(LED_SLIDER, slider_index, _LED_CODES[led_state], mask)
+
+    def record_led_button(self, led_state, button_index):
+        self.record(LED_BUTTON, button_index, _LED_CODES[led_state])
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self._flush_interval):
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes out the records since the last flush. Only the flush thread
+        and close() should call this.
+        '''
+        capacity = self._capacity
+        size = _RECORD.size
+        written = self._written
+        start = max(self._flushed, written - capacity)
+        self.dropped += start - self._flushed
+        if start == written:
+            return
+        # copy without holding the lock, so the writers never wait on us
+        begin = (start % capacity) * size
+        end = (written % capacity) * size
+        if begin < end:
+            chunk = self._ring[begin:end]
+        else:
+            chunk = self._ring[begin:] + self._ring[:end]
+        # anything the writers lapped while we were copying is garbage. The
+        # count is read under the lock, so a record that was being packed
+        # while we copied (but not yet counted) can't slip through
+        with self._write_lock:
+            lapped = self._written
+        overwritten = min(lapped - capacity, written) - start
+        if overwritten > 0:
+            chunk = chunk[overwritten * size:]
+            self.dropped += overwritten
+        self._file.write(bytes(chunk))
+        self._file.flush()
+        self._flushed = written
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+        self._file.close()
+
+class JournaledMIDISource(object):
+    '''Passes MIDI through to midi_source, journaling each message'''
+    def __init__(self, midi_source, journal):
+        self._midi_source = midi_source
+        self._journal = journal
+
+    def send(self, message):
+        self._journal.record_midi(message)
+        self._midi_source.send(message)
+
+    def flush(self):
+        self._midi_source.flush()
+
+    def close(self):
+        self._midi_source.close()
+
+def read_journal(path):
+    '''
+    Returns the monotonic and wall clock start times of the journal at path,
+    and a generator of its (timestamp, kind, a, b, c) records
+    '''
+    log = open(path, 'rb')
+    header = log.read(_HEADER.size)
+    if len(header) < _HEADER.size or header[:len(MAGIC)] != MAGIC:
+        log.close()
+        raise ValueError('%s is not a journal' % path)
+    magic, version, start, wall_start = _HEADER.unpack(header)
+    if version != VERSION:
+        log.close()
+        raise ValueError('Unsupported journal version: %d' % version)
+    def records():
+        with log:
+            while True:
+                record = log.read(_RECORD.size)
+                if len(record) < _RECORD.size:
+                    # the end, or cut off mid-write
+                    return
+                yield _RECORD.unpack(record)
+    return start, wall_start, records()
+
+def describe(record):
+    '''Returns a record as a dict of its named and decoded fields'''
+    timestamp, kind, a, b, c = record
+    name, fields = KINDS[kind]
+    values = dict(zip(fields, (a, b, c)))
+    if kind == STATE:
+        values['state'] = STATE_NAMES[a]
+    elif kind == SLIDER_VALUE:
+        values['value'] = (None if b == 0xffff else
+                           float(b) / _SLIDER_SCALE)
+    elif kind in (LED_PAD, LED_SLIDER, LED_BUTTON):
+        values['led'] = LED_STATES[b]
+    values['kind'] = name
+    return values
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Converts a journal to CSV or JSON')
+    parser.add_argument('journal')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+    parser.add_argument('--last', type=float, metavar='SECONDS',
+                        help='only show the end of the journal')
+    args = parser.parse_args()
+    start, wall_start, records = read_journal(args.journal)
+    rows = []
+    for record in records:
+        row = describe(record)
+        row['time'] = round(record[0] - start, 6)
+        rows.append(row)
+    if args.last is not None and rows:
+        cutoff = rows[-1]['time'] - args.last
+        rows = [row for row in rows if row['time'] >= cutoff]
+    if args.format == 'json':
+        json.dump({'wall_start': wall_start, 'records': rows}, sys.stdout,
+                  indent=1, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        columns = ['time', 'kind']
+        for name, fields in KINDS:
+            columns.extend(field for field in fields if field not in columns)
+        writer = csv.DictWriter(sys.stdout, columns)
+        writer.writerow(dict(zip(columns, columns)))
+        for row in rows:
+            row['time'] = '%.6f' % row['time']
+            writer.writerow(row)
+
+if __name__ == '__main__':
+    main()
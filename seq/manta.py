@@ -1,5 +1,21 @@
-from OSC import OSCClient, OSCServer, OSCMessage
+try:
+    from OSC import (OSCClient, OSCClientError, OSCServer, OSCMessage,
+                     decodeOSC)
+except ImportError:
+    # pyOSC is Python 2 only. On Python 3 (which asyncmanta.py needs) install
+    # its port, pyOSC3, instead
+    from pyOSC3 import (OSCClient, OSCClientError, OSCServer, OSCMessage,
+                        decodeOSC)
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import struct
 import sys
+import time
+from clock import monotonic, SystemClock
 
 
 wickihayden = [0,  2,  4,  6,  8,  10, 12, 14,
@@ -41,27 +57,36 @@ AMBER = 'amber'
 OFF = 'off'
 
 class PadVelocityEvent(object):
-    def __init__(self, pad_num, velocity):
+    __slots__ = ('pad_num', 'velocity', 'timestamp')
+
+    def __init__(self, pad_num, velocity, timestamp=None):
         self.pad_num = pad_num
         self.velocity = velocity
+        self.timestamp = timestamp
 
     def __str__(self):
         return "Pad Velocity Event: idx %d, velocity %d" % (
                 self.pad_num, self.velocity)
 
 class ButtonVelocityEvent(object):
-    def __init__(self, button_num, velocity):
+    __slots__ = ('button_num', 'velocity', 'timestamp')
+
+    def __init__(self, button_num, velocity, timestamp=None):
         self.button_num = button_num
         self.velocity = velocity
+        self.timestamp = timestamp
 
     def __str__(self):
         return "Button Velocity Event: idx %d, velocity %d" % (
                 self.button_num, self.velocity)
 
 class PadValueEvent(object):
-    def __init__(self, pad_num, value):
+    __slots__ = ('pad_num', 'value', 'timestamp')
+
+    def __init__(self, pad_num, value, timestamp=None):
         self.pad_num = pad_num
         self.value = value
+        self.timestamp = timestamp
 
     def __str__(self):
         return "Pad Value Event: idx %d, value %d" % (self.pad_num, self.value)
@@ -69,10 +94,13 @@ class PadValueEvent(object):
 class SliderValueEvent(object):
     '''A touch, release, or movement on one of the two sliders.
     If touched is false then the value is invalid'''
-    def __init__(self, slider_num, touched, value):
+    __slots__ = ('touched', 'slider_num', 'value', 'timestamp')
+
+    def __init__(self, slider_num, touched, value, timestamp=None):
         self.touched = touched
         self.slider_num = slider_num
         self.value = value
+        self.timestamp = timestamp
 
     def __str__(self):
         return "Slider Value Event: idx %d, %s, value %d" % (
@@ -80,66 +108,699 @@ class SliderValueEvent(object):
                 'touched' if self.touched else 'not touched',
                 self.value)
 
-class Manta(object):
+class _EventPool(object):
+    '''
+    A set of preallocated events of one type that the decoder fills in, so we
+    don't allocate a new event per message. Everything taken from the pool is
+    handed back by reset().
+    '''
+    def __init__(self, factory, size):
+        self._factory = factory
+        self._events = [factory() for i in range(size)]
+        self._used = 0
+
+    def take(self):
+        if self._used == len(self._events):
+            # more events in one batch than we've seen before
+            self._events.append(self._factory())
+        event = self._events[self._used]
+        self._used += 1
+        return event
+
+    def reset(self, reuse=True):
+        '''
+        Makes the events handed out so far available again. With reuse unset
+        they're replaced with new ones instead, so the caller can keep them.
+        '''
+        if not reuse:
+            self._events[:self._used] = [self._factory()
+                                         for i in range(self._used)]
+        self._used = 0
+
+class EventCoalescer(object):
+    '''
+    Collapses the continuous pad and slider values in a batch of events down
+    to the last value for each pad or slider, since that's all that matters
+    by the time we get to them. Velocity and button events, and slider
+    releases, are kept exactly and in order, and values are never moved
+    across them.
+    '''
+    def __init__(self):
+        # number of events dropped, by event type
+        self.collapsed = {PadValueEvent: 0, SliderValueEvent: 0}
+        self.total_collapsed = 0
+
+    def coalesce(self, events):
+        result = []
+        # maps (event type, index) to (position, event) for the latest
+        # continuous value of each pad or slider since the last exact event
+        pending = {}
+        for position, event in enumerate(events):
+            event_type = type(event)
+            if event_type is PadValueEvent:
+                key = (event_type, event.pad_num)
+            elif event_type is SliderValueEvent and event.touched:
+                key = (event_type, event.slider_num)
+            else:
+                if pending:
+                    self._flush(pending, result)
+                result.append(event)
+                continue
+            if key in pending:
+                self.collapsed[event_type] += 1
+                self.total_collapsed += 1
+            pending[key] = (position, event)
+        if pending:
+            self._flush(pending, result)
+        return result
+
+    def _flush(self, pending, result):
+        '''Adds the pending values to result in the order they arrived'''
+        result.extend(event for position, event in sorted(pending.values(),
+                key=lambda entry: entry[0]))
+        pending.clear()
+
+def _read_kernel_drops(sock):
+    '''
+    Returns the number of datagrams the kernel has dropped on the given UDP
+    socket because its receive buffer was full, or None if the platform
+    doesn't expose it (it's read from /proc/net/udp, so this is Linux-only).
+    '''
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    try:
+        with open('/proc/net/udp') as udp_table:
+            # skip the header line
+            next(udp_table)
+            for line in udp_table:
+                fields = line.split()
+                if fields[9] == inode:
+                    return int(fields[12])
+    except (IOError, OSError, IndexError, StopIteration):
+        pass
+    return None
+
+# Linux's socket option for nanosecond receive timestamps, which Python
+# doesn't define
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+_TIMESPEC = struct.Struct('@ll')
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+# the cmsghdr that heads each control message: its length, level and type,
+# with the data aligned to a size_t (a long on Linux) after it
+_CMSGHDR = struct.Struct('@Lii')
+_CMSG_ALIGN = ctypes.sizeof(ctypes.c_size_t)
+_CMSG_DATA = (_CMSGHDR.size + _CMSG_ALIGN - 1) & ~(_CMSG_ALIGN - 1)
+_SOCKADDR_FAMILY = struct.Struct('@H')
+_SOCKADDR_PORT = struct.Struct('>H')
+
+def _libc_recvmsg(sock, size):
+    '''
+    recvmsg() for pythons that don't have it (anything before 3.3), through
+    libc. Returns a function like the one _timestamped_receiver() does.
+    '''
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    recvmsg = libc.recvmsg
+    recvmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_msghdr), ctypes.c_int]
+    recvmsg.restype = ctypes.c_ssize_t
+    # everything's allocated once, as this is called for every datagram
+    fd = sock.fileno()
+    data = ctypes.create_string_buffer(size)
+    name = ctypes.create_string_buffer(128)
+    control = ctypes.create_string_buffer(64)
+    iov = _iovec(ctypes.cast(data, ctypes.c_void_p), size)
+    header = _msghdr()
+    header.msg_iov = ctypes.pointer(iov)
+    header.msg_iovlen = 1
+    header.msg_name = ctypes.cast(name, ctypes.c_void_p)
+    header.msg_control = ctypes.cast(control, ctypes.c_void_p)
+    header_ref = ctypes.byref(header)
+    name_size = len(name)
+    control_size = len(control)
+    string_at = ctypes.string_at
+    def receive(max_size):
+        header.msg_namelen = name_size
+        header.msg_controllen = control_size
+        if iov.iov_len != max_size:
+            iov.iov_len = min(max_size, size)
+        length = recvmsg(fd, header_ref, 0)
+        if length < 0:
+            error = ctypes.get_errno()
+            raise socket.error(error, os.strerror(error))
+        arrived = None
+        # the timestamp is the only control message we asked for
+        if header.msg_controllen >= _CMSG_DATA + _TIMESPEC.size:
+            cmsg_len, level, kind = _CMSGHDR.unpack_from(control)
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS:
+                seconds, nanoseconds = _TIMESPEC.unpack_from(control,
+                                                             _CMSG_DATA)
+                arrived = seconds + nanoseconds * 1e-9
+        return string_at(data, length), _decode_sockaddr(name), arrived
+    return receive
+
+def _decode_sockaddr(sockaddr):
+    '''Returns a sockaddr buffer as the (host, port) python would'''
+    family, = _SOCKADDR_FAMILY.unpack_from(sockaddr)
+    port, = _SOCKADDR_PORT.unpack_from(sockaddr, 2)
+    if family == socket.AF_INET6:
+        return socket.inet_ntop(socket.AF_INET6, sockaddr[8:24]), port
+    return socket.inet_ntoa(sockaddr[4:8]), port
+
+def _timestamped_receiver(sock):
+    '''
+    Asks the kernel to timestamp each datagram on sock as it arrives, and
+    returns a function that reads a datagram, returning it with its source
+    and the wall clock time it arrived (or None if it wasn't stamped). Returns
+    None if this isn't supported here.
+    '''
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+    except socket.error:
+        return None
+    if not hasattr(sock, 'recvmsg'):
+        # the timestamp only comes with the datagram, in its ancillary data
+        return _libc_recvmsg(sock, 65536)
+    ancillary_size = socket.CMSG_SPACE(_TIMESPEC.size)
+    def receive(size):
+        data, ancillary, flags, source = sock.recvmsg(size, ancillary_size)
+        for level, kind, payload in ancillary:
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS:
+                seconds, nanoseconds = _TIMESPEC.unpack(
+                        payload[:_TIMESPEC.size])
+                return data, source, seconds + nanoseconds * 1e-9
+        return data, source, None
+    return receive
+
+def _osc_string(string):
+    '''Encodes a string as a null-terminated OSC string padded to 4 bytes'''
+    string = string.encode('ascii') + b'\0'
+    return string + b'\0' * (-len(string) % 4)
+
+def osc_prefix(address, typetags):
+    '''
+    Returns the encoded address and type tag string that starts every OSC
+    message sent to address with the given type tags (without the ',')
+    '''
+    return _osc_string(address) + _osc_string(',' + typetags)
+
+def encode_osc(path, *args):
+    '''Returns the binary encoding of an OSC message'''
+    msg = OSCMessage(path)
+    msg.append(args)
+    return msg.getBinary()
+
+_BUNDLE_TAG = _osc_string('#bundle')
+_BUNDLE_ELEMENT_SIZE = struct.Struct('>i')
+_TIMETAG = struct.Struct('>II')
+_TIMETAG_IMMEDIATE = _TIMETAG.pack(0, 1)
+# seconds between the NTP epoch (1900) that OSC uses and the unix epoch
+_NTP_EPOCH_OFFSET = 2208988800
+
+def encode_timetag(timestamp):
+    '''
+    Encodes a unix timestamp as an OSC timetag. None gives the special
+    "immediately" timetag.
+    '''
+    if timestamp is None:
+        return _TIMETAG_IMMEDIATE
+    seconds = int(timestamp)
+    fraction = int((timestamp - seconds) * (1 << 32))
+    return _TIMETAG.pack(seconds + _NTP_EPOCH_OFFSET, fraction)
 
-    def __init__(self, receive_port=31416, send_port=31417, send_address='127.0.0.1'):
-        self.osc_client = OSCClient()
-        self.osc_server = OSCServer(('127.0.0.1', receive_port))
-        self.osc_client.connect(('127.0.0.1', send_port))
-        # set the osc server to time out after 1ms
-        self.osc_server.timeout = 0.001
+class _PacketCache(dict):
+    '''
+    Encodes OSC messages for one address the first time they're needed.
+    Indexing with one argument at a time, e.g. cache[RED][10], gives the
+    encoded message with those arguments, and once it's been built the lookup
+    doesn't allocate anything.
+    '''
+    def __init__(self, path, arg_count, *args):
+        self._path = path
+        self._arg_count = arg_count
+        self._args = args
+
+    def __missing__(self, arg):
+        args = self._args + (arg,)
+        if len(args) == self._arg_count:
+            value = encode_osc(self._path, *args)
+        else:
+            value = _PacketCache(self._path, self._arg_count, *args)
+        self[arg] = value
+        return value
+
+# the fixed vocabulary of control messages we send, shared by all instances
+_LED_ENABLE_PACKETS = _PacketCache('/manta/ledcontrol', 2)
+_LED_PAD_PACKETS = _PacketCache('/manta/led/pad', 2)
+_LED_ROW_PACKETS = _PacketCache('/manta/led/pad/row', 3)
+_LED_SLIDER_PACKETS = _PacketCache('/manta/led/slider', 3)
+_LED_BUTTON_PACKETS = _PacketCache('/manta/led/button', 2)
+# pad LEDs are by far the most common, so build them all up front
+for _led_state in (OFF, AMBER, RED):
+    for _pad_index in range(48):
+        _LED_PAD_PACKETS[_led_state][_pad_index]
+
+class Manta(object):
+    # max number of datagrams decoded by a single process() call, so a flood
+    # of continuous data can't starve the caller
+    max_batch = 256
+    max_datagram_size = 1024
+    # keep outgoing bundles within a single ethernet frame
+    max_bundle_size = 1472
+
+    def __init__(self, receive_port=31416, send_port=31417, send_address='127.0.0.1',
+                 timeout=0.001, fast_decode=True, buffer_leds=False,
+                 bundle_output=False, reuse_events=True,
+                 kernel_timestamps=False):
+        # the events handed out by process() come from these pools, and the
+        # list they come in is reused too, so they're only valid until the
+        # next call to process(). With reuse_events unset, each call gets a
+        # new list and new events, which can be handed to another thread
+        self.reuse_events = reuse_events
         self.event_queue = []
-        self.osc_server.addMsgHandler('/manta/continuous/pad',
+        self._pad_velocity_events = _EventPool(
+                lambda: PadVelocityEvent(0, 0), self.max_batch)
+        self._button_velocity_events = _EventPool(
+                lambda: ButtonVelocityEvent(0, 0), self.max_batch)
+        self._pad_value_events = _EventPool(
+                lambda: PadValueEvent(0, 0), self.max_batch)
+        self._slider_value_events = _EventPool(
+                lambda: SliderValueEvent(0, False, 0), self.max_batch)
+        # number of datagrams read by the last process() call, and the most
+        # we've seen queued up at once
+        self.backlog_depth = 0
+        self.max_backlog_depth = 0
+        self.datagrams_received = 0
+        # if set, every datagram received is passed to its record() method
+        # along with the time it was read (see sessionlog)
+        self.recorder = None
+        # if set, the time spent decoding and the number of datagrams read by
+        # each process() call are recorded here (see metrics.py)
+        self.metrics = None
+        # if set, every LED change asked for is journaled (see journal.py)
+        self.journal = None
+        # each event is stamped with the time its datagram arrived on this
+        # clock (MantaSeq sets it to its own). With kernel_timestamps set and
+        # supported, that's when the kernel received it, otherwise it's when
+        # process() read it. Reading the kernel's timestamps costs a few
+        # microseconds per datagram, so they're off unless asked for
+        self.clock = SystemClock()
+        self.kernel_timestamps = kernel_timestamps
+        self._timestamped_receive = None
+        self._datagram_time = None
+        # with buffer_leds set, pad LED changes are held until flush_leds(),
+        # which sends them with as few messages as it can
+        self.buffer_leds = buffer_leds
+        self._pending_leds = {}
+        # the last state we sent for each pad, or None if we don't know
+        self._led_states = [None] * 48
+        # with bundle_output set, outgoing messages are held until
+        # flush_output(), which sends them as OSC bundles
+        self.bundle_output = bundle_output
+        self._outgoing = []
+        self.datagrams_sent = 0
+        # maps the encoded address and type tags of the messages the manta
+        # sends to a precompiled struct for their int arguments, so we can
+        # skip pyOSC's generic decoding and pattern matching. Anything that
+        # doesn't match goes through pyOSC as usual.
+        self.fast_decode = fast_decode
+        self._fast_paths = {}
+        self._fast_arg_sizes = []
+        # maps each address we handle to its callback
+        self._callbacks = {}
+        self._add_handler('/manta/continuous/pad', 'ii',
                 self._pad_value_callback)
-        self.osc_server.addMsgHandler('/manta/continuous/slider',
+        self._add_handler('/manta/continuous/slider', 'ii',
                 self._slider_value_callback)
-        self.osc_server.addMsgHandler('/manta/continuous/button',
+        self._add_handler('/manta/continuous/button', 'ii',
                 self._button_value_callback)
-        self.osc_server.addMsgHandler('/manta/velocity/pad',
+        self._add_handler('/manta/velocity/pad', 'ii',
                 self._pad_velocity_callback)
-        self.osc_server.addMsgHandler('/manta/velocity/button',
+        self._add_handler('/manta/velocity/button', 'ii',
                 self._button_velocity_callback)
+        self._open(receive_port, send_port, send_address, timeout)
+
+    def _open(self, receive_port, send_port, send_address, timeout):
+        '''Creates the sockets, with pyOSC handling anything off the fast path'''
+        self.osc_client = OSCClient()
+        self.osc_server = OSCServer(('127.0.0.1', receive_port))
+        self.osc_client.connect(('127.0.0.1', send_port))
+        # by default the osc server times out after 1ms. Callers that do their
+        # own waiting with wait() should pass 0 so process() never blocks
+        self.osc_server.timeout = timeout
+        # we drain the socket ourselves, so it needs to be non-blocking
+        self.osc_server.socket.setblocking(False)
+        self.set_kernel_timestamps(self.kernel_timestamps)
+        for address, callback in self._callbacks.items():
+            self.osc_server.addMsgHandler(address, callback)
+
+    def set_kernel_timestamps(self, enabled):
+        '''
+        Turns kernel receive timestamps on or off. When on, events are
+        stamped with when the kernel received their datagram, where that's
+        supported
+        '''
+        self.kernel_timestamps = enabled
+        if self.osc_server is None:
+            # a subclass that doesn't use pyOSC's sockets
+            return
+        if enabled:
+            self._timestamped_receive = _timestamped_receiver(
+                    self.osc_server.socket)
+            return
+        if self._timestamped_receive is not None:
+            self._timestamped_receive = None
+            self.osc_server.socket.setsockopt(socket.SOL_SOCKET,
+                                              SO_TIMESTAMPNS, 0)
+
+    def _add_handler(self, address, typetags, callback):
+        '''
+        Registers a callback for the given address. typetags gives the
+        integer-only arguments we expect, which get a fast decoding path.
+        '''
+        self._callbacks[address] = callback
+        arg_struct = struct.Struct('>' + typetags)
+        self._fast_paths[osc_prefix(address, typetags)] = (
+                address, typetags, arg_struct, callback)
+        if arg_struct.size not in self._fast_arg_sizes:
+            self._fast_arg_sizes.append(arg_struct.size)
+
+    def add_handler(self, address, callback):
+        '''
+        Registers a callback for messages to address that aren't from the
+        manta itself, e.g. queries from other programs. These always go
+        through pyOSC's decoding.
+        '''
+        self._callbacks[address] = callback
+        if self.osc_server is not None:
+            self.osc_server.addMsgHandler(address, callback)
+
+    def reply(self, address, path, *args):
+        '''Sends an OSC message to address, e.g. the source of a query'''
+        self.osc_server.socket.sendto(encode_osc(path, *args), address)
+
+    def fileno(self):
+        '''Returns the file descriptor of the receive socket, so a Manta can be
+        passed straight to select()'''
+        return self.osc_server.fileno()
+
+    def wait(self, timeout=None):
+        '''
+        Blocks until there's incoming OSC data to process or until timeout
+        seconds have passed. A timeout of None waits forever. Returns True if
+        there's data waiting.
+        '''
+        try:
+            readable, _, _ = select.select([self], [], [], timeout)
+        except select.error:
+            # interrupted by a signal, let the caller re-check its deadlines
+            return False
+        return bool(readable)
 
     def process(self):
-        self.osc_server.handle_request()
-        ret_list = self.event_queue
-        self.event_queue = []
-        return ret_list
+        '''
+        Decodes every datagram waiting on the socket (up to max_batch of them)
+        and returns the resulting events in a single list. If nothing is
+        waiting, this blocks for up to the timeout given to the constructor.
+        The list and the events in it are reused by the next call, unless
+        reuse_events is unset.
+        '''
+        events = self._reset_events()
+        if self.osc_server.timeout and not self.wait(self.osc_server.timeout):
+            return events
+        sock = self.osc_server.socket
+        recorder = self.recorder
+        metrics = self.metrics
+        if metrics is not None:
+            started = monotonic()
+        if recorder is not None:
+            # everything read in one call gets the same timestamp, so replays
+            # see the same batches
+            received = recorder.clock.now()
+        read_time = self.clock.now()
+        receive = self._timestamped_receive
+        if receive is not None:
+            # kernel timestamps are on the wall clock
+            wall_offset = read_time - time.time()
+        count = 0
+        while count < self.max_batch:
+            try:
+                if receive is None:
+                    data, source = sock.recvfrom(self.max_datagram_size)
+                    arrived = None
+                else:
+                    data, source, arrived = receive(self.max_datagram_size)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if recorder is not None:
+                recorder.record(received, data)
+            if arrived is None:
+                self._datagram_time = read_time
+            else:
+                self._datagram_time = arrived + wall_offset
+            self._handle_datagram(data, source)
+            count += 1
+        self.backlog_depth = count
+        if count > self.max_backlog_depth:
+            self.max_backlog_depth = count
+        self.datagrams_received += count
+        if metrics is not None:
+            metrics.record_phase('decode', monotonic() - started)
+            metrics.record_depth('input', count)
+        return events
+
+    def _reset_events(self):
+        '''
+        Starts a new list of events, reusing the old list and events if
+        reuse_events is set, and returns it
+        '''
+        reuse = self.reuse_events
+        if reuse:
+            events = self.event_queue
+            del events[:]
+        else:
+            events = self.event_queue = []
+        self._pad_velocity_events.reset(reuse)
+        self._button_velocity_events.reset(reuse)
+        self._pad_value_events.reset(reuse)
+        self._slider_value_events.reset(reuse)
+        return events
+
+    def _handle_datagram(self, data, source):
+        '''
+        Decodes a single datagram and dispatches it to its callback, using the
+        fast path if it's one of the messages we know about and falling back
+        to pyOSC otherwise.
+        '''
+        if self.fast_decode:
+            for arg_size in self._fast_arg_sizes:
+                fast_path = self._fast_paths.get(data[:-arg_size])
+                if fast_path is not None:
+                    address, typetags, arg_struct, callback = fast_path
+                    callback(address, typetags,
+                             arg_struct.unpack(data[-arg_size:]), source)
+                    return
+        self._handle_generic(data, source)
+
+    def _handle_generic(self, data, source):
+        '''Decodes and dispatches a datagram with pyOSC'''
+        if self.osc_server is None:
+            # a subclass that doesn't use pyOSC's sockets
+            self._dispatch_decoded(decodeOSC(data), source)
+            return
+        request = (data, self.osc_server.socket)
+        try:
+            self.osc_server.process_request(request, source)
+        except Exception:
+            self.osc_server.handle_error(request, source)
+
+    def _dispatch_decoded(self, message, source):
+        if not message:
+            return
+        if message[0] == '#bundle':
+            for element in message[2:]:
+                self._dispatch_decoded(element, source)
+            return
+        callback = self._callbacks.get(message[0])
+        if callback is not None:
+            callback(message[0], message[1][1:], message[2:], source)
+
+    def kernel_drops(self):
+        '''
+        Returns how many datagrams the kernel has dropped because we didn't
+        read them fast enough, or None if that isn't available.
+        '''
+        return _read_kernel_drops(self.osc_server.socket)
 
     def _pad_value_callback(self, path, tags, args, source):
-        self.event_queue.append(PadValueEvent(args[0], args[1]))
+        event = self._pad_value_events.take()
+        event.pad_num = args[0]
+        event.value = args[1]
+        event.timestamp = self._datagram_time
+        self.event_queue.append(event)
 
     def _slider_value_callback(self, path, tags, args, source):
-        touched = False if args[1] == 0xffff else True
-        scaled_value = args[1] / 4096.0
-        self.event_queue.append(SliderValueEvent(args[0], touched, scaled_value))
+        event = self._slider_value_events.take()
+        event.slider_num = args[0]
+        event.touched = False if args[1] == 0xffff else True
+        event.value = args[1] / 4096.0
+        event.timestamp = self._datagram_time
+        self.event_queue.append(event)
 
     def _button_value_callback(self, path, tags, args, source):
         pass
 
     def _pad_velocity_callback(self, path, tags, args, source):
-        self.event_queue.append(PadVelocityEvent(args[0], args[1]))
+        event = self._pad_velocity_events.take()
+        event.pad_num = args[0]
+        event.velocity = args[1]
+        event.timestamp = self._datagram_time
+        self.event_queue.append(event)
 
     def _button_velocity_callback(self, path, tags, args, source):
-        self.event_queue.append(ButtonVelocityEvent(args[0], args[1]))
+        event = self._button_velocity_events.take()
+        event.button_num = args[0]
+        event.velocity = args[1]
+        event.timestamp = self._datagram_time
+        self.event_queue.append(event)
 
     def _send_osc(self, path, *args):
-        msg = OSCMessage(path)
-        msg.append(args)
-        self.osc_client.send(msg)
+        self._send_packet(encode_osc(path, *args))
+
+    def _send_packet(self, packet):
+        '''Sends an already-encoded OSC packet'''
+        if self.bundle_output:
+            self._outgoing.append(packet)
+        else:
+            self._send_datagram(packet)
+
+    def _send_datagram(self, data):
+        try:
+            self.osc_client.socket.send(data)
+        except socket.error as e:
+            raise OSCClientError('while sending: %s' % str(e))
+        self.datagrams_sent += 1
+
+    def flush_output(self, timetag=None):
+        '''
+        Sends the messages queued since the last flush as OSC bundles, split
+        so no datagram is bigger than max_bundle_size. If timetag (a unix
+        timestamp) is given the receiver should apply the messages at that
+        time, otherwise it applies them immediately. A single message with no
+        timetag is sent on its own.
+        '''
+        outgoing = self._outgoing
+        if not outgoing:
+            return
+        if len(outgoing) == 1 and timetag is None:
+            self._send_datagram(outgoing[0])
+        else:
+            header = _BUNDLE_TAG + encode_timetag(timetag)
+            bundle = [header]
+            size = len(header)
+            for packet in outgoing:
+                element_size = _BUNDLE_ELEMENT_SIZE.size + len(packet)
+                if (size + element_size > self.max_bundle_size and
+                        len(bundle) > 1):
+                    self._send_datagram(b''.join(bundle))
+                    bundle = [header]
+                    size = len(header)
+                bundle.append(_BUNDLE_ELEMENT_SIZE.pack(len(packet)))
+                bundle.append(packet)
+                size += element_size
+            self._send_datagram(b''.join(bundle))
+        del outgoing[:]
 
     def set_led_enable(self, led_type, enabled):
-        self._send_osc('/manta/ledcontrol', led_type, 1 if enabled else 0)
+        self._send_packet(_LED_ENABLE_PACKETS[led_type][1 if enabled else 0])
 
     def set_led_pad(self, led_state, pad_index):
-        self._send_osc('/manta/led/pad', led_state, pad_index)
+        if self.journal is not None:
+            self.journal.record_led_pad(led_state, pad_index)
+        if self.buffer_leds:
+            self._pending_leds[pad_index] = led_state
+        else:
+            self._send_packet(_LED_PAD_PACKETS[led_state][pad_index])
+            self._led_states[pad_index] = led_state
+
+    def set_led_row(self, led_state, row, mask):
+        '''
+        Sets the pads in the given row whose bits are set in mask (bit 0 is
+        the first column) to led_state, leaving the others alone
+        '''
+        self._send_packet(_LED_ROW_PACKETS[led_state][row][mask])
+        for column in range(8):
+            if mask & (1 << column):
+                self._led_states[row * 8 + column] = led_state
+
+    def set_led_frame(self, led_state, pads):
+        '''
+        Sets every pad in the collection pads to led_state, leaving the others
+        alone. The pads are sent as a string of 48 '0' or '1' characters.
+        '''
+        mask = ['0'] * 48
+        for pad_index in pads:
+            mask[pad_index] = '1'
+            self._led_states[pad_index] = led_state
+        self._send_osc('/manta/led/pad/frame', led_state, ''.join(mask))
+
+    def flush_leds(self):
+        '''
+        Sends the pad LED changes buffered since the last flush, using
+        whichever of individual pad messages, row messages, or frame messages
+        takes the fewest packets.
+        '''
+        if not self._pending_leds:
+            return
+        changes = [(pad_index, led_state) for pad_index, led_state
+                   in sorted(self._pending_leds.items())
+                   if self._led_states[pad_index] != led_state]
+        self._pending_leds.clear()
+        # for each color, maps the row number to the mask of pads to change
+        row_masks = {}
+        for pad_index, led_state in changes:
+            rows = row_masks.setdefault(led_state, {})
+            row = row_from_pad(pad_index)
+            rows[row] = rows.get(row, 0) | (1 << column_from_pad(pad_index))
+        row_message_count = sum(len(rows) for rows in row_masks.values())
+        if len(changes) <= len(row_masks):
+            for pad_index, led_state in changes:
+                self._send_packet(_LED_PAD_PACKETS[led_state][pad_index])
+                self._led_states[pad_index] = led_state
+        elif row_message_count <= len(row_masks):
+            for led_state, rows in sorted(row_masks.items()):
+                for row, mask in sorted(rows.items()):
+                    self.set_led_row(led_state, row, mask)
+        else:
+            for led_state in sorted(row_masks):
+                self.set_led_frame(led_state, [pad_index for pad_index, state
+                                               in changes if state == led_state])
+
+    def set_led_slider(self, led_state, slider_index, mask):
+        if self.journal is not None:
+            self.journal.record_led_slider(led_state, slider_index, mask)
+        self._send_packet(_LED_SLIDER_PACKETS[led_state][slider_index][mask])
+
+    def set_led_button(self, led_state, button_index):
+        if self.journal is not None:
+            self.journal.record_led_button(led_state, button_index)
+        self._send_packet(_LED_BUTTON_PACKETS[led_state][button_index])
 
 
-#"/manta/led/pad/row", "sii", LEDRowHandler, this);
 #"/manta/led/pad/column", "sii", LEDColumnHandler, this);
-#"/manta/led/pad/frame", "ss", LEDFrameHandler, this);
-#"/manta/led/slider", "sii", LEDSliderHandler, this);
-#"/manta/led/button", "si", LEDButtonHandler, this);
 
 def main():
     manta = Manta()
@@ -150,7 +811,7 @@ def main():
     while True:
         events = manta.process()
         for event in events:
-            print event
+            print(event)
         count -= 1
         if not count:
             manta.set_led_pad(OFF if led_on else RED, 10)
@@ -0,0 +1,158 @@
+'''
+Runs a sequencer for each of several Mantas in one process and one thread.
+Run directly with the number of Mantas and optionally the MIDI backend:
+
+    python mantahost.py 4 udp
+
+Each Manta's OSC ports are PORT_STRIDE above the last one's, starting at the
+usual 31416/31417.
+'''
+import glob
+import select
+import sys
+from clock import SystemClock
+from manta import Manta
+from mantaseq import MantaSeq
+from midibackends import open_backend
+from scheduler import Scheduler
+
+BASE_RECEIVE_PORT = 31416
+BASE_SEND_PORT = 31417
+PORT_STRIDE = 10
+
+class MantaSeqHost(object):
+    '''
+    Drives several MantaSeqs from a single loop. All their sockets are
+    watched by one poller and each instance's next deadline sits in one
+    timer heap, so an instance only costs anything when it has input or a
+    step or note-off is due. Changes made to an instance outside of
+    process(), like calling start() directly, should be followed by
+    refresh().
+    '''
+    def __init__(self, clock=None):
+        self._clock = clock if clock is not None else SystemClock()
+        self.instances = []
+        # holds each instance's next deadline, with a handle to cancel it
+        self._deadlines = Scheduler()
+        self._timers = {}
+        self._by_fd = {}
+        # poll() scales better with many sockets, but isn't everywhere
+        self._poller = select.poll() if hasattr(select, 'poll') else None
+
+    def add_instance(self, receive_port, send_port, midi_source=None,
+                     **kwargs):
+        '''
+        Creates a MantaSeq talking to the Manta on the given OSC ports and
+        returns it. Any other arguments are passed to MantaSeq.
+        '''
+        manta = Manta(receive_port=receive_port, send_port=send_port,
+                      timeout=0, buffer_leds=True, bundle_output=True)
+        seq = MantaSeq(clock=self._clock, midi_source=midi_source,
+                       manta=manta, **kwargs)
+        self.instances.append(seq)
+        fd = manta.fileno()
+        self._by_fd[fd] = seq
+        if self._poller is not None:
+            self._poller.register(fd, select.POLLIN)
+        self.refresh(seq)
+        return seq
+
+    def start(self):
+        for seq in self.instances:
+            seq.start()
+            self.refresh(seq)
+
+    def cleanup(self):
+        for seq in self.instances:
+            seq.cleanup()
+            seq._manta.osc_server.close()
+
+    def refresh(self, seq):
+        '''Updates the timer heap with seq's next deadline'''
+        deadline = seq.next_deadline()
+        timer = self._timers.get(seq)
+        if timer is not None:
+            if timer[0] == deadline:
+                return
+            self._deadlines.cancel(timer[1])
+        if deadline is None:
+            self._timers.pop(seq, None)
+        else:
+            self._timers[seq] = (deadline,
+                                 self._deadlines.schedule(deadline, seq))
+
+    def next_deadline(self):
+        return self._deadlines.next_timestamp()
+
+    def run(self):
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(0, deadline - self._clock.now())
+            self.process(timeout)
+
+    def process(self, timeout=0):
+        '''
+        Waits up to timeout seconds for input, then processes every instance
+        that has input or a deadline due
+        '''
+        ready = self._poll(timeout)
+        for deadline, seq in self._deadlines.pop_due(self._clock.now()):
+            # it's no longer in the heap
+            del self._timers[seq]
+            if seq not in ready:
+                ready.append(seq)
+        for seq in ready:
+            seq.process()
+            self.refresh(seq)
+
+    def _poll(self, timeout):
+        '''Returns the instances with input waiting'''
+        if self._poller is not None:
+            # poll() takes milliseconds, and rounds down
+            if timeout is not None:
+                timeout = int(timeout * 1000 + 0.999)
+            try:
+                fds = [fd for fd, event in self._poller.poll(timeout)]
+            except select.error:
+                return []
+        else:
+            try:
+                fds, _, _ = select.select(list(self._by_fd), [], [], timeout)
+            except select.error:
+                return []
+        return [self._by_fd[fd] for fd in fds]
+
+def _instance_backend(name, index):
+    '''Opens a separate MIDI port for the index'th instance'''
+    if name is None:
+        name = 'coremidi' if sys.platform == 'darwin' else 'alsa'
+    if name == 'coremidi':
+        return open_backend(name, name='MantaSeq %d' % (index + 1))
+    if name == 'alsa':
+        devices = sorted(glob.glob('/dev/snd/midiC*D*'))
+        if index >= len(devices):
+            raise IOError('Not enough ALSA raw MIDI devices')
+        return open_backend(name, device=devices[index])
+    if name == 'udp':
+        return open_backend(name, port=BASE_SEND_PORT + 1 +
+                            index * PORT_STRIDE)
+    return open_backend(name)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    backend = sys.argv[2] if len(sys.argv) > 2 else None
+    host = MantaSeqHost()
+    for i in range(count):
+        host.add_instance(BASE_RECEIVE_PORT + i * PORT_STRIDE,
+                          BASE_SEND_PORT + i * PORT_STRIDE,
+                          _instance_backend(backend, i))
+    try:
+        host.run()
+    except KeyboardInterrupt:
+        host.cleanup()
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,23 @@
-from simplecoremidi import MIDISource
+import argparse
+import errno
+import fcntl
+import os
+import select
+import threading
+from collections import deque
 from stepseq import Seq
+from scheduler import Scheduler
+from clock import SystemClock
+from midiout import ControllerCache, TimedMIDIOutput
+from midibackends import open_backend
+from sessionlog import SessionRecorder
+from journal import Journal, JournaledMIDISource, STATE_NAMES
+from metrics import (Metrics,
+                     MetricsServer,
+                     OSC_ADDRESS as METRICS_ADDRESS,
+                     timer as metrics_timer)
 from manta import (Manta,
+                   EventCoalescer,
                    PadVelocityEvent,
                    ButtonVelocityEvent,
                    PadValueEvent,
@@ -10,7 +27,6 @@ from manta import (Manta,
                    row_from_pad,
                    OFF, AMBER, RED,
                    PAD_AND_BUTTON)
-import time
 from mantaseqstates import *
 
 class MantaSeqPadLED(object):
@@ -53,22 +69,107 @@ class MantaSeqPadLED(object):
             self.manta.set_led_pad(new_led_state, self.pad_num)
             self.led_state = new_led_state
 
-class MantaSeq(object):
+class _Waker(object):
+    '''A pipe that one thread writes to to wake another out of wait()'''
     def __init__(self):
+        self._read, self._write = os.pipe()
+        # if nobody's been reading, the pipe is already full of wake-ups
+        flags = fcntl.fcntl(self._write, fcntl.F_GETFL)
+        fcntl.fcntl(self._write, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def wake(self):
+        try:
+            os.write(self._write, b'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout=None):
+        '''Blocks until woken or timeout seconds have passed'''
+        try:
+            readable, _, _ = select.select([self._read], [], [], timeout)
+        except select.error:
+            return
+        if readable:
+            os.read(self._read, 4096)
+
+    def close(self):
+        os.close(self._read)
+        os.close(self._write)
+
+class MantaSeq(object):
+    def __init__(self, clock=None, lookahead=0, coalesce=False,
+                 midi_source=None, manta=None):
         #TODO: get rid of current_step attribute in favor of querying seq
-        self._manta = Manta()
-        self._midi_source = MIDISource('MantaSeq')
+        self._clock = clock if clock is not None else SystemClock()
+        # we do our own waiting in run(), so process() shouldn't block. LED
+        # changes are buffered and flushed together at the end of process(),
+        # in as few datagrams as possible. A manta passed in should be set up
+        # the same way
+        if manta is None:
+            manta = Manta(timeout=0, buffer_leds=True, bundle_output=True)
+        self._manta = manta
+        # so events are stamped with the time they arrived on our clock
+        self._manta.clock = self._clock
+        self._midi_source = None
         self._seq = Seq()
         self._manta.set_led_enable(PAD_AND_BUTTON, True)
-        self.step_duration = 0.125
-        # the first step should get executed on the first process() call
-        self.next_step_timestamp = time.time()
+        self._manta.flush_output()
+        self._step_duration = 0.125
+        # step times are computed as an offset from an anchor time rather than
+        # accumulated, so rounding errors don't add up. The first step should
+        # get executed on the first process() call
+        self._anchor_timestamp = self._clock.now()
+        self._steps_since_anchor = 0
         self.current_step = 0
-        self.note_offs = {}
+        self.note_offs = Scheduler()
+        # number of sequenced voices currently sounding per note number. The
+        # note-off only goes out when the last overlapping voice ends. Notes
+        # held down live count as voices too, and are also kept in
+        # _live_notes until they're released
+        self._voice_counts = {}
+        self._live_notes = set()
         self.running = False
         self.start_stop_button = 0
         self.shift_button = 1
-        self._state = MantaSeqIdleState(self)
+        self.record_button = 2
+        # while recording, notes played live are written into the step
+        # nearest to when they were played
+        self.recording = False
+        # the arrival time of the pad event being handled
+        self._event_time = None
+        # steps that were recorded just before they came round, so they
+        # shouldn't sound again until the next time
+        self._recorded_ahead = set()
+        # the states are created once and switched between
+        self._idle_state = MantaSeqIdleState(self)
+        self._steps_selected_state = MantaSeqStepsSelectedState(self)
+        self._shifted_state = MantaSeqShiftedState(self)
+        self._tempo_adjust_state = MantaSeqTempoAdjustState(self)
+        self._state = self._idle_state
+        # with coalesce set, continuous pad and slider values are collapsed to
+        # the latest value per pad or slider within each process() call
+        self._coalescer = EventCoalescer() if coalesce else None
+        # the sequence the steps are played from. With the timing on its own
+        # thread, that's a snapshot of _seq republished after each batch of
+        # edits, otherwise it's _seq itself
+        self._playing_seq = self._seq
+        self._published_seq = self._seq
+        # only used while running with threads, see start_threads()
+        self._threads = None
+        self._threads_running = False
+        self._input_events = None
+        self._timing_commands = None
+        self._ui_commands = None
+        self._timing_waker = None
+        self._ui_waker = None
+        # maps each type of manta event to the method that handles it
+        self._event_handlers = {
+            PadVelocityEvent: self._process_pad_velocity_event,
+            ButtonVelocityEvent: self._process_button_velocity_event,
+            PadValueEvent: self._process_pad_value_event,
+            SliderValueEvent: self._process_slider_value_event,
+        }
         self.pad_leds = [MantaSeqPadLED(i, self._manta) for i in range(48)]
         self._global_cc1 = 0
         self._global_cc2 = 0
@@ -77,17 +178,190 @@ class MantaSeq(object):
         self._selected_note = None
         self._selected_cc1 = None
         self._selected_cc2 = None
+        # if set, called with the number of seconds each step or note-off
+        # fired after its deadline
+        self.lateness_callback = None
+        # if set, process() records where its time goes here (see metrics.py)
+        self.metrics = None
+        # if set, input, state changes, MIDI and LEDs are journaled here
+        self.journal = None
+        self._state_indices = dict(
+                (getattr(self, '_%s_state' % name), index)
+                for index, name in enumerate(STATE_NAMES))
+        self.lookahead = 0
+        self._timed_output = None
+        if midi_source is None:
+            midi_source = open_backend()
+        self.set_midi_source(midi_source)
+        self.set_lookahead(lookahead)
 
     def cleanup(self):
         self._manta.set_led_enable(PAD_AND_BUTTON, False)
+        self._manta.flush_output()
+        self.set_lookahead(0)
+        self._midi_source.close()
+
+    def set_midi_source(self, midi_source):
+        '''
+        Sends MIDI to midi_source, usually one of the backends in
+        midibackends. Anything with a send() method taking a MIDI message
+        tuple and a flush() method that writes them out will do. Control
+        changes go through a cache so repeated values aren't resent.
+        '''
+        self._midi_source = midi_source
+        self._midi_out = ControllerCache(self._journaled(midi_source),
+                                         self._clock)
+        if self._timed_output is not None:
+            self.set_lookahead(self.lookahead)
+
+    def _journaled(self, midi_source):
+        if self.journal is None:
+            return midi_source
+        return JournaledMIDISource(midi_source, self.journal)
+
+    def enable_metrics(self, metrics=None):
+        '''
+        Starts recording metrics, in a new Metrics unless one is given, and
+        answers OSC queries for them on /mantaseq/metrics with a JSON
+        snapshot. Returns the Metrics.
+        '''
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = self._manta.metrics = metrics
+        self._manta.add_handler(METRICS_ADDRESS, self._metrics_query)
+        return metrics
+
+    def disable_metrics(self):
+        self.metrics = self._manta.metrics = None
+
+    def _metrics_query(self, path, tags, args, source):
+        if self.metrics is not None:
+            self._manta.reply(source, METRICS_ADDRESS, self.metrics.to_json())
+
+    def set_journal(self, journal):
+        '''
+        Journals everything from now on to journal (see journal.py), or
+        stops journaling if it's None. The caller still has to close it.
+        '''
+        self.journal = self._manta.journal = journal
+        # only the end of the chain changes, so the CC cache and rate limits
+        # and anything queued for later are kept
+        self._midi_out.set_midi_source(self._journaled(self._midi_source))
+        if journal is not None:
+            journal.record_state(self._state_indices[self._state])
+
+    def set_cc_rate_limit(self, cc_num, max_rate):
+        '''Sends at most max_rate changes per second of the given CC'''
+        self._midi_out.set_rate_limit(cc_num, max_rate)
+
+    def set_lookahead(self, lookahead):
+        '''
+        In lookahead mode, steps and note-offs due within the next lookahead
+        seconds are computed ahead of time and handed to a timed output queue
+        with their exact timestamps, so loop hiccups don't cause jitter. This
+        delays the effect of pattern edits by up to lookahead. LED updates
+        aren't timestamped, so they happen up to lookahead early.
+        '''
+        if self._timed_output is not None:
+            self._timed_output.close()
+            self._timed_output = None
+        self.lookahead = lookahead
+        if lookahead > 0:
+            self._timed_output = TimedMIDIOutput(self._midi_out, self._clock)
+            self._timed_output.start()
 
     def start(self):
+        self._on_timing_thread(self._start)
+
+    def _start(self):
         self.running = True
-        self.next_step_timestamp = time.time()
+        self._recorded_ahead.clear()
+        self._anchor(self._clock.now())
 
     def stop(self):
+        self._on_timing_thread(self._stop)
+
+    def _stop(self):
         self.running = False
 
+    def _anchor(self, timestamp):
+        '''Makes timestamp the time of the next step'''
+        self._anchor_timestamp = timestamp
+        self._steps_since_anchor = 0
+
+    @property
+    def next_step_timestamp(self):
+        return (self._anchor_timestamp +
+                self._steps_since_anchor * self._step_duration)
+
+    @property
+    def step_duration(self):
+        return self._step_duration
+
+    @step_duration.setter
+    def step_duration(self, duration):
+        '''
+        Changes the tempo, keeping our position within the current step. e.g.
+        if we're a quarter of the way to the next step, the next step gets
+        scheduled three quarters of the new step duration from now.
+        '''
+        self._on_timing_thread(self._set_step_duration, duration)
+
+    def _set_step_duration(self, duration):
+        # in lookahead mode the last step may not have happened yet
+        reference = max(self._clock.now(),
+                        self.next_step_timestamp - self._step_duration)
+        remaining = (self.next_step_timestamp - reference) / self._step_duration
+        remaining = max(remaining, 0.0)
+        self._step_duration = duration
+        self._anchor(reference + remaining * duration)
+
+    def set_recording(self, recording):
+        '''
+        Turns live recording on or off, lighting the record button. Kernel
+        receive timestamps are only asked for while recording, as reading
+        them makes every datagram slower to receive
+        '''
+        self.recording = recording
+        self._manta.set_kernel_timestamps(recording)
+        self._on_ui_thread(self._manta.set_led_button,
+                           RED if recording else OFF, self.record_button)
+
+    def record_note(self, note_num, velocity):
+        '''
+        Writes a note played live into the step whose time is nearest to when
+        the pad event arrived
+        '''
+        timestamp = self._event_time
+        if timestamp is None:
+            timestamp = self._clock.now()
+        # the step clock belongs to the timing thread, so the step is worked
+        # out there, and the edit is made back here
+        self._on_timing_thread(self._place_recorded_note, note_num, velocity,
+                               timestamp)
+
+    def _place_recorded_note(self, note_num, velocity, timestamp):
+        if not self.running:
+            return
+        offset = int(round((timestamp - self.next_step_timestamp) /
+                           self._step_duration))
+        step_count = self._playing_seq.step_count
+        step_num = (self._playing_seq.current_step_index + offset) % step_count
+        if offset >= 0:
+            # it's already sounded live, so don't play it again this time
+            self._recorded_ahead.add(step_num)
+        self._on_ui_thread(self._write_recorded_note, step_num, note_num,
+                           velocity)
+
+    def _write_recorded_note(self, step_num, note_num, velocity):
+        step = self._seq.steps[step_num]
+        step.note = note_num
+        step.velocity = velocity
+        if self._ui_commands is not None:
+            # running with threads, where the timing thread plays a snapshot
+            self._published_seq = self._seq.snapshot()
+        self.set_pad_active(step_num, True)
+
     def _get_step_color(self, step_num):
         if step_num == self.current_step:
             return RED
@@ -96,17 +370,268 @@ class MantaSeq(object):
         else:
             return OFF
 
-    def _send_midi_cc(self, cc_num, value):
-        self._midi_source.send(make_cc(cc_num, value))
+    def _send_midi(self, message, timestamp=None):
+        '''
+        Sends a MIDI message now, or at timestamp if we're in lookahead mode
+        '''
+        if timestamp is not None and self._timed_output is not None:
+            self._timed_output.send_at(timestamp, message)
+        else:
+            self._midi_out.send(message)
+
+    def _send_midi_cc(self, cc_num, value, timestamp=None):
+        self._send_midi(make_cc(cc_num, value), timestamp)
 
-    def _send_midi_note(self, note_num, velocity):
-        # remove from note_offs dict if present
-        self.note_offs.pop(note_num, None)
-        midi_note = make_note(note_num, velocity)
-        self._midi_source.send(midi_note)
+    def _send_midi_note(self, note_num, velocity, timestamp=None):
+        self._send_midi(make_note(note_num, velocity), timestamp)
 
     def _schedule_note_off(self, note_num, timestamp):
-        self.note_offs[note_num] = timestamp
+        '''Registers a sounding voice for note_num that ends at timestamp'''
+        self._voice_counts[note_num] = self._voice_counts.get(note_num, 0) + 1
+        self.note_offs.schedule(timestamp, note_num)
+
+    def play_note(self, note_num, velocity):
+        '''
+        Plays a note live, with velocity 0 releasing it. A held note counts as
+        a voice, so a sequenced note-off for the same note doesn't cut it off
+        '''
+        self._on_timing_thread(self._play_note, note_num, velocity)
+
+    def _play_note(self, note_num, velocity):
+        if velocity > 0:
+            if note_num not in self._live_notes:
+                self._live_notes.add(note_num)
+                self._voice_counts[note_num] = \
+                        self._voice_counts.get(note_num, 0) + 1
+            self._send_midi_note(note_num, velocity)
+        elif not self._release_live_note(note_num):
+            # pressed while we weren't playing live notes
+            self._send_midi_note(note_num, 0)
+
+    def release_live_note(self, note_num):
+        '''
+        Ends the voice of a note held down live, if it is, whichever state
+        we've moved to since it was pressed
+        '''
+        self._on_timing_thread(self._release_live_note, note_num)
+
+    def _release_live_note(self, note_num):
+        if note_num not in self._live_notes:
+            return False
+        self._live_notes.discard(note_num)
+        self._release_voice(note_num)
+        return True
+
+    def _release_voice(self, note_num, timestamp=None):
+        count = self._voice_counts.get(note_num, 0) - 1
+        if count > 0:
+            self._voice_counts[note_num] = count
+            return
+        self._voice_counts.pop(note_num, None)
+        self._send_midi_note(note_num, 0, timestamp)
+        self._on_ui_thread(self.set_pad_intensity, pad_from_note(note_num), 0)
+
+    def next_deadline(self):
+        '''
+        Returns the timestamp of the next step or note-off, whichever comes
+        first, or None if there's nothing scheduled.
+        '''
+        deadline = self.note_offs.next_timestamp()
+        if self.running and (deadline is None or
+                             self.next_step_timestamp < deadline):
+            deadline = self.next_step_timestamp
+        if deadline is not None:
+            deadline -= self.lookahead
+        # rate-limited CCs that are being held back
+        pending_cc = self._midi_out.next_pending_timestamp()
+        if pending_cc is not None and (deadline is None or
+                                       pending_cc < deadline):
+            deadline = pending_cc
+        return deadline
+
+    def run(self):
+        '''
+        Processes events until interrupted. Between calls to process() we sleep
+        on the manta socket until either input arrives or the next deadline is
+        due, rather than polling.
+        '''
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(0, deadline - self._clock.now())
+            self._manta.wait(timeout)
+            self.process()
+
+    def run_threaded(self):
+        '''
+        Like run(), but with input and timing on their own threads (see
+        start_threads()), and the LEDs and state machine on this one
+        '''
+        self.start_threads()
+        try:
+            while True:
+                self.process_ui()
+        finally:
+            self.stop_threads()
+
+    def start_threads(self):
+        '''
+        Splits the work across three threads, so a slow LED burst or a
+        blocking send can't hold up a step. A receiver thread decodes manta
+        input and queues it, and a timing thread owns the step clock and
+        sends the sequenced MIDI. The calling thread is left to apply the
+        input and update the LEDs by calling process_ui() in a loop. The
+        timing thread plays a snapshot of the sequence that's replaced after
+        each batch of edits, so it never waits on the UI.
+        '''
+        self._begin_handoff()
+        self._threads_running = True
+        self._threads = [threading.Thread(target=self._receive_loop),
+                         threading.Thread(target=self._timing_loop)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop_threads(self):
+        self._threads_running = False
+        self._timing_waker.wake()
+        for thread in self._threads:
+            thread.join()
+        self._threads = None
+        self._end_handoff()
+
+    def _begin_handoff(self):
+        '''
+        Sets up the queues that the threads hand work to each other through.
+        deque's append() and popleft() are atomic, so they don't need locks.
+        '''
+        self._input_events = deque()
+        self._timing_commands = deque()
+        self._ui_commands = deque()
+        self._timing_waker = _Waker()
+        self._ui_waker = _Waker()
+        # the events are handed to another thread, so they can't be reused
+        self._manta.reuse_events = False
+        self._published_seq = self._seq.snapshot()
+
+    def _end_handoff(self):
+        timing_commands, self._timing_commands = self._timing_commands, None
+        ui_commands, self._ui_commands = self._ui_commands, None
+        for commands in (timing_commands, ui_commands):
+            while commands:
+                func, args = commands.popleft()
+                func(*args)
+        self._input_events = None
+        self._timing_waker.close()
+        self._ui_waker.close()
+        self._timing_waker = self._ui_waker = None
+        self._manta.reuse_events = True
+        self._seq.current_step_index = self._playing_seq.current_step_index
+        self._playing_seq = self._published_seq = self._seq
+
+    def _on_timing_thread(self, func, *args):
+        '''
+        Calls func, or when running with threads, has the timing thread call
+        it, as that thread owns the step clock
+        '''
+        if self._timing_commands is None:
+            func(*args)
+        else:
+            self._timing_commands.append((func, args))
+            self._timing_waker.wake()
+
+    def _on_ui_thread(self, func, *args):
+        '''
+        Calls func, or when running with threads, has the UI thread call it,
+        as that thread owns the LEDs
+        '''
+        if self._ui_commands is None:
+            func(*args)
+        else:
+            self._ui_commands.append((func, args))
+            self._ui_waker.wake()
+
+    def _receive_loop(self):
+        manta = self._manta
+        while self._threads_running:
+            # the timeout is so we notice when we're stopped
+            if not manta.wait(0.1):
+                continue
+            events = manta.process()
+            if events:
+                self._input_events.append(events)
+                self._ui_waker.wake()
+
+    def _timing_loop(self):
+        while self._threads_running:
+            deadline = self.next_deadline()
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(0, deadline - self._clock.now())
+            self._timing_waker.wait(timeout)
+            self.process_timing()
+
+    def process_timing(self):
+        '''
+        The timing thread's share of process(): carries out any start, stop
+        or tempo changes from the UI, then the steps and note-offs that are
+        due
+        '''
+        commands = self._timing_commands
+        while commands:
+            func, args = commands.popleft()
+            func(*args)
+        metrics = self.metrics
+        if metrics is not None:
+            self._tick_measured(self._clock.now(), metrics)
+        else:
+            self._tick(self._clock.now())
+
+    def process_ui(self, timeout=None):
+        '''
+        The UI thread's share of process(): waits up to timeout for input or
+        step changes to show, then applies them and sends the LED updates
+        '''
+        self._ui_waker.wait(timeout)
+        commands = self._ui_commands
+        while commands:
+            func, args = commands.popleft()
+            func(*args)
+        input_events = self._input_events
+        metrics = self.metrics
+        edited = False
+        while input_events:
+            if metrics is not None:
+                self._apply_events_measured(input_events.popleft(), metrics)
+            else:
+                self._apply_events(input_events.popleft())
+            edited = True
+        if edited:
+            self._published_seq = self._seq.snapshot()
+        if metrics is not None:
+            started = metrics_timer()
+            self._midi_out.flush()
+            metrics.record_phase('midi_flush', metrics_timer() - started)
+            self._flush_leds_measured(metrics)
+            return
+        # notes played live and global CC changes
+        self._midi_out.flush()
+        self._manta.flush_leds()
+        self._manta.flush_output()
+
+    def _report_lateness(self, deadline, now):
+        # in lookahead mode deadlines are processed early, and this is negative
+        if self.lateness_callback is not None:
+            self.lateness_callback(now - deadline)
+        if self.metrics is not None:
+            self.metrics.record_lateness(now - deadline)
+
+    def _move_step_highlight(self, last_step, current_step):
+        self.set_pad_highlight(last_step, False)
+        self.set_pad_highlight(current_step, True)
 
     def set_pad_highlight(self, pad_num, highlight):
         self.pad_leds[pad_num].highlight(highlight)
@@ -118,48 +643,134 @@ class MantaSeq(object):
         self.pad_leds[pad_num].intensity(intensity)
 
     def process(self):
-        now = time.time()
-        events = self._manta.process()
+        if self.metrics is not None:
+            self._process_measured(self.metrics)
+            return
+        now = self._clock.now()
+        self._apply_events(self._manta.process())
+        self._tick(now)
+        self._manta.flush_leds()
+        self._manta.flush_output()
+
+    def _process_measured(self, metrics):
+        '''process(), timing each phase. The manta times its own decoding'''
+        now = self._clock.now()
+        self._apply_events_measured(self._manta.process(), metrics)
+        self._tick_measured(now, metrics)
+        self._flush_leds_measured(metrics)
+
+    def _apply_events_measured(self, events, metrics):
+        metrics.count_events(events)
+        started = metrics_timer()
+        self._apply_events(events)
+        metrics.record_phase('dispatch', metrics_timer() - started)
+
+    def _tick_measured(self, now, metrics):
+        '''_tick(), timing each phase'''
+        started = metrics_timer()
+        horizon = now + self.lookahead
+        self._send_note_offs(now, horizon)
+        sent_note_offs = metrics_timer()
+        metrics.record_phase('note_offs', sent_note_offs - started)
+        self._send_steps(now, horizon)
+        stepped = metrics_timer()
+        metrics.record_phase('steps', stepped - sent_note_offs)
+        metrics.record_depth('note_offs', len(self.note_offs))
+        self._flush_midi(now)
+        metrics.record_phase('midi_flush', metrics_timer() - stepped)
+
+    def _flush_leds_measured(self, metrics):
+        started = metrics_timer()
+        self._manta.flush_leds()
+        self._manta.flush_output()
+        metrics.record_phase('led_flush', metrics_timer() - started)
+
+    def _apply_events(self, events):
+        if self._coalescer is not None:
+            events = self._coalescer.coalesce(events)
+        if self.journal is not None:
+            self._dispatch_journaled(events, self.journal)
+        else:
+            self._dispatch(events)
+
+    def _tick(self, now):
+        '''Sends the steps and note-offs that are due'''
+        # everything due before horizon gets processed now. Without lookahead
+        # that's just everything that's already due
+        horizon = now + self.lookahead
+        self._send_note_offs(now, horizon)
+        self._send_steps(now, horizon)
+        self._flush_midi(now)
+
+    def _send_note_offs(self, now, horizon):
+        for timestamp, note_num in self.note_offs.pop_due(horizon):
+            self._report_lateness(timestamp, now)
+            self._release_voice(note_num, timestamp)
+
+    def _send_steps(self, now, horizon):
+        while self.running and horizon >= self.next_step_timestamp:
+            self._step(now)
+
+    def _flush_midi(self, now):
+        self._midi_out.flush_pending(now)
+        # everything this tick sent goes out in one write
+        self._midi_out.flush()
+
+    def _dispatch(self, events):
+        handlers = self._event_handlers
+        for event in events:
+            handler = handlers.get(type(event))
+            if handler is not None:
+                handler(event)
+
+    def _dispatch_journaled(self, events, journal):
+        '''_dispatch(), journaling each event and any state change it causes'''
+        handlers = self._event_handlers
+        state = self._state
         for event in events:
-            if isinstance(event, PadVelocityEvent):
-                self._process_pad_velocity_event(event)
-            if isinstance(event, ButtonVelocityEvent):
-                self._process_button_velocity_event(event)
-            elif isinstance(event, PadValueEvent):
-                self._process_pad_value_event(event)
-            elif isinstance(event, SliderValueEvent):
-                self._process_slider_value_event(event)
-
-        # send any pending note_offs
-        for note_num, timestamp in self.note_offs.items():
-            if now >= timestamp:
-                # send_midi_note will take care of removing the note
-                # from the list
-                self._send_midi_note(note_num, 0)
-                self.set_pad_intensity(pad_from_note(note_num), 0)
-
-        # if it's time for another step, do it
-        if self.running and now >= self.next_step_timestamp:
-            last_step = self.current_step
-            self.current_step = self._seq.current_step_index
-            step_obj = self._seq.step()
-            if step_obj.velocity > 0:
-                self._send_midi_note(step_obj.note, step_obj.velocity)
-                note_off_timestamp = self.next_step_timestamp + (step_obj.duration *
-                            self.step_duration)
-                self._schedule_note_off(step_obj.note, note_off_timestamp)
-                self.set_pad_intensity(pad_from_note(step_obj.note),
-                        step_obj.velocity)
-            self._send_midi_cc(1, self._combine_cc(self._global_cc1, step_obj.cc1))
-            self._send_midi_cc(2, self._combine_cc(self._global_cc2, step_obj.cc2))
-
-            # update the step LEDs (previous and current)
-            self.set_pad_highlight(last_step, False)
-            self.set_pad_highlight(self.current_step, True)
-
-            # remember which step we turned on so we can turn it off next time
-            # around
-            self.next_step_timestamp += self.step_duration
+            journal.record_event(event)
+            handler = handlers.get(type(event))
+            if handler is not None:
+                handler(event)
+                if self._state is not state:
+                    state = self._state
+                    journal.record_state(self._state_indices[state])
+
+    def _step(self, now):
+        step_timestamp = self.next_step_timestamp
+        self._report_lateness(step_timestamp, now)
+        last_step = self.current_step
+        seq = self._playing_seq
+        published = self._published_seq
+        if published is not seq:
+            # pick up the latest edits, carrying on from the same position
+            published.current_step_index = seq.current_step_index
+            self._playing_seq = seq = published
+        self.current_step = seq.current_step_index
+        step_obj = seq.step()
+        recorded_ahead = (self._recorded_ahead and
+                          self.current_step in self._recorded_ahead)
+        if recorded_ahead:
+            self._recorded_ahead.discard(self.current_step)
+        if step_obj.velocity > 0 and not recorded_ahead:
+            self._send_midi_note(step_obj.note, step_obj.velocity,
+                                 step_timestamp)
+            note_off_timestamp = step_timestamp + (step_obj.duration *
+                        self.step_duration)
+            self._schedule_note_off(step_obj.note, note_off_timestamp)
+            self._on_ui_thread(self.set_pad_intensity,
+                               pad_from_note(step_obj.note), step_obj.velocity)
+        self._send_midi_cc(1, self._combine_cc(self._global_cc1, step_obj.cc1),
+                           step_timestamp)
+        self._send_midi_cc(2, self._combine_cc(self._global_cc2, step_obj.cc2),
+                           step_timestamp)
+
+        # update the step LEDs (previous and current)
+        self._on_ui_thread(self._move_step_highlight, last_step,
+                           self.current_step)
+
+        self._steps_since_anchor += 1
+
     def _combine_cc(self, glob, step):
         '''
         combines the global cc (glob) with the per-step cc (step)
@@ -168,6 +779,7 @@ class MantaSeq(object):
 
     # most of the events get deferred to the state, as they're state-dependent
     def _process_pad_velocity_event(self, event):
+        self._event_time = event.timestamp
         if row_from_pad(event.pad_num) < 2:
             if event.velocity > 0:
                 self._state.process_step_press(event.pad_num)
@@ -186,6 +798,9 @@ class MantaSeq(object):
                 self._state.process_shift_press()
             else:
                 self._state.process_shift_release()
+        elif event.button_num == self.record_button:
+            if event.velocity > 0:
+                self.set_recording(not self.recording)
 
     def _process_pad_value_event(self, event):
         # pad value messages are ignored for step selection pads
@@ -205,13 +820,43 @@ def make_cc(cc_num, value, channel = 0):
     return (0xB0 | channel, cc_num, value)
 
 def main():
-    seq = MantaSeq()
+    parser = argparse.ArgumentParser(description='Step sequencer for the Manta')
+    parser.add_argument('backend', nargs='?',
+                        help='MIDI backend: coremidi, alsa or udp')
+    parser.add_argument('--threaded', action='store_true',
+                        help='run input and timing on their own threads')
+    parser.add_argument('--record', metavar='LOG',
+                        help='record the incoming OSC to a session log')
+    parser.add_argument('--journal', metavar='PATH',
+                        help='journal everything to PATH (see journal.py)')
+    parser.add_argument('--metrics', metavar='SOCKET',
+                        help='record metrics, served on this Unix socket')
+    args = parser.parse_args()
+    seq = MantaSeq(midi_source=open_backend(args.backend))
+    recorder = None
+    if args.record:
+        recorder = SessionRecorder(args.record, seq._clock)
+        seq._manta.recorder = recorder
+    journal = None
+    if args.journal:
+        journal = Journal(args.journal)
+        seq.set_journal(journal)
+    metrics_server = None
+    if args.metrics:
+        metrics_server = MetricsServer(seq.enable_metrics(), args.metrics)
     try:
-        while True:
-            seq.process()
-            time.sleep(0.0001)
+        if args.threaded:
+            seq.run_threaded()
+        else:
+            seq.run()
     except KeyboardInterrupt:
         seq.cleanup()
+        if recorder is not None:
+            recorder.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if journal is not None:
+            journal.close()
 
 if __name__ == '__main__':
     main()
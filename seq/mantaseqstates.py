@@ -19,7 +19,10 @@ class MantaSeqState(object):
         pass
 
     def process_note_velocity(self, note_pad, velocity):
-        pass
+        # only the idle state plays notes, but one pressed there can be
+        # released in any state
+        if velocity == 0:
+            self.manta_seq.release_live_note(note_from_pad(note_pad))
 
     def process_slider_value(self, slider_num, value):
         pass
@@ -44,16 +47,19 @@ class MantaSeqState(object):
         If the mantaseq has any notes or sliders already selected,
         assign them to the notes.
         '''
+        values = {}
         selected_note = self.manta_seq._selected_note
         if selected_note is not None:
-            self.manta_seq._seq.set_note(selected_note[0])
-            self.manta_seq._seq.set_velocity(selected_note[1])
+            values['note'] = selected_note[0]
+            values['velocity'] = selected_note[1]
         selected_cc1 = self.manta_seq._selected_cc1
         if selected_cc1 is not None:
-            self.manta_seq._seq.set_cc1(selected_cc1)
+            values['cc1'] = selected_cc1
         selected_cc2 = self.manta_seq._selected_cc2
         if selected_cc2 is not None:
-            self.manta_seq._seq.set_cc2(selected_cc2)
+            values['cc2'] = selected_cc2
+        if values:
+            self.manta_seq._seq.set_fields(**values)
 
 class MantaSeqIdleState(MantaSeqState):
     def process_step_press(self, step_num):
@@ -63,14 +69,16 @@ class MantaSeqIdleState(MantaSeqState):
         if self.manta_seq._selected_note is not None:
             self.manta_seq.set_pad_active(step_num, True)
 
-        self.manta_seq._state = MantaSeqStepsSelectedState(self.manta_seq)
+        self.manta_seq._state = self.manta_seq._steps_selected_state
 
     def process_shift_press(self):
-        self.manta_seq._state = MantaSeqShiftedState(self.manta_seq)
+        self.manta_seq._state = self.manta_seq._shifted_state
 
     def process_note_velocity(self, pad_num, velocity):
         note_num = note_from_pad(pad_num)
-        self.manta_seq._send_midi_note(note_num, velocity)
+        self.manta_seq.play_note(note_num, velocity)
+        if velocity > 0 and self.manta_seq.recording:
+            self.manta_seq.record_note(note_num, velocity)
 
     def process_note_value(self, pad_num, value):
         note_num = note_from_pad(pad_num)
@@ -106,18 +114,17 @@ class MantaSeqStepsSelectedState(MantaSeqState):
     def process_step_release(self, step_num):
         self.manta_seq._seq.deselect_step(step_num)
         self.set_note_intensity_from_step_num(step_num, False)
-        if len(self.manta_seq._seq.selected_steps) == 0:
-            self.manta_seq._state = MantaSeqIdleState(self.manta_seq)
+        if not self.manta_seq._seq.selection:
+            self.manta_seq._state = self.manta_seq._idle_state
         # TODO: make sure all pads have intensity of 0, otherwise they
         # could get stuck on, as the intensity doesn't get updated unless
         # there are steps selected
 
     def process_note_value(self, pad_num, value):
         note_num = note_from_pad(pad_num)
-        self.manta_seq._seq.set_note(note_num)
-        self.manta_seq._seq.set_velocity(value)
-        # note - this isn't very efficient. if necessary we should
-        # use the set_row_led API call
+        self.manta_seq._seq.set_fields(note=note_num, velocity=value)
+        # only the pads that actually change get sent, and the manta batches
+        # them into row or frame messages at the end of the tick
         for i in range(48):
             if i != pad_num:
                 self.manta_seq.set_pad_intensity(i, 0)
@@ -128,10 +135,9 @@ class MantaSeqStepsSelectedState(MantaSeqState):
             self.manta_seq._selected_note = None
 
         # then update the pad colors of any selected pads
-        for i, step in enumerate(self.manta_seq._seq.steps):
-            if step in self.manta_seq._seq.selected_steps:
-                active = (value > 0)
-                self.manta_seq.set_pad_active(i, active)
+        active = (value > 0)
+        for i in self.manta_seq._seq.selected_indices():
+            self.manta_seq.set_pad_active(i, active)
 
     def process_slider_value(self, slider_num, value):
         if slider_num == 0:
@@ -141,32 +147,34 @@ class MantaSeqStepsSelectedState(MantaSeqState):
 
 class MantaSeqShiftedState(MantaSeqState):
     def process_shift_release(self):
-        self.manta_seq._state = MantaSeqIdleState(self.manta_seq)
+        self.manta_seq._state = self.manta_seq._idle_state
 
     def process_slider_value(self, slider_num, value):
         if slider_num == 0:
-            self.manta_seq._state = MantaSeqTempoAdjustState(
-                    self.manta_seq, value,
-                    self.manta_seq.step_duration)
+            tempo_adjust_state = self.manta_seq._tempo_adjust_state
+            tempo_adjust_state.begin(value, self.manta_seq.step_duration)
+            self.manta_seq._state = tempo_adjust_state
 
     def process_step_press(self, step_num):
         '''Shifted step select erases that note'''
         self.manta_seq.set_pad_active(step_num, False)
         self.manta_seq._seq.select_step(step_num)
-        self.manta_seq._seq.set_velocity(0)
-        self.manta_seq._seq.set_cc1(0)
-        self.manta_seq._seq.set_cc2(0)
+        self.manta_seq._seq.set_fields(velocity=0, cc1=0, cc2=0)
         self.manta_seq._seq.deselect_step(step_num)
 
 class MantaSeqTempoAdjustState(MantaSeqState):
-    def __init__(self, manta_seq, slide_begin, initial_duration):
-        'Takes the initial value of the slider so we can reference against it'
+    def __init__(self, manta_seq):
         super(MantaSeqTempoAdjustState, self).__init__(manta_seq)
+        self.slide_begin = None
+        self.initial_duration = None
+
+    def begin(self, slide_begin, initial_duration):
+        'Takes the initial value of the slider so we can reference against it'
         self.slide_begin = slide_begin
         self.initial_duration = initial_duration
 
     def process_shift_release(self):
-        self.manta_seq._state = MantaSeqIdleState(self.manta_seq)
+        self.manta_seq._state = self.manta_seq._idle_state
 
     def process_slider_value(self, slider_num, value):
         if slider_num == 0:
@@ -176,4 +184,4 @@ class MantaSeqTempoAdjustState(MantaSeqState):
             self.manta_seq.step_duration = self.initial_duration * 2 ** exponent
 
     def process_slider_release(self, slider_num):
-        self.manta_seq._state = MantaSeqShiftedState(self.manta_seq)
+        self.manta_seq._state = self.manta_seq._shifted_state
@@ -0,0 +1,237 @@
+'''
+Instrumentation for finding out where the time goes in the sequencer loop.
+Assign a Metrics to MantaSeq.metrics (see MantaSeq.enable_metrics()) and
+process() times each of its phases, counts the events by type, and records
+queue depths and step lateness. Everything is kept in fixed-size histograms
+and ring buffers, so recording never allocates. With metrics unset the
+instrumented code is skipped entirely.
+
+A snapshot of the metrics can be fetched as JSON by sending an OSC message
+to /mantaseq/metrics on the Manta's receive port, or by connecting to the
+Unix socket of a MetricsServer.
+'''
+import json
+import math
+import os
+import socket
+import threading
+from array import array
+from clock import monotonic
+
+# the OSC address queries for a snapshot are sent to, and replies come from
+OSC_ADDRESS = '/mantaseq/metrics'
+# used to time the phases, independent of the sequencer's clock
+timer = monotonic
+
+PHASES = ('decode', 'dispatch', 'note_offs', 'steps', 'midi_flush',
+          'led_flush')
+
+class Histogram(object):
+    '''
+    A log-linear histogram in the style of HDR histograms: each power of two
+    above min_value is split into sub_buckets linear buckets, so every value
+    is stored to within 1/sub_buckets of itself whatever its size. Values at
+    or below min_value (including negative ones) go in the first bucket.
+    '''
+    def __init__(self, min_value=1e-6, max_value=60.0, sub_buckets=16):
+        self.min_value = min_value
+        self.sub_buckets = sub_buckets
+        self._bucket_count = (int(math.log(max_value / min_value, 2)) + 2) * \
+                sub_buckets
+        self._counts = array('l', [0] * self._bucket_count)
+        self.reset()
+
+    def reset(self):
+        for i in range(self._bucket_count):
+            self._counts[i] = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _index(self, value):
+        if value <= self.min_value:
+            return 0
+        mantissa, exponent = math.frexp(value / self.min_value)
+        index = exponent * self.sub_buckets + int(
+                (mantissa * 2 - 1) * self.sub_buckets)
+        return min(index, self._bucket_count - 1)
+
+    def _bucket_value(self, index):
+        '''Returns the upper bound of values in the bucket'''
+        if index == 0:
+            return self.min_value
+        exponent, sub_bucket = divmod(index, self.sub_buckets)
+        return math.ldexp(0.5 * (1 + (sub_bucket + 1.0) / self.sub_buckets),
+                          exponent) * self.min_value
+
+    def record(self, value):
+        self._counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max or self.count == 1:
+            self.max = value
+
+    def percentile(self, fraction):
+        '''
+        Returns the value that fraction of the recorded values are at or below,
+        rounded up to its bucket's upper bound
+        '''
+        if not self.count:
+            return 0.0
+        target = max(1, int(math.ceil(fraction * self.count)))
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= target:
+                if index == self._bucket_count - 1:
+                    # the last bucket has no upper bound
+                    return self.max
+                return min(self._bucket_value(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+class RingBuffer(object):
+    '''Keeps the last size values recorded'''
+    def __init__(self, size):
+        self._values = array('d', [0.0] * size)
+        self.clear()
+
+    def clear(self):
+        self._next = 0
+        self.count = 0
+
+    def append(self, value):
+        self._values[self._next] = value
+        self._next = (self._next + 1) % len(self._values)
+        self.count += 1
+
+    def values(self):
+        '''Returns the values kept, oldest first'''
+        if self.count < len(self._values):
+            return list(self._values[:self._next])
+        return list(self._values[self._next:]) + list(self._values[:self._next])
+
+class Metrics(object):
+    '''
+    The numbers recorded by an instrumented MantaSeq and its Manta. When the
+    sequencer runs on several threads they all record here, so recording
+    and snapshots take a lock.
+    '''
+    def __init__(self, recent=256):
+        self._lock = threading.Lock()
+        # seconds spent in each phase of process()
+        self.phases = dict((phase, Histogram()) for phase in PHASES)
+        self.event_counts = {}
+        # datagrams read per process() call, and note-offs waiting
+        self.queue_depths = {'input': Histogram(min_value=1),
+                             'note_offs': Histogram(min_value=1)}
+        # seconds each step and note-off went out after its deadline
+        self.lateness = Histogram()
+        self.recent_lateness = RingBuffer(recent)
+
+    def reset(self):
+        with self._lock:
+            for histogram in self.phases.values():
+                histogram.reset()
+            for histogram in self.queue_depths.values():
+                histogram.reset()
+            self.event_counts.clear()
+            self.lateness.reset()
+            self.recent_lateness.clear()
+
+    def record_phase(self, phase, seconds):
+        with self._lock:
+            self.phases[phase].record(seconds)
+
+    def record_depth(self, queue, depth):
+        with self._lock:
+            self.queue_depths[queue].record(depth)
+
+    def record_lateness(self, seconds):
+        with self._lock:
+            self.lateness.record(seconds)
+            self.recent_lateness.append(seconds)
+
+    def count_events(self, events):
+        counts = self.event_counts
+        with self._lock:
+            for event in events:
+                name = type(event).__name__
+                counts[name] = counts.get(name, 0) + 1
+
+    def snapshot(self):
+        '''Returns everything recorded so far, in a form that can be JSON'd'''
+        with self._lock:
+            return {
+                'phases': dict((phase, histogram.summary())
+                               for phase, histogram in self.phases.items()),
+                'events': dict(self.event_counts),
+                'queue_depths': dict((queue, histogram.summary())
+                                     for queue, histogram in
+                                     self.queue_depths.items()),
+                'lateness': self.lateness.summary(),
+                'recent_lateness': self.recent_lateness.values(),
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+class MetricsServer(object):
+    '''
+    Serves metrics on a Unix socket at path. Each connection is sent a JSON
+    snapshot and then closed, e.g. with
+
+        nc -U /tmp/mantaseq.sock
+
+    Connections are handled on a thread of their own, so the sequencer loop
+    doesn't need to poll it.
+    '''
+    def __init__(self, metrics, path):
+        self.metrics = metrics
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        self._socket.listen(4)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while self._running:
+            try:
+                connection, _ = self._socket.accept()
+            except socket.error:
+                return
+            try:
+                connection.sendall(self.metrics.to_json().encode('ascii') +
+                                   b'\n')
+            except socket.error:
+                pass
+            finally:
+                connection.close()
+
+    def close(self):
+        self._running = False
+        # accept() doesn't return when the socket is closed under it, so wake
+        # it with a connection of our own
+        try:
+            waker = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            waker.connect(self.path)
+            waker.close()
+        except socket.error:
+            pass
+        self._thread.join()
+        self._socket.close()
+        os.unlink(self.path)
@@ -0,0 +1,144 @@
+'''
+MIDI outputs for MantaSeq. They all take messages as tuples of ints through
+send() and write them out when flush() is called, so everything the
+sequencer sends in one tick goes out in a single write.
+'''
+import glob
+import os
+import socket
+import struct
+import sys
+import threading
+from manta import osc_prefix
+
+class MIDIBackend(object):
+    '''
+    Base class for the backends. send() and flush() can be called from more
+    than one thread. Subclasses implement _write(), which gets the list of
+    messages sent since the last flush.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._batch = []
+        # number of _write() calls, i.e. batches actually written
+        self.writes = 0
+
+    def send(self, message):
+        with self._lock:
+            self._batch.append(message)
+
+    def flush(self):
+        with self._lock:
+            if not self._batch:
+                return
+            batch = self._batch
+            self._batch = []
+            self._write(batch)
+            self.writes += 1
+
+    def close(self):
+        self.flush()
+
+    def _write(self, messages):
+        raise NotImplementedError()
+
+def _midi_bytes(messages):
+    '''Concatenates the messages into one byte string'''
+    return bytes(bytearray(byte for message in messages for byte in message))
+
+class CoreMIDIBackend(MIDIBackend):
+    '''A virtual CoreMIDI source that other apps can connect to (OS X only)'''
+    def __init__(self, name='MantaSeq'):
+        MIDIBackend.__init__(self)
+        # imported here so the other backends work without simplecoremidi
+        from simplecoremidi import MIDISource
+        self._source = MIDISource(name)
+
+    def _write(self, messages):
+        # each batch goes out as a single packet
+        self._source.send(tuple(byte for message in messages
+                                for byte in message))
+
+class ALSARawMIDIBackend(MIDIBackend):
+    '''
+    Writes to an ALSA raw MIDI device, e.g. /dev/snd/midiC1D0. With no
+    device given, the first one found is used.
+    '''
+    def __init__(self, device=None):
+        MIDIBackend.__init__(self)
+        if device is None:
+            devices = sorted(glob.glob('/dev/snd/midiC*D*'))
+            if not devices:
+                raise IOError('No ALSA raw MIDI devices found')
+            device = devices[0]
+        self.device = device
+        self._fd = os.open(device, os.O_WRONLY)
+
+    def _write(self, messages):
+        os.write(self._fd, _midi_bytes(messages))
+
+    def close(self):
+        MIDIBackend.close(self)
+        os.close(self._fd)
+
+class UDPBackend(MIDIBackend):
+    '''
+    Sends each batch as an OSC message to address with the raw MIDI bytes in
+    a single blob argument, for machines without a MIDI interface
+    '''
+    def __init__(self, port=31418, host='127.0.0.1', address='/midi'):
+        MIDIBackend.__init__(self)
+        self._destination = (host, port)
+        self._prefix = osc_prefix(address, 'b')
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _write(self, messages):
+        data = _midi_bytes(messages)
+        blob_size = len(data)
+        data += b'\0' * (-blob_size % 4)
+        self._socket.sendto(self._prefix + struct.pack('>i', blob_size) + data,
+                            self._destination)
+
+    def close(self):
+        MIDIBackend.close(self)
+        self._socket.close()
+
+class CaptureBackend(MIDIBackend):
+    '''
+    Keeps everything sent in memory, for tests and benchmarks. sent is a list
+    of (timestamp, message) tuples and batches a list of (timestamp,
+    messages) tuples, both stamped with clock's time when they were flushed.
+    '''
+    def __init__(self, clock):
+        MIDIBackend.__init__(self)
+        self._clock = clock
+        self.sent = []
+        self.batches = []
+
+    def _write(self, messages):
+        timestamp = self._clock.now()
+        self.batches.append((timestamp, messages))
+        self.sent.extend((timestamp, message) for message in messages)
+
+    def messages(self):
+        '''Returns the messages sent so far, without timestamps'''
+        return [message for timestamp, message in self.sent]
+
+BACKENDS = {
+    'coremidi': CoreMIDIBackend,
+    'alsa': ALSARawMIDIBackend,
+    'udp': UDPBackend,
+}
+
+def open_backend(name=None, **options):
+    '''
+    Opens the named backend, passing it any options given. With no name,
+    that's CoreMIDI on OS X and ALSA everywhere else.
+    '''
+    if name is None:
+        name = 'coremidi' if sys.platform == 'darwin' else 'alsa'
+    try:
+        backend_class = BACKENDS[name]
+    except KeyError:
+        raise ValueError('Unknown MIDI backend: %s' % name)
+    return backend_class(**options)
@@ -0,0 +1,201 @@
+import os
+import select
+import threading
+from scheduler import Scheduler
+
+CONTROL_CHANGE = 0xB0
+
+class ControllerCache(object):
+    '''
+    Passes MIDI messages through to midi_source, dropping control changes
+    that would set a controller to the value it already has. Controllers can
+    also be rate limited: changes that come too quickly are held back and only
+    the latest one is sent once the interval has passed (see flush_pending()),
+    so the synth always ends up at the same value. Messages can come from
+    more than one thread.
+    '''
+    def __init__(self, midi_source, clock):
+        self._midi_source = midi_source
+        self._clock = clock
+        self._lock = threading.Lock()
+        # all keyed on (channel, controller number)
+        self._values = {}
+        self._min_intervals = {}
+        self._last_sent = {}
+        self._pending = {}
+        self.suppressed_count = 0
+
+    def set_midi_source(self, midi_source):
+        '''
+        Sends to midi_source from now on, keeping the cached values and rate
+        limits, so it should lead to the same synth
+        '''
+        with self._lock:
+            self._midi_source = midi_source
+
+    def set_rate_limit(self, cc_num, max_rate, channel=0):
+        '''
+        Limits the controller to max_rate messages per second. None removes
+        the limit.
+        '''
+        key = (channel, cc_num)
+        with self._lock:
+            if max_rate is None:
+                self._min_intervals.pop(key, None)
+                message = self._pending.pop(key, None)
+                if message is not None:
+                    self._values[key] = message[2]
+                    self._midi_source.send(message)
+            else:
+                self._min_intervals[key] = 1.0 / max_rate
+
+    def flush(self):
+        self._midi_source.flush()
+
+    def reset(self):
+        '''Forgets the cached values, so the next change to each is sent'''
+        with self._lock:
+            self._values.clear()
+
+    def send(self, message):
+        if message[0] & 0xF0 != CONTROL_CHANGE:
+            self._midi_source.send(message)
+            return
+        key = (message[0] & 0x0F, message[1])
+        value = message[2]
+        with self._lock:
+            if key in self._pending:
+                # this replaces a change we were holding back
+                self.suppressed_count += 1
+                if self._values.get(key) == value:
+                    del self._pending[key]
+                else:
+                    self._pending[key] = message
+                return
+            if self._values.get(key) == value:
+                self.suppressed_count += 1
+                return
+            interval = self._min_intervals.get(key)
+            if interval is not None:
+                now = self._clock.now()
+                last_sent = self._last_sent.get(key)
+                if last_sent is not None and now < last_sent + interval:
+                    self._pending[key] = message
+                    return
+                self._last_sent[key] = now
+            self._values[key] = value
+            self._midi_source.send(message)
+
+    def next_pending_timestamp(self):
+        '''
+        Returns when the next held-back change can be sent, or None if there
+        aren't any
+        '''
+        with self._lock:
+            if not self._pending:
+                return None
+            return min(self._last_sent[key] + self._min_intervals[key]
+                       for key in self._pending)
+
+    def flush_pending(self, now):
+        '''Sends the held-back changes whose rate limit interval has passed'''
+        with self._lock:
+            if not self._pending:
+                return
+            for key, message in list(self._pending.items()):
+                # compare the same way next_pending_timestamp() computes it,
+                # so waking at that time is enough to send
+                if now >= self._last_sent[key] + self._min_intervals[key]:
+                    del self._pending[key]
+                    self._last_sent[key] = now
+                    self._values[key] = message[2]
+                    self._midi_source.send(message)
+
+class TimedMIDIOutput(object):
+    '''
+    Sends MIDI messages at future timestamps from a background thread, so when
+    they go out doesn't depend on when the main loop gets around to it.
+    Timestamps are in the time base of the given clock.
+    '''
+    def __init__(self, midi_source, clock):
+        self._midi_source = midi_source
+        self._clock = clock
+        self._queue = Scheduler()
+        self._lock = threading.Lock()
+        # writing to this pipe wakes the output thread when a message is
+        # queued ahead of everything it's currently waiting on
+        self._wake_read, self._wake_write = os.pipe()
+        self._thread = None
+        self._running = False
+        # if set, called from the output thread with the number of seconds
+        # each message went out after its timestamp
+        self.lateness_callback = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        '''
+        Stops the output thread and sends whatever is still queued straight
+        away, as dropping queued note-offs would leave notes stuck on
+        '''
+        if self._thread is not None:
+            self._running = False
+            self._wake()
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            remaining = self._queue.pop_due(float('inf'))
+        if remaining:
+            for timestamp, message in remaining:
+                self._midi_source.send(message)
+            self._midi_source.flush()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def send_at(self, timestamp, message):
+        with self._lock:
+            next_timestamp = self._queue.next_timestamp()
+            self._queue.schedule(timestamp, message)
+        if next_timestamp is None or timestamp < next_timestamp:
+            self._wake()
+
+    def flush_due(self, now):
+        '''
+        Sends every message due at or before now. The output thread calls
+        this, but it can also be called directly when there's no thread.
+        '''
+        with self._lock:
+            due = self._queue.pop_due(now)
+        if not due:
+            return
+        for timestamp, message in due:
+            self._midi_source.send(message)
+        self._midi_source.flush()
+        if self.lateness_callback is not None:
+            now = self._clock.now()
+            for timestamp, message in due:
+                self.lateness_callback(now - timestamp)
+
+    def _wake(self):
+        os.write(self._wake_write, b'x')
+
+    def _run(self):
+        while self._running:
+            with self._lock:
+                next_timestamp = self._queue.next_timestamp()
+            if next_timestamp is None:
+                timeout = None
+            else:
+                timeout = max(0, next_timestamp - self._clock.now())
+            try:
+                readable, _, _ = select.select([self._wake_read], [], [],
+                                               timeout)
+            except select.error:
+                continue
+            if readable:
+                os.read(self._wake_read, 4096)
+            self.flush_due(self._clock.now())
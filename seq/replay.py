@@ -0,0 +1,140 @@
+'''
+Replays a recorded session (see sessionlog.py) through MantaSeq on a virtual
+clock, as fast as it'll go, and writes out the MIDI and LED output. Run
+directly:
+
+    python replay.py session.log output.txt
+
+Each output line is the time since the start of the recording, then either
+"midi" and the message bytes or "osc" and the datagram sent to the Manta, in
+hex. Comparing the output of two versions of the sequencer shows whether
+they behave the same.
+'''
+import binascii
+import sys
+import time
+from clock import VirtualClock
+from manta import Manta
+from mantaseq import MantaSeq
+from midibackends import CaptureBackend
+from sessionlog import read_session
+
+class ReplayManta(Manta):
+    '''
+    A Manta that's fed datagrams instead of reading a socket, and keeps what
+    it sends in sent, as (timestamp, datagram) tuples
+    '''
+    def __init__(self, clock, **kwargs):
+        self._clock = clock
+        self._incoming = []
+        self.sent = []
+        Manta.__init__(self, timeout=0, buffer_leds=True, bundle_output=True,
+                       **kwargs)
+
+    def _open(self, receive_port, send_port, send_address, timeout):
+        self.osc_server = None
+        self.osc_client = None
+
+    def feed(self, datagrams):
+        '''Queues datagrams to be decoded by the next process() call'''
+        self._incoming.extend(datagrams)
+
+    def process(self):
+        events = self._reset_events()
+        self._datagram_time = self.clock.now()
+        for data in self._incoming:
+            self._handle_datagram(data, None)
+        count = len(self._incoming)
+        del self._incoming[:]
+        self.backlog_depth = count
+        if count > self.max_backlog_depth:
+            self.max_backlog_depth = count
+        self.datagrams_received += count
+        return events
+
+    def _send_datagram(self, data):
+        self.sent.append((self._clock.now(), data))
+        self.datagrams_sent += 1
+
+def _run_until(seq, clock, timestamp):
+    '''Processes every step and note-off due up to timestamp'''
+    while True:
+        deadline = seq.next_deadline()
+        if deadline is None or deadline > timestamp:
+            return
+        clock.set(max(deadline, clock.now()))
+        seq.process()
+
+class SessionReplay(object):
+    '''
+    Replays the session log at path through a new MantaSeq, created with any
+    other arguments given. Datagrams that were read together are processed
+    together, and steps and note-offs run at their exact times in between.
+    '''
+    def __init__(self, path, **kwargs):
+        self._path = path
+        self._seq_options = kwargs
+        self.clock = VirtualClock()
+        self.seq = None
+        self.start_time = None
+
+    def run(self, tail=0):
+        '''
+        Replays the whole log, then lets the sequencer run on for tail
+        seconds after the last datagram
+        '''
+        clock = self.clock
+        batch = []
+        batch_time = None
+        for timestamp, data in read_session(self._path):
+            if self.seq is None:
+                clock.set(timestamp)
+                self.start_time = timestamp
+                self.seq = MantaSeq(clock=clock,
+                                    midi_source=CaptureBackend(clock),
+                                    manta=ReplayManta(clock),
+                                    **self._seq_options)
+            if batch and timestamp != batch_time:
+                self._process_batch(batch_time, batch)
+                batch = []
+            batch_time = timestamp
+            batch.append(data)
+        if self.seq is None:
+            raise ValueError('%s has no datagrams in it' % self._path)
+        self._process_batch(batch_time, batch)
+        _run_until(self.seq, clock, batch_time + tail)
+
+    def _process_batch(self, timestamp, batch):
+        _run_until(self.seq, self.clock, timestamp)
+        self.clock.set(max(timestamp, self.clock.now()))
+        self.seq._manta.feed(batch)
+        self.seq.process()
+
+    def output_lines(self):
+        '''Returns the MIDI and LED output, formatted for writing'''
+        output = [(timestamp, 0, 'midi ' + ' '.join('%02x' % byte
+                                                    for byte in message))
+                  for timestamp, message in self.seq._midi_source.sent]
+        output.extend((timestamp, 1,
+                       'osc ' + binascii.hexlify(data).decode('ascii'))
+                      for timestamp, data in self.seq._manta.sent)
+        output.sort(key=lambda line: line[:2])
+        return ['%.6f %s\n' % (timestamp - self.start_time, line)
+                for timestamp, order, line in output]
+
+def main():
+    if len(sys.argv) != 3:
+        print('usage: replay.py session.log output.txt')
+        sys.exit(1)
+    session = SessionReplay(sys.argv[1])
+    start = time.time()
+    session.run(tail=1.0)
+    elapsed = time.time() - start
+    lines = session.output_lines()
+    with open(sys.argv[2], 'w') as output:
+        output.writelines(lines)
+    print('replayed %d datagrams in %.2fs, %d lines of output' % (
+            session.seq._manta.datagrams_received, elapsed, len(lines)))
+
+if __name__ == '__main__':
+    main()
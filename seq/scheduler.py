@@ -0,0 +1,71 @@
+import heapq
+import itertools
+
+# stands in for the item of an entry that has been cancelled or popped.
+# Cancelled entries are left in the heap until they work their way to the top
+_CANCELLED = object()
+
+class Scheduler(object):
+    '''
+    A priority queue of items keyed on timestamp. Scheduling and expiring an
+    item are O(log n), and checking for due items when nothing is due is O(1).
+    Items with the same timestamp come out in the order they were scheduled.
+    '''
+    def __init__(self):
+        self._heap = []
+        # breaks ties between equal timestamps so items are never compared
+        self._sequence = itertools.count()
+        self._live_count = 0
+
+    def __len__(self):
+        return self._live_count
+
+    def schedule(self, timestamp, item):
+        '''
+        Schedules item at timestamp, returning a handle that can be passed to
+        cancel().
+        '''
+        entry = [timestamp, next(self._sequence), item]
+        heapq.heappush(self._heap, entry)
+        self._live_count += 1
+        return entry
+
+    def cancel(self, handle):
+        '''
+        Cancels a scheduled item. Cancelling an item that has already been
+        popped or cancelled does nothing.
+        '''
+        if handle[2] is not _CANCELLED:
+            handle[2] = _CANCELLED
+            self._live_count -= 1
+
+    def next_timestamp(self):
+        '''Returns the earliest scheduled timestamp, or None if empty'''
+        heap = self._heap
+        while heap and heap[0][2] is _CANCELLED:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def pop_due(self, now):
+        '''
+        Removes and returns a sequence of (timestamp, item) tuples for every item
+        scheduled at or before now, earliest first.
+        '''
+        heap = self._heap
+        if not heap or heap[0][0] > now:
+            return ()
+        due = []
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            item = entry[2]
+            if item is not _CANCELLED:
+                entry[2] = _CANCELLED
+                due.append((entry[0], item))
+        self._live_count -= len(due)
+        return due
+
+    def clear(self):
+        for entry in self._heap:
+            entry[2] = _CANCELLED
+        del self._heap[:]
+        self._live_count = 0
@@ -0,0 +1,54 @@
+'''
+Records the raw OSC datagrams a Manta receives to a binary log, so sessions
+can be replayed later (see replay.py). A log starts with a short header,
+followed by a record per datagram: the time it was read as a double and its
+length as an unsigned short, then the datagram itself.
+'''
+import struct
+
+MAGIC = b'MSQL'
+VERSION = 1
+_HEADER = struct.Struct('>4sB')
+_RECORD = struct.Struct('>dH')
+
+class SessionRecorder(object):
+    '''
+    Writes datagrams to the log at path. Assign it to a Manta's recorder
+    attribute to record everything the Manta receives, stamped with clock's
+    time.
+    '''
+    def __init__(self, path, clock):
+        self.clock = clock
+        self._file = open(path, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION))
+        self.record_count = 0
+
+    def record(self, timestamp, data):
+        self._file.write(_RECORD.pack(timestamp, len(data)))
+        self._file.write(data)
+        self.record_count += 1
+
+    def close(self):
+        self._file.close()
+
+def read_session(path):
+    '''Yields the (timestamp, datagram) records in the log at path'''
+    with open(path, 'rb') as log:
+        header = log.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise ValueError('%s is not a session log' % path)
+        magic, version = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError('%s is not a session log' % path)
+        if version != VERSION:
+            raise ValueError('Unsupported session log version: %d' % version)
+        while True:
+            record = log.read(_RECORD.size)
+            if len(record) < _RECORD.size:
+                return
+            timestamp, size = _RECORD.unpack(record)
+            data = log.read(size)
+            if len(data) < size:
+                # the recording was cut off mid-write
+                return
+            yield timestamp, data
@@ -1,20 +1,50 @@
+from array import array
+
 MAX_STEPS = 16
+# the per-step fields, with the array typecode and default value of the
+# column each one is stored in. Durations are a ratio relative to the step
+# time.
+FIELDS = (('note', 'i', 0),
+          ('velocity', 'i', 0),
+          ('cc1', 'i', 0),
+          ('cc2', 'i', 0),
+          ('duration', 'd', 0.90))
+
+def _field_property(field):
+    def get_value(self):
+        return self._seq.columns[field][self.index]
+    def set_value(self, value):
+        self._seq.columns[field][self.index] = value
+    return property(get_value, set_value)
+
 class Step(object):
-    def __init__(self, note=0, velocity=0, cc1=0, cc2=0, duration=0.90):
-        self.note = note
-        self.velocity = velocity
-        self.cc1 = cc1
-        self.cc2 = cc2
-        # duration is a ratio relative to the step time
-        self.duration = duration
+    '''
+    A view of a single step. The values themselves live in the Seq's columns,
+    so reading or writing them here reads or writes the Seq.
+    '''
+    __slots__ = ('_seq', 'index')
+
+    def __init__(self, seq, index):
+        self._seq = seq
+        self.index = index
+
+for _field, _typecode, _default in FIELDS:
+    setattr(Step, _field, _field_property(_field))
 
 class Seq(object):
-    def __init__(self):
-        self.step_count = MAX_STEPS
-        self.steps = [Step() for i in range(MAX_STEPS)]
-        # pitches, velocities, etc. can be assigned to multiple steps at once
-        self.selected_steps = []
+    def __init__(self, length=MAX_STEPS):
+        self.step_count = length
+        # each field is stored in its own array, indexed by step number
+        self.columns = dict((field, array(typecode, [default] * length))
+                            for field, typecode, default in FIELDS)
+        self.steps = [Step(self, i) for i in range(length)]
+        # pitches, velocities, etc. can be assigned to multiple steps at once.
+        # bit n is set if step n is selected
+        self.selection = 0
         self.current_step_index = 0
+        # selected_indices() is cached until the selection changes
+        self._indices = []
+        self._indices_selection = 0
 
     def step(self):
         # catch the case where the step count was changed and
@@ -27,25 +57,70 @@ class Seq(object):
         return current_step
 
     def select_step(self, step_index):
-        assert step_index < MAX_STEPS, "Out-of-range step: %d" % step_index
-        step = self.steps[step_index]
-        if step not in self.selected_steps:
-            self.selected_steps.append(step)
+        assert step_index < len(self.steps), "Out-of-range step: %d" % step_index
+        self.selection |= 1 << step_index
 
     def deselect_step(self, step_index):
-        self.selected_steps.remove(self.steps[step_index])
+        self.selection &= ~(1 << step_index)
+
+    def is_selected(self, step_index):
+        return bool(self.selection & (1 << step_index))
 
-    # implement methods to set step attributes
-    def __getattr__(self, attr):
+    def selected_indices(self):
         '''
-        This allows us to call methods like set_note() or set_velocity() and
-        have them dispatched properly to all selected steps.
+        Returns the indices of the selected steps, in order. The list is
+        shared, so don't modify it.
+        '''
+        if self._indices_selection != self.selection:
+            indices = []
+            selection = self.selection
+            while selection:
+                lowest_bit = selection & -selection
+                indices.append(lowest_bit.bit_length() - 1)
+                selection ^= lowest_bit
+            self._indices = indices
+            self._indices_selection = self.selection
+        return self._indices
+
+    def snapshot(self):
         '''
-        if not attr.startswith('set_'):
-            raise AttributeError()
-        attr = attr[4:]
-        # define a function that sets the given value on all selected steps
-        def set_step_value(value):
-            for step in self.selected_steps:
-                setattr(step, attr, value)
-        return set_step_value
+        Returns a copy of the sequence, with its own copy of the step values,
+        that can be played while this one keeps being edited
+        '''
+        copy = Seq(len(self.steps))
+        for field, column in self.columns.items():
+            copy.columns[field][:] = column
+        copy.step_count = self.step_count
+        copy.current_step_index = self.current_step_index
+        return copy
+
+    @property
+    def selected_steps(self):
+        return [self.steps[i] for i in self.selected_indices()]
+
+    def set_fields(self, **values):
+        '''
+        Sets several fields on all the selected steps in one pass, e.g.
+        set_fields(note=60, velocity=100)
+        '''
+        try:
+            columns = [(self.columns[field], value)
+                       for field, value in values.items()]
+        except KeyError as e:
+            raise TypeError('Unknown step field: %s' % e.args[0])
+        for i in self.selected_indices():
+            for column, value in columns:
+                column[i] = value
+
+def _field_setter(field):
+    def set_field(self, value):
+        '''Sets the field on all the selected steps'''
+        column = self.columns[field]
+        for i in self.selected_indices():
+            column[i] = value
+    set_field.__name__ = 'set_' + field
+    return set_field
+
+# define set_note(), set_velocity(), etc.
+for _field, _typecode, _default in FIELDS:
+    setattr(Seq, 'set_' + _field, _field_setter(_field))
@@ -0,0 +1,134 @@
+import socket
+import struct
+import unittest
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+from manta import osc_prefix, PadVelocityEvent, RED
+from clock import LoopClock
+from midibackends import CaptureBackend
+if asyncio is not None:
+    from asyncmanta import AsyncManta, AsyncMantaSeq
+
+def pad_velocity_datagram(pad_num, velocity):
+    return (osc_prefix('/manta/velocity/pad', 'ii') +
+            struct.pack('>ii', pad_num, velocity))
+
+@unittest.skipIf(asyncio is None, 'needs asyncio')
+class AsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+class TestAsyncManta(AsyncTest):
+    def setUp(self):
+        AsyncTest.setUp(self)
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(1)
+        self.manta = AsyncManta(receive_port=0,
+                                send_port=self.receiver.getsockname()[1])
+        self.batches = []
+        self.manta.event_handler = self.collect_events
+        self.loop.run_until_complete(self.manta.open(self.loop))
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sender.connect(self.manta.transport.get_extra_info('sockname'))
+
+    def tearDown(self):
+        self.manta.close()
+        self.sender.close()
+        self.receiver.close()
+        AsyncTest.tearDown(self)
+
+    def collect_events(self):
+        self.batches.append([(type(event), event.pad_num, event.velocity)
+                             for event in self.manta.process()])
+
+    def test_datagrams_are_decoded_as_they_arrive(self):
+        self.sender.send(pad_velocity_datagram(3, 100))
+        self.sender.send(pad_velocity_datagram(4, 0))
+        self.run_for(0.05)
+        self.assertEqual(self.batches, [[(PadVelocityEvent, 3, 100)],
+                                        [(PadVelocityEvent, 4, 0)]])
+
+    def test_bundles_are_decoded(self):
+        message = pad_velocity_datagram(5, 80)
+        bundle = (b'#bundle\0' + struct.pack('>II', 0, 1) +
+                  struct.pack('>i', len(message)) + message)
+        self.sender.send(bundle)
+        self.run_for(0.05)
+        self.assertEqual(self.batches, [[(PadVelocityEvent, 5, 80)]])
+
+    def test_messages_sent_before_open_are_held(self):
+        manta = AsyncManta(receive_port=0,
+                           send_port=self.receiver.getsockname()[1])
+        manta.set_led_pad(RED, 10)
+        self.loop.run_until_complete(manta.open(self.loop))
+        try:
+            data = self.receiver.recv(4096)
+        finally:
+            manta.close()
+        self.assertTrue(data.startswith(osc_prefix('/manta/led/pad', 'si')))
+
+class TestAsyncMantaSeq(AsyncTest):
+    STEP_DURATION = 0.01
+
+    def setUp(self):
+        AsyncTest.setUp(self)
+        # somewhere for the LED messages to go
+        self.led_sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.led_sink.bind(('127.0.0.1', 0))
+
+    def tearDown(self):
+        self.led_sink.close()
+        AsyncTest.tearDown(self)
+
+    def make_seq(self, note):
+        seq = AsyncMantaSeq(self.loop, receive_port=0,
+                            send_port=self.led_sink.getsockname()[1],
+                            midi_source=CaptureBackend(LoopClock(self.loop)))
+        seq.step_duration = self.STEP_DURATION
+        seq._seq.select_step(0)
+        seq._seq.set_fields(note=note, velocity=100)
+        return seq
+
+    def test_tempo_change_from_outside_moves_the_timer(self):
+        seq = self.make_seq(60)
+        seq.step_duration = 1.0
+        seq.start()
+        seq.process()
+        try:
+            self.assertEqual(seq._timer_deadline, seq.next_deadline())
+            seq.step_duration = 0.5
+            self.assertEqual(seq._timer_deadline, seq.next_deadline())
+        finally:
+            seq._timer.cancel()
+            seq.cleanup()
+            seq._manta.close()
+
+    def test_sequencers_share_a_loop(self):
+        seqs = [self.make_seq(60), self.make_seq(62)]
+        tasks = [self.loop.create_task(seq.run()) for seq in seqs]
+        # let the endpoints open, so that isn't counted against the first step
+        self.run_for(0.02)
+        for seq in seqs:
+            seq.start()
+        start = self.loop.time()
+        self.run_for(self.STEP_DURATION * 16 * 2.5)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks,
+                                                    return_exceptions=True))
+        for seq, note in zip(seqs, (60, 62)):
+            note_ons = [t for t, message in seq._midi_source.sent
+                        if message[0] == 0x90 and message[2] > 0]
+            self.assertEqual(len(note_ons), 3)
+            for i, t in enumerate(note_ons):
+                ideal = start + i * 16 * self.STEP_DURATION
+                self.assertTrue(abs(t - ideal) < 0.005)
@@ -0,0 +1,33 @@
+import time
+import unittest
+from mock import patch
+from clock import SystemClock, VirtualClock, monotonic
+import clock
+
+class TestSystemClock(unittest.TestCase):
+    def test_never_goes_backwards(self):
+        clock = SystemClock()
+        readings = [clock.now() for i in range(1000)]
+        self.assertEqual(readings, sorted(readings))
+
+    def test_isnt_the_wall_clock(self):
+        self.assertFalse(monotonic is time.time)
+
+    def test_clock_gettime_keeps_time(self):
+        monotonic = clock._clock_gettime_monotonic()
+        start = monotonic()
+        time.sleep(0.05)
+        self.assertAlmostEqual(monotonic() - start, 0.05, delta=0.04)
+
+    def test_unsupported_platforms_fail_loudly(self):
+        with patch('sys.platform', 'plan9'):
+            self.assertRaises(ImportError, clock._clock_gettime_monotonic)
+
+class TestVirtualClock(unittest.TestCase):
+    def test_only_moves_when_told(self):
+        clock = VirtualClock(10)
+        self.assertEqual(clock.now(), 10)
+        clock.advance(0.5)
+        self.assertEqual(clock.now(), 10.5)
+        clock.set(3)
+        self.assertEqual(clock.now(), 3)
@@ -0,0 +1,39 @@
+import unittest
+from clock import VirtualClock
+from fakemanta import pad_values, pressure_sweep, single_hits, slider_drag
+from mantaseq import MantaSeq
+from midibackends import CaptureBackend
+from replay import ReplayManta
+
+class TestPatterns(unittest.TestCase):
+    '''Checks each pattern's expected MIDI is exactly what MantaSeq sends'''
+    def assert_expected_output(self, pattern):
+        clock = VirtualClock()
+        capture = CaptureBackend(clock)
+        seq = MantaSeq(clock=clock, midi_source=capture,
+                       manta=ReplayManta(clock))
+        for offset, datagram, expected in pattern:
+            clock.set(offset)
+            seq._manta.feed([datagram])
+            seq.process()
+        self.assertEqual(capture.messages(),
+                         [expected for offset, datagram, expected in pattern
+                          if expected is not None])
+
+    def test_single_hits(self):
+        pattern = single_hits(3, 100)
+        self.assertEqual(len(pattern), 6)
+        self.assert_expected_output(pattern)
+
+    def test_pressure_sweep(self):
+        self.assert_expected_output(pressure_sweep(1000))
+
+    def test_slider_drag(self):
+        self.assert_expected_output(slider_drag(600, 1000))
+
+    def test_pad_values(self):
+        self.assert_expected_output(pad_values(100, 1000))
+
+    def test_zero_rate_sends_everything_at_once(self):
+        self.assertEqual(set(offset for offset, datagram, expected
+                             in pressure_sweep(0)), set([0]))
@@ -0,0 +1,156 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from clock import VirtualClock
+from fakemanta import pad_velocity_datagram, slider_value_datagram
+from journal import (Journal, read_journal, describe, KINDS, MIDI, STATE,
+                     LED_PAD, _RECORD)
+from manta import osc_prefix, AMBER, RED
+from mantaseq import MantaSeq, make_note
+from midibackends import CaptureBackend
+from replay import ReplayManta
+import struct
+
+def button_velocity_datagram(button_num, velocity):
+    return (osc_prefix('/manta/velocity/button', 'ii') +
+            struct.pack('>ii', button_num, velocity))
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self):
+        start, wall_start, records = read_journal(self.path)
+        return list(records)
+
+class TestJournal(JournalTest):
+    def test_records_are_read_back_in_order(self):
+        journal = Journal(self.path)
+        journal.record_midi(make_note(60, 100))
+        journal.record_led_pad(RED, 12)
+        journal.record_state(2)
+        journal.close()
+        records = self.read()
+        self.assertEqual([record[1:] for record in records],
+                         [(MIDI, 0x90, 60, 100), (LED_PAD, 12, 2, 0),
+                          (STATE, 2, 0, 0)])
+        timestamps = [record[0] for record in records]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_oldest_records_are_dropped_when_ring_fills(self):
+        journal = Journal(self.path, capacity=4, flush_interval=60)
+        for i in range(10):
+            journal.record_state(i)
+        journal.close()
+        self.assertEqual([record[2] for record in self.read()],
+                         [6, 7, 8, 9])
+        self.assertEqual(journal.dropped, 6)
+
+    def test_flushes_across_ring_wraparound(self):
+        journal = Journal(self.path, capacity=4, flush_interval=60)
+        for i in range(3):
+            journal.record_state(i)
+        journal.flush()
+        for i in range(3, 6):
+            journal.record_state(i)
+        journal.close()
+        self.assertEqual([record[2] for record in self.read()],
+                         list(range(6)))
+        self.assertEqual(journal.dropped, 0)
+
+    def test_record_being_written_during_flush_is_dropped(self):
+        journal = Journal(self.path, capacity=4, flush_interval=60)
+        for i in range(4):
+            journal.record_state(i)
+        lapping = []
+        class LappingRing(bytearray):
+            def __getitem__(ring, index):
+                chunk = bytearray.__getitem__(ring, index)
+                if not lapping:
+                    # while the ring is being copied, a writer packs record 4
+                    # over record 0 but hasn't counted it yet
+                    lapping.append(True)
+                    journal._write_lock.acquire()
+                    _RECORD.pack_into(ring, 0, 0.0, STATE, 4, 0, 0)
+                    def finish():
+                        journal._written += 1
+                        journal._write_lock.release()
+                    threading.Timer(0.05, finish).start()
+                return chunk
+        journal._ring = LappingRing(journal._ring)
+        journal.flush()
+        journal.close()
+        self.assertEqual([record[2] for record in self.read()],
+                         [1, 2, 3, 4])
+        self.assertEqual(journal.dropped, 1)
+
+    def test_rejects_other_files(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a journal at all')
+        self.assertRaises(ValueError, read_journal, self.path)
+
+    def test_describe(self):
+        self.assertEqual(describe((0, STATE, 1, 0, 0)),
+                         {'kind': 'state', 'state': 'steps_selected'})
+        self.assertEqual(describe((0, LED_PAD, 3, 1, 0)),
+                         {'kind': 'led_pad', 'pad': 3, 'led': AMBER})
+
+class TestJournaledMantaSeq(JournalTest):
+    def test_input_states_midi_and_leds_are_journaled(self):
+        clock = VirtualClock(1000)
+        seq = MantaSeq(clock=clock, midi_source=CaptureBackend(clock),
+                       manta=ReplayManta(clock))
+        journal = Journal(self.path, flush_interval=60)
+        seq.set_journal(journal)
+        # the first step moves the highlight
+        seq.start()
+        # shift press and release, then a note played live
+        seq._manta.feed([button_velocity_datagram(1, 100),
+                         button_velocity_datagram(1, 0),
+                         pad_velocity_datagram(16, 100)])
+        seq.process()
+        seq.set_journal(None)
+        journal.close()
+        kinds = [KINDS[record[1]][0] for record in self.read()]
+        self.assertEqual(kinds[:7], ['state', 'button_velocity', 'state',
+                                     'button_velocity', 'state',
+                                     'pad_velocity', 'midi'])
+        self.assertTrue('led_pad' in kinds)
+        states = [describe(record)['state'] for record in self.read()
+                  if record[1] == STATE]
+        self.assertEqual(states, ['idle', 'shifted', 'idle'])
+
+    def test_midi_still_reaches_source(self):
+        clock = VirtualClock(1000)
+        capture = CaptureBackend(clock)
+        seq = MantaSeq(clock=clock, midi_source=capture,
+                       manta=ReplayManta(clock))
+        journal = Journal(self.path, flush_interval=60)
+        seq.set_journal(journal)
+        seq._manta.feed([slider_value_datagram(0, 2048)])
+        seq.process()
+        journal.close()
+        self.assertEqual(capture.messages(), [(0xB0, 1, 63)])
+        self.assertEqual([record[1:] for record in self.read()
+                          if record[1] == MIDI], [(MIDI, 0xB0, 1, 63)])
+
+    def test_attaching_keeps_cc_rate_limits(self):
+        clock = VirtualClock(1000)
+        capture = CaptureBackend(clock)
+        seq = MantaSeq(clock=clock, midi_source=capture,
+                       manta=ReplayManta(clock))
+        seq.set_cc_rate_limit(1, 10)
+        journal = Journal(self.path, flush_interval=60)
+        seq.set_journal(journal)
+        seq._manta.feed([slider_value_datagram(0, 1000 + i * 500)
+                         for i in range(5)])
+        seq.process()
+        seq.set_journal(None)
+        journal.close()
+        self.assertEqual(len(capture.messages()), 1)
@@ -1,5 +1,27 @@
+import socket
+import struct
+import sys
+import time
 import unittest
-from manta import note_from_pad, pad_from_note
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+from manta import (Manta,
+                   decodeOSC,
+                   AMBER, RED,
+                   ButtonVelocityEvent,
+                   EventCoalescer,
+                   PadValueEvent,
+                   PadVelocityEvent,
+                   SliderValueEvent,
+                   _LED_PAD_PACKETS,
+                   _LED_ROW_PACKETS,
+                   _libc_recvmsg,
+                   encode_osc,
+                   osc_prefix,
+                   note_from_pad,
+                   pad_from_note)
 
 BASE_MIDI_NOTE = 48
 
@@ -18,3 +40,355 @@ class TestNoteConversion(unittest.TestCase):
 
     def test_octave_above_base_midi_note_gives_16th_pad(self):
         self.assertEquals(pad_from_note(BASE_MIDI_NOTE+12), 16)
+
+def pad_velocity_datagram(pad_num, velocity):
+    return b'/manta/velocity/pad\0,ii\0' + struct.pack('>ii', pad_num, velocity)
+
+class LoopbackTest(unittest.TestCase):
+    manta_options = {}
+
+    def setUp(self):
+        self.manta = Manta(receive_port=0, timeout=0, **self.manta_options)
+        self.address = self.manta.osc_server.socket.getsockname()
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sender.close()
+        self.manta.osc_server.close()
+
+    def send_pad_velocity(self, pad_num, velocity):
+        self.sender.sendto(pad_velocity_datagram(pad_num, velocity),
+                           self.address)
+
+class TestWaiting(LoopbackTest):
+    def test_wait_times_out_without_input(self):
+        self.assertFalse(self.manta.wait(0))
+
+    def test_wait_wakes_on_input(self):
+        self.send_pad_velocity(0, 0)
+        self.assertTrue(self.manta.wait(1))
+
+class TestDraining(LoopbackTest):
+    def test_process_without_input_returns_nothing(self):
+        self.assertEqual(self.manta.process(), [])
+
+    def test_process_drains_all_pending_datagrams(self):
+        for i in range(20):
+            self.send_pad_velocity(i, 100)
+        self.manta.wait(1)
+        events = self.manta.process()
+        self.assertEqual([e.pad_num for e in events], list(range(20)))
+        self.assertTrue(isinstance(events[0], PadVelocityEvent))
+        self.assertEqual(self.manta.backlog_depth, 20)
+
+    def test_process_is_bounded_by_max_batch(self):
+        self.manta.max_batch = 5
+        for i in range(8):
+            self.send_pad_velocity(i, 100)
+        self.manta.wait(1)
+        self.assertEqual(len(self.manta.process()), 5)
+        self.assertEqual(len(self.manta.process()), 3)
+        self.assertEqual(self.manta.max_backlog_depth, 5)
+        self.assertEqual(self.manta.datagrams_received, 8)
+
+    def test_kernel_drops_starts_at_zero(self):
+        self.assertIn(self.manta.kernel_drops(), (0, None))
+
+class TestReceiveTimestamps(LoopbackTest):
+    manta_options = {'kernel_timestamps': True}
+
+    def test_events_are_stamped(self):
+        self.send_pad_velocity(0, 100)
+        self.manta.wait(1)
+        event = self.manta.process()[0]
+        self.assertTrue(event.timestamp <= self.manta.clock.now())
+
+    def test_kernel_timestamp_is_arrival_time(self):
+        if not sys.platform.startswith('linux'):
+            self.skipTest('kernel receive timestamps are Linux only')
+        self.assertTrue(self.manta._timestamped_receive is not None)
+        self.send_pad_velocity(0, 100)
+        time.sleep(0.05)
+        read_time = self.manta.clock.now()
+        event = self.manta.process()[0]
+        self.assertTrue(read_time - event.timestamp > 0.04)
+
+    def test_libc_recvmsg_matches_recvfrom(self):
+        if not sys.platform.startswith('linux'):
+            self.skipTest('kernel receive timestamps are Linux only')
+        receive = _libc_recvmsg(self.manta.osc_server.socket, 1024)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.bind(('127.0.0.1', 0))
+        try:
+            sender.sendto(b'abcdefgh',
+                          self.manta.osc_server.socket.getsockname())
+            self.manta.wait(1)
+            data, source, arrived = receive(1024)
+            self.assertEqual(data, b'abcdefgh')
+            self.assertEqual(source, sender.getsockname())
+            self.assertTrue(abs(arrived - time.time()) < 1)
+            self.assertRaises(socket.error, receive, 1024)
+        finally:
+            sender.close()
+
+class TestReadTimestamps(LoopbackTest):
+    def test_kernel_timestamps_are_off_by_default(self):
+        self.assertTrue(self.manta._timestamped_receive is None)
+
+    def test_kernel_timestamps_can_be_turned_off(self):
+        self.manta.set_kernel_timestamps(True)
+        self.manta.set_kernel_timestamps(False)
+        self.assertTrue(self.manta._timestamped_receive is None)
+        self.test_read_time_is_used()
+
+    def test_read_time_is_used(self):
+        self.send_pad_velocity(0, 100)
+        time.sleep(0.05)
+        read_time = self.manta.clock.now()
+        event = self.manta.process()[0]
+        self.assertTrue(event.timestamp >= read_time)
+
+class TestFastDecode(LoopbackTest):
+    source = ('127.0.0.1', 0)
+
+    def decode(self, datagrams):
+        del self.manta.event_queue[:]
+        for data in datagrams:
+            self.manta._handle_datagram(data, self.source)
+        return list(self.manta.event_queue)
+
+    def test_fast_path_matches_generic_path(self):
+        datagrams = [pad_velocity_datagram(3, 100),
+                     osc_prefix('/manta/continuous/pad', 'ii') +
+                        struct.pack('>ii', 20, 55),
+                     osc_prefix('/manta/continuous/slider', 'ii') +
+                        struct.pack('>ii', 1, 2048),
+                     osc_prefix('/manta/velocity/button', 'ii') +
+                        struct.pack('>ii', 2, 90)]
+        fast_events = [str(e) for e in self.decode(datagrams)]
+        self.manta.fast_decode = False
+        generic_events = [str(e) for e in self.decode(datagrams)]
+        self.assertEqual(len(fast_events), 4)
+        self.assertEqual(fast_events, generic_events)
+
+    def test_other_type_tags_fall_back_to_generic_path(self):
+        data = osc_prefix('/manta/velocity/pad', 'if') + struct.pack('>if', 5, 42.0)
+        events = self.decode([data])
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].pad_num, 5)
+        self.assertEqual(events[0].velocity, 42.0)
+
+class OutputTest(unittest.TestCase):
+    manta_options = {}
+
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(0)
+        self.manta = Manta(receive_port=0,
+                           send_port=self.receiver.getsockname()[1],
+                           timeout=0, **self.manta_options)
+
+    def tearDown(self):
+        self.receiver.close()
+        self.manta.osc_server.close()
+
+    def sent_datagrams(self):
+        datagrams = []
+        while True:
+            try:
+                datagrams.append(self.receiver.recv(65536))
+            except socket.error:
+                return datagrams
+
+    def sent_messages(self):
+        return [decodeOSC(data) for data in self.sent_datagrams()]
+
+class TestLEDBuffering(OutputTest):
+    manta_options = {'buffer_leds': True}
+
+    def test_unbuffered_pad_led_is_sent_immediately(self):
+        self.manta.buffer_leds = False
+        self.manta.set_led_pad(AMBER, 47)
+        self.assertEqual(self.sent_messages(),
+                         [['/manta/led/pad', ',si', AMBER, 47]])
+
+    def test_nothing_is_sent_until_flush(self):
+        self.manta.set_led_pad(RED, 3)
+        self.assertEqual(self.sent_messages(), [])
+        self.manta.flush_leds()
+        self.assertEqual(self.sent_messages(),
+                         [['/manta/led/pad', ',si', RED, 3]])
+
+    def test_only_last_change_per_pad_is_sent(self):
+        self.manta.set_led_pad(RED, 3)
+        self.manta.set_led_pad(AMBER, 3)
+        self.manta.flush_leds()
+        self.assertEqual(self.sent_messages(),
+                         [['/manta/led/pad', ',si', AMBER, 3]])
+
+    def test_unchanged_pads_are_not_resent(self):
+        self.manta.set_led_pad(RED, 3)
+        self.manta.flush_leds()
+        self.sent_messages()
+        self.manta.set_led_pad(RED, 3)
+        self.manta.flush_leds()
+        self.assertEqual(self.sent_messages(), [])
+
+    def test_changes_in_one_row_are_sent_as_row(self):
+        for pad_index in (8, 10, 15):
+            self.manta.set_led_pad(AMBER, pad_index)
+        self.manta.flush_leds()
+        self.assertEqual(self.sent_messages(),
+                [['/manta/led/pad/row', ',sii', AMBER, 1, 0b10000101]])
+
+    def test_changes_across_rows_are_sent_as_frames(self):
+        for pad_index in range(48):
+            self.manta.set_led_pad(RED if pad_index % 2 else AMBER, pad_index)
+        self.manta.flush_leds()
+        messages = self.sent_messages()
+        self.assertEqual(messages, [
+            ['/manta/led/pad/frame', ',ss', AMBER, '10' * 24],
+            ['/manta/led/pad/frame', ',ss', RED, '01' * 24]])
+
+class TestPacketCache(unittest.TestCase):
+    def test_cached_packets_match_generic_encoding(self):
+        self.assertEqual(_LED_PAD_PACKETS[RED][10],
+                         encode_osc('/manta/led/pad', RED, 10))
+        self.assertEqual(_LED_ROW_PACKETS[AMBER][2][0x81],
+                         encode_osc('/manta/led/pad/row', AMBER, 2, 0x81))
+
+    def test_packets_are_only_built_once(self):
+        self.assertTrue(_LED_PAD_PACKETS[RED][10] is _LED_PAD_PACKETS[RED][10])
+
+class TestBundling(OutputTest):
+    manta_options = {'bundle_output': True}
+
+    def test_nothing_is_sent_until_flush(self):
+        self.manta.set_led_pad(RED, 3)
+        self.assertEqual(self.sent_datagrams(), [])
+
+    def test_single_message_is_sent_unbundled(self):
+        self.manta.set_led_pad(RED, 3)
+        self.manta.flush_output()
+        self.assertEqual(self.sent_messages(),
+                         [['/manta/led/pad', ',si', RED, 3]])
+
+    def test_messages_are_sent_as_one_bundle(self):
+        for pad_index in range(3):
+            self.manta.set_led_pad(RED, pad_index)
+        self.manta.flush_output()
+        messages = self.sent_messages()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0][0], '#bundle')
+        self.assertEqual(messages[0][2:],
+                         [['/manta/led/pad', ',si', RED, i] for i in range(3)])
+        self.assertEqual(self.manta.datagrams_sent, 1)
+
+    def test_bundles_are_split_at_max_size(self):
+        self.manta.max_bundle_size = 100
+        for pad_index in range(10):
+            self.manta.set_led_pad(RED, pad_index)
+        self.manta.flush_output()
+        datagrams = self.sent_datagrams()
+        self.assertTrue(len(datagrams) > 1)
+        self.assertTrue(all(len(data) <= 100 for data in datagrams))
+        pads = [message[3] for data in datagrams
+                for message in decodeOSC(data)[2:]]
+        self.assertEqual(pads, list(range(10)))
+
+    def test_timetag_is_encoded_as_ntp_time(self):
+        self.manta.set_led_pad(RED, 3)
+        self.manta.flush_output(timetag=1000.5)
+        data = self.sent_datagrams()[0]
+        self.assertEqual(struct.unpack('>II', data[8:16]),
+                         (1000 + 2208988800, 1 << 31))
+
+class TestEventCoalescing(unittest.TestCase):
+    def setUp(self):
+        self.coalescer = EventCoalescer()
+
+    def coalesce(self, events):
+        return [str(event) for event in self.coalescer.coalesce(events)]
+
+    def test_keeps_last_value_per_pad(self):
+        events = [PadValueEvent(20, 10), PadValueEvent(21, 5),
+                  PadValueEvent(20, 30)]
+        self.assertEqual(self.coalesce(events),
+                         [str(events[1]), str(events[2])])
+        self.assertEqual(self.coalescer.collapsed[PadValueEvent], 1)
+        self.assertEqual(self.coalescer.total_collapsed, 1)
+
+    def test_keeps_last_value_per_slider(self):
+        events = [SliderValueEvent(0, True, 0.1), SliderValueEvent(1, True, 0.2),
+                  SliderValueEvent(0, True, 0.3)]
+        self.assertEqual(self.coalesce(events),
+                         [str(events[1]), str(events[2])])
+        self.assertEqual(self.coalescer.collapsed[SliderValueEvent], 1)
+
+    def test_values_are_not_moved_across_velocity_events(self):
+        events = [PadVelocityEvent(3, 100), PadValueEvent(20, 10),
+                  PadValueEvent(20, 30), PadVelocityEvent(3, 0),
+                  PadValueEvent(20, 0), ButtonVelocityEvent(1, 100)]
+        self.assertEqual(self.coalesce(events),
+                         [str(events[0]), str(events[2]), str(events[3]),
+                          str(events[4]), str(events[5])])
+
+    def test_slider_releases_are_kept(self):
+        events = [SliderValueEvent(0, True, 0.1), SliderValueEvent(0, True, 0.3),
+                  SliderValueEvent(0, False, 0xffff),
+                  SliderValueEvent(0, True, 0.5)]
+        self.assertEqual(self.coalesce(events),
+                         [str(events[1]), str(events[2]), str(events[3])])
+
+class TestEventReuse(LoopbackTest):
+    def send_and_process(self, count):
+        for i in range(count):
+            self.send_pad_velocity(i % 48, 100)
+        self.manta.wait(1)
+        return self.manta.process()
+
+    def test_events_and_list_are_reused_between_calls(self):
+        events = self.send_and_process(10)
+        first_ids = [id(event) for event in events]
+        first_list = events
+        events = self.send_and_process(10)
+        self.assertTrue(events is first_list)
+        self.assertEqual([id(event) for event in events], first_ids)
+        self.assertEqual([event.pad_num for event in events], list(range(10)))
+
+    def test_events_can_be_kept_without_reuse(self):
+        self.manta.reuse_events = False
+        first = self.send_and_process(10)
+        second = self.send_and_process(10)
+        self.assertFalse(first is second)
+        self.assertEqual(set(map(id, first)) & set(map(id, second)), set())
+        self.assertEqual([event.pad_num for event in first], list(range(10)))
+
+    def test_events_have_no_dict(self):
+        event = self.send_and_process(1)[0]
+        self.assertFalse(hasattr(event, '__dict__'))
+
+    @unittest.skipIf(tracemalloc is None, 'needs tracemalloc')
+    def test_steady_state_allocation_is_bounded(self):
+        tracemalloc.start()
+        try:
+            # warm up so the pools have grown to the batch size, with the
+            # event list's storage traced so freeing it is counted later
+            self.send_and_process(200)
+            peaks = []
+            for i in range(5):
+                for j in range(200):
+                    self.send_pad_velocity(j % 48, 100)
+                self.manta.wait(1)
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                self.manta.process()
+                current, peak = tracemalloc.get_traced_memory()
+                peaks.append(peak - before)
+                self.assertTrue(current - before < 1024)
+        finally:
+            tracemalloc.stop()
+        # if every message allocated an event that lived until the end of
+        # the call, the peak would grow by at least 200 events
+        self.assertTrue(max(peaks) < 200 * 48)
@@ -0,0 +1,76 @@
+import socket
+import struct
+import unittest
+from clock import VirtualClock
+from manta import osc_prefix
+from mantahost import MantaSeqHost
+from midibackends import CaptureBackend
+
+class TestMantaSeqHost(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock(100)
+        # somewhere for the LED messages to go
+        self.led_sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.led_sink.bind(('127.0.0.1', 0))
+        self.host = MantaSeqHost(self.clock)
+        self.seqs = []
+        for note in (60, 62, 64):
+            seq = self.host.add_instance(
+                    0, self.led_sink.getsockname()[1],
+                    CaptureBackend(self.clock))
+            seq._seq.select_step(0)
+            seq._seq.set_fields(note=note, velocity=100)
+            seq._seq.deselect_step(0)
+            self.seqs.append(seq)
+        self.process_counts = [0] * len(self.seqs)
+        for i, seq in enumerate(self.seqs):
+            seq.process = self.counting(seq.process, i)
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.host.cleanup()
+        self.sender.close()
+        self.led_sink.close()
+
+    def counting(self, process, index):
+        def counted_process():
+            self.process_counts[index] += 1
+            process()
+        return counted_process
+
+    def note_ons(self, seq):
+        return [message[1] for message in seq._midi_source.messages()
+                if message[0] == 0x90 and message[2] > 0]
+
+    def test_idle_instances_are_not_processed(self):
+        self.host.process(0)
+        self.assertEqual(self.process_counts, [0, 0, 0])
+        self.assertEqual(self.host.next_deadline(), None)
+
+    def test_started_instances_step_together(self):
+        self.host.start()
+        self.assertEqual(self.host.next_deadline(), 100)
+        self.host.process(0)
+        self.assertEqual([self.note_ons(seq) for seq in self.seqs],
+                         [[60], [62], [64]])
+
+    def test_only_instances_with_due_deadlines_are_processed(self):
+        self.seqs[1].start()
+        self.host.refresh(self.seqs[1])
+        self.host.process(0)
+        self.assertEqual(self.process_counts, [0, 1, 0])
+        self.assertTrue(self.host.next_deadline() > 100)
+        self.host.process(0)
+        self.assertEqual(self.process_counts, [0, 1, 0])
+
+    def test_input_goes_to_its_instance(self):
+        port = self.seqs[2]._manta.osc_server.socket.getsockname()[1]
+        # the start/stop button
+        self.sender.sendto(osc_prefix('/manta/velocity/button', 'ii') +
+                           struct.pack('>ii', 0, 100), ('127.0.0.1', port))
+        self.host.process(1)
+        self.assertEqual(self.process_counts, [0, 0, 1])
+        self.assertTrue(self.seqs[2].running)
+        # it steps straight away, and the note-off is on the heap
+        self.assertEqual(self.note_ons(self.seqs[2]), [64])
+        self.assertTrue(self.host.next_deadline() > 100)
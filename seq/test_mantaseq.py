@@ -1,8 +1,12 @@
 import unittest
 from mock import Mock, patch
 from mantaseq import MantaSeq
+from clock import VirtualClock
+from midiout import TimedMIDIOutput
+from midibackends import CaptureBackend
 from mantaseq import make_note, make_cc
-from manta import (PadVelocityEvent,
+from manta import (EventCoalescer,
+                   PadVelocityEvent,
                    PadValueEvent,
                    ButtonVelocityEvent,
                    SliderValueEvent,
@@ -15,32 +19,29 @@ MIDI_BASE_NOTE = 60
 
 class MockedBoundaryTest(unittest.TestCase):
     def setUp(self):
-        # note that because Manta and MIDISource are imported with from...
-        # then we have to patch them in the mantaseq namespace
+        # note that because Manta is imported with from...
+        # then we have to patch it in the mantaseq namespace
         self.manta_patch = patch('mantaseq.Manta')
         self.manta_patch.start()
-        self.midi_patch = patch('mantaseq.MIDISource')
-        self.midi_patch.start()
-        self.time_patch = patch('time.time',
-                side_effect = lambda: self.logical_time)
-        self.time_patch.start()
         # allow the logical time of a test to be set
-        self.logical_time = 1000
+        self.clock = VirtualClock(1000)
 
-        self.seq = MantaSeq()
+        self.seq = MantaSeq(clock=self.clock, midi_source=Mock())
         self.event_queue = []
         self.seq._manta.process.side_effect = self.get_next_event
         self.seq._manta.set_led_pad.side_effect = self.set_led_state
         self.led_states = [OFF] * 48
         self.seq.start()
 
+    @property
+    def logical_time(self):
+        return self.clock.now()
+
     def step_time(self, amount):
-        self.logical_time += amount
+        self.clock.advance(amount)
 
     def tearDown(self):
         self.manta_patch.stop()
-        self.midi_patch.stop()
-        self.time_patch.stop()
 
     def add_sequenced_note(self, step, pad_offset, velocity):
         self.enqueue_step_select(step)
@@ -364,6 +365,159 @@ class TestStepping(MockedBoundaryTest):
         self.assert_midi_cc_sent(1, 94)
         self.assert_midi_cc_sent(2, 94)
 
+class TestDeadlines(MockedBoundaryTest):
+    def test_next_deadline_is_next_step_when_running(self):
+        self.seq.process()
+        self.assertEqual(self.seq.next_deadline(),
+                self.logical_time + self.seq.step_duration)
+
+    def test_next_deadline_is_none_when_stopped_and_idle(self):
+        self.seq.stop()
+        self.assertEqual(self.seq.next_deadline(), None)
+
+    def test_next_deadline_includes_note_offs(self):
+        self.seq.stop()
+        self.seq._schedule_note_off(60, self.logical_time + 0.05)
+        self.assertEqual(self.seq.next_deadline(), self.logical_time + 0.05)
+
+    def test_lateness_is_reported(self):
+        lateness = []
+        self.seq.lateness_callback = lateness.append
+        self.step_time(0.01)
+        self.seq.process()
+        self.assertEqual(len(lateness), 1)
+        self.assertAlmostEqual(lateness[0], 0.01)
+
+class TestLookahead(MockedBoundaryTest):
+    def setUp(self):
+        super(TestLookahead, self).setUp()
+        # drive the timed output by hand rather than from its thread
+        self.seq.lookahead = 0.05
+        self.seq._timed_output = TimedMIDIOutput(self.seq._midi_source,
+                                                 self.clock)
+
+    def tearDown(self):
+        if self.seq._timed_output is not None:
+            self.seq._timed_output.close()
+        super(TestLookahead, self).tearDown()
+
+    def test_steps_within_lookahead_are_queued_with_their_timestamp(self):
+        self.add_sequenced_note(1, 0, 45)
+        self.process_queued_manta_events()
+        step_timestamp = self.seq.next_step_timestamp
+        self.clock.set(step_timestamp - 0.03)
+        self.seq.process()
+        self.assertEqual(self.seq.next_step_timestamp,
+                         step_timestamp + self.seq.step_duration)
+        self.assert_no_midi_note_sent()
+        self.seq._timed_output.flush_due(step_timestamp)
+        self.assert_midi_note_sent(MIDI_BASE_NOTE, 45)
+
+    def test_turning_off_lookahead_sends_queued_note_offs(self):
+        self.seq.stop()
+        self.seq._schedule_note_off(60, self.logical_time + 0.03)
+        self.seq.process()
+        self.assert_no_midi_note_sent()
+        self.seq.set_lookahead(0)
+        self.assert_midi_note_sent(60, 0)
+
+    def test_next_deadline_is_early_by_lookahead(self):
+        self.seq.process()
+        self.assertEqual(self.seq.next_deadline(),
+                         self.seq.next_step_timestamp - 0.05)
+
+class TestOverlappingNotes(MockedBoundaryTest):
+    def setUp(self):
+        super(TestOverlappingNotes, self).setUp()
+        self.seq.stop()
+
+    def note_offs_sent(self, note):
+        return [c for c in self.seq._midi_source.send.mock_calls
+                if c[1][0] == make_note(note, 0)]
+
+    def test_note_off_waits_for_last_overlapping_voice(self):
+        self.seq._schedule_note_off(60, self.logical_time + 1.0)
+        self.seq._schedule_note_off(60, self.logical_time + 0.5)
+        self.step_time(0.5)
+        self.seq.process()
+        self.assertEqual(self.note_offs_sent(60), [])
+        self.step_time(0.5)
+        self.seq.process()
+        self.assertEqual(len(self.note_offs_sent(60)), 1)
+
+    def test_note_offs_for_different_notes_are_independent(self):
+        self.seq._schedule_note_off(60, self.logical_time + 0.5)
+        self.seq._schedule_note_off(62, self.logical_time + 1.0)
+        self.step_time(0.5)
+        self.seq.process()
+        self.assertEqual(len(self.note_offs_sent(60)), 1)
+        self.assertEqual(self.note_offs_sent(62), [])
+
+    def test_sequenced_note_off_doesnt_cut_off_held_note(self):
+        self.seq._schedule_note_off(MIDI_BASE_NOTE, self.logical_time + 0.5)
+        self.enqueue_note_velocity_event(0, 90)
+        self.process_queued_manta_events()
+        self.step_time(0.5)
+        self.seq.process()
+        self.assertEqual(self.note_offs_sent(MIDI_BASE_NOTE), [])
+        self.enqueue_note_velocity_event(0, 0)
+        self.process_queued_manta_events()
+        self.assertEqual(len(self.note_offs_sent(MIDI_BASE_NOTE)), 1)
+
+    def test_held_note_released_in_another_state_ends(self):
+        self.enqueue_note_velocity_event(0, 90)
+        self.enqueue_step_select(0)
+        self.enqueue_note_velocity_event(0, 0)
+        self.enqueue_step_deselect(0)
+        self.process_queued_manta_events()
+        self.assertEqual(len(self.note_offs_sent(MIDI_BASE_NOTE)), 1)
+        self.assertEqual(self.seq._voice_counts, {})
+        self.seq._schedule_note_off(MIDI_BASE_NOTE, self.logical_time + 0.5)
+        self.step_time(0.5)
+        self.seq.process()
+        self.assertEqual(len(self.note_offs_sent(MIDI_BASE_NOTE)), 2)
+
+    def test_held_note_waits_for_sequenced_voice(self):
+        self.enqueue_note_velocity_event(0, 90)
+        self.process_queued_manta_events()
+        self.seq._schedule_note_off(MIDI_BASE_NOTE, self.logical_time + 0.5)
+        self.enqueue_note_velocity_event(0, 0)
+        self.process_queued_manta_events()
+        self.assertEqual(self.note_offs_sent(MIDI_BASE_NOTE), [])
+        self.step_time(0.5)
+        self.seq.process()
+        self.assertEqual(len(self.note_offs_sent(MIDI_BASE_NOTE)), 1)
+
+class TestStates(MockedBoundaryTest):
+    def test_states_are_reused(self):
+        idle_state = self.seq._state
+        self.enqueue_step_select(3)
+        self.enqueue_step_deselect(3)
+        self.process_queued_manta_events()
+        self.assertTrue(self.seq._state is idle_state)
+
+    def test_unknown_events_are_ignored(self):
+        self.event_queue.append(object())
+        self.process_queued_manta_events()
+        self.assertTrue(self.seq._state is self.seq._idle_state)
+
+class TestCoalescing(MockedBoundaryTest):
+    def setUp(self):
+        super(TestCoalescing, self).setUp()
+        self.seq._coalescer = EventCoalescer()
+
+    def test_only_last_pad_value_is_applied(self):
+        self.event_queue.append([PadVelocityEvent(3, 100),
+                                 PadValueEvent(16, 100),
+                                 PadValueEvent(17, 45),
+                                 PadValueEvent(16, 0),
+                                 PadValueEvent(17, 80),
+                                 PadVelocityEvent(3, 0)])
+        self.process_queued_manta_events()
+        self.assertEqual(self.seq._seq.steps[3].note, MIDI_BASE_NOTE + 2)
+        self.assertEqual(self.seq._seq.steps[3].velocity, 80)
+        self.assertEqual(self.seq._coalescer.total_collapsed, 2)
+
 class TestTempoAdjust(MockedBoundaryTest):
     def test_swiping_full_right_to_left_should_cut_tempo_in_half(self):
         initial_step_duration = self.seq.step_duration
@@ -385,6 +539,33 @@ class TestTempoAdjust(MockedBoundaryTest):
         self.process_queued_manta_events()
         self.assertEqual(self.seq.step_duration, initial_step_duration / 2)
 
+class TestTempoChangePhase(MockedBoundaryTest):
+    def setUp(self):
+        super(TestTempoChangePhase, self).setUp()
+        self.seq.process()
+
+    def test_step_times_dont_accumulate_error(self):
+        start = self.logical_time
+        for i in range(1000):
+            self.clock.set(self.seq.next_step_timestamp)
+            self.seq.process()
+        self.assertEqual(self.seq.next_step_timestamp,
+                start + 1001 * self.seq.step_duration)
+
+    def test_tempo_change_keeps_position_within_step(self):
+        initial_duration = self.seq.step_duration
+        self.step_time(initial_duration / 4)
+        self.seq.step_duration = initial_duration * 2
+        self.assertAlmostEqual(self.seq.next_step_timestamp,
+                self.logical_time + 1.5 * initial_duration)
+
+    def test_steps_after_tempo_change_use_new_duration(self):
+        self.seq.step_duration = 0.5
+        first = self.seq.next_step_timestamp
+        self.clock.set(first)
+        self.seq.process()
+        self.assertAlmostEqual(self.seq.next_step_timestamp, first + 0.5)
+
 class TestSliderCC(MockedBoundaryTest):
     def test_slider0_should_send_cc1(self):
         # TODO: this test is broken because the value gets sent as part of the step
@@ -423,3 +604,198 @@ class TestStartStop(MockedBoundaryTest):
         self.seq.process()
         self.seq.process()
         self.assert_midi_note_sent(MIDI_BASE_NOTE, 100)
+
+class TestLiveRecording(MockedBoundaryTest):
+    def setUp(self):
+        super(TestLiveRecording, self).setUp()
+        # the first step plays at the start, and the next one is step 1
+        self.enqueue_button_velocity_event(self.seq.record_button, 100)
+        self.seq.process()
+
+    def play_note(self, timestamp, velocity=90):
+        self.event_queue.append(PadVelocityEvent(16, velocity, timestamp))
+        self.seq.process()
+
+    def note_ons_sent(self):
+        return [args[0] for name, args, kwargs
+                in self.seq._midi_source.send.mock_calls
+                if args[0][0] == 0x90 and args[0][2] > 0]
+
+    def test_record_button_lights_up(self):
+        self.seq._manta.set_led_button.assert_called_with(
+                RED, self.seq.record_button)
+        self.assertTrue(self.seq.recording)
+
+    def test_kernel_timestamps_only_while_recording(self):
+        self.seq._manta.set_kernel_timestamps.assert_called_with(True)
+        self.enqueue_button_velocity_event(self.seq.record_button, 100)
+        self.seq.process()
+        self.seq._manta.set_kernel_timestamps.assert_called_with(False)
+
+    def test_note_is_recorded_into_nearest_step(self):
+        self.step_time(0.2)
+        self.play_note(1000.13)
+        step = self.seq._seq.steps[1]
+        self.assertEqual((step.note, step.velocity), (MIDI_BASE_NOTE, 90))
+
+    def test_arrival_time_is_used_instead_of_processing_time(self):
+        # processed nearer step 1, but it arrived nearer step 0
+        self.step_time(0.1)
+        self.play_note(1000.01)
+        self.assertEqual(self.seq._seq.steps[0].velocity, 90)
+        self.assertEqual(self.seq._seq.steps[1].velocity, 0)
+
+    def test_processing_time_is_used_without_timestamp(self):
+        self.step_time(0.13)
+        self.play_note(None)
+        self.assertEqual(self.seq._seq.steps[1].velocity, 90)
+
+    def test_recorded_step_only_sounds_live_until_next_time_round(self):
+        self.step_time(0.12)
+        self.play_note(1000.12)
+        self.step_time(0.01)
+        self.seq.process()
+        self.assertEqual(self.note_ons_sent(), [make_note(MIDI_BASE_NOTE, 90)])
+        self.step_time(16 * self.seq.step_duration)
+        self.seq.process()
+        self.assertEqual(len(self.note_ons_sent()), 2)
+
+    def test_nothing_is_recorded_when_not_recording(self):
+        self.enqueue_button_velocity_event(self.seq.record_button, 100)
+        self.seq.process()
+        self.assertFalse(self.seq.recording)
+        self.step_time(0.13)
+        self.play_note(1000.13)
+        self.assertEqual(self.seq._seq.steps[1].velocity, 0)
+
+class TestControllerCaching(MockedBoundaryTest):
+    def test_repeated_step_cc_is_sent_once(self):
+        self.set_step_cc(1, 1, 0.25)
+        self.set_step_cc(2, 1, 0.25)
+        self.process_queued_manta_events()
+        self.step_time(self.seq.step_duration * 2 + 0.001)
+        self.seq.process()
+        sent = [args[0] for args, _ in
+                self.seq._midi_source.send.call_args_list]
+        self.assertEqual(sent.count(make_cc(1, 31)), 1)
+
+class TestMIDIBatching(MockedBoundaryTest):
+    def test_step_is_written_in_one_batch(self):
+        capture = CaptureBackend(self.clock)
+        self.seq.set_midi_source(capture)
+        self.add_sequenced_note(1, 0, 45)
+        self.process_queued_manta_events()
+        writes = capture.writes
+        self.step_time(self.seq.step_duration + 0.001)
+        self.seq.process()
+        self.assertEqual(capture.writes, writes + 1)
+        self.assertIn(make_note(MIDI_BASE_NOTE, 45), capture.messages())
+
+class TestMetrics(MockedBoundaryTest):
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.metrics = self.seq.enable_metrics()
+
+    def test_phases_and_events_are_recorded(self):
+        self.add_sequenced_note(1, 0, 45)
+        self.process_queued_manta_events()
+        for phase, histogram in self.metrics.phases.items():
+            if phase != 'decode':
+                self.assertEqual(histogram.count, 4)
+        self.assertEqual(self.metrics.event_counts,
+                         {'PadVelocityEvent': 2, 'PadValueEvent': 2})
+
+    def test_measured_process_still_steps(self):
+        self.add_sequenced_note(1, 0, 45)
+        self.process_queued_manta_events()
+        self.step_time(self.seq.step_duration + 0.001)
+        self.seq.process()
+        self.assert_midi_note_sent(MIDI_BASE_NOTE, 45)
+        self.assertEqual(self.metrics.queue_depths['note_offs'].max, 1)
+
+    def test_lateness_is_recorded(self):
+        self.step_time(0.01)
+        self.seq.process()
+        self.assertAlmostEqual(self.metrics.recent_lateness.values()[0], 0.01)
+
+    def test_disabling_stops_recording(self):
+        self.seq.disable_metrics()
+        self.seq.process()
+        self.assertEqual(self.metrics.lateness.count, 0)
+
+class TestThreadedHandoff(MockedBoundaryTest):
+    '''Drives the timing and UI sides of the threaded mode by hand'''
+    def setUp(self):
+        MockedBoundaryTest.setUp(self)
+        self.seq._begin_handoff()
+
+    def tearDown(self):
+        self.seq._end_handoff()
+        MockedBoundaryTest.tearDown(self)
+
+    def deliver_queued_manta_events(self):
+        '''Hands the queued events over as the receiver thread would'''
+        while self.event_queue:
+            self.seq._input_events.append(self.get_next_event())
+        self.seq.process_ui(0)
+
+    def test_edits_are_played_once_published(self):
+        self.add_sequenced_note(1, 0, 45)
+        self.seq.process_timing()
+        self.deliver_queued_manta_events()
+        self.step_time(self.seq.step_duration + 0.001)
+        self.seq.process_timing()
+        self.assert_midi_note_sent(MIDI_BASE_NOTE, 45)
+
+    def test_unpublished_edits_are_not_played(self):
+        self.seq.process_timing()
+        # edited directly, without going through process_ui()
+        self.seq._seq.select_step(1)
+        self.seq._seq.set_fields(note=60, velocity=45)
+        self.step_time(self.seq.step_duration + 0.001)
+        self.seq.process_timing()
+        self.assert_no_midi_note_sent()
+
+    def test_step_leds_are_left_to_the_ui(self):
+        self.seq.process_timing()
+        self.assert_led_state(0, OFF)
+        self.seq.process_ui(0)
+        self.assert_led_state(0, RED)
+
+    def test_metrics_are_recorded_by_both_threads(self):
+        metrics = self.seq.enable_metrics()
+        self.add_sequenced_note(1, 0, 45)
+        self.deliver_queued_manta_events()
+        self.step_time(self.seq.step_duration + 0.001)
+        self.seq.process_timing()
+        for phase, histogram in metrics.phases.items():
+            if phase != 'decode':
+                self.assertTrue(histogram.count > 0, phase)
+        self.assertEqual(metrics.event_counts,
+                         {'PadVelocityEvent': 2, 'PadValueEvent': 2})
+        self.assertEqual(metrics.queue_depths['note_offs'].max, 1)
+        self.assertTrue(metrics.lateness.count > 0)
+
+    def test_recorded_note_is_placed_by_timing_and_published(self):
+        self.seq.process_timing()
+        self.enqueue_button_velocity_event(self.seq.record_button, 100)
+        self.event_queue.append(PadVelocityEvent(16, 90, 1000.13))
+        self.deliver_queued_manta_events()
+        # nothing's been placed until the timing thread has had a look
+        self.assertEqual(self.seq._seq.steps[1].velocity, 0)
+        self.step_time(0.13)
+        self.seq.process_timing()
+        self.seq.process_ui(0)
+        self.assertEqual(self.seq._seq.steps[1].velocity, 90)
+        self.assertEqual(self.seq._published_seq.steps[1].velocity, 90)
+        # it sounded live, so step 1 stays quiet this time round
+        self.assert_midi_note_sent(MIDI_BASE_NOTE, 90)
+        self.assertEqual(len([c for c in self.seq._midi_source.send.mock_calls
+                              if c[1][0] == make_note(MIDI_BASE_NOTE, 90)]),
+                         1)
+
+    def test_stop_is_carried_out_by_timing(self):
+        self.seq.stop()
+        self.assertTrue(self.seq.running)
+        self.seq.process_timing()
+        self.assertFalse(self.seq.running)
@@ -0,0 +1,134 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from manta import decodeOSC
+from clock import VirtualClock
+from manta import Manta, encode_osc
+from mantaseq import MantaSeq
+from metrics import (Histogram, Metrics, MetricsServer, RingBuffer,
+                     OSC_ADDRESS, PHASES)
+from midibackends import CaptureBackend
+
+class TestHistogram(unittest.TestCase):
+    def test_percentiles_are_within_bucket_precision(self):
+        histogram = Histogram()
+        for i in range(1, 1001):
+            histogram.record(i * 1e-5)
+        for fraction in (0.5, 0.9, 0.99):
+            exact = fraction * 1000 * 1e-5
+            self.assertTrue(exact <= histogram.percentile(fraction) <
+                            exact * (1 + 1.0 / histogram.sub_buckets))
+        self.assertEqual(histogram.percentile(1), 1000 * 1e-5)
+
+    def test_small_and_negative_values_go_in_first_bucket(self):
+        histogram = Histogram()
+        histogram.record(-0.5)
+        histogram.record(-0.25)
+        histogram.record(0.5)
+        self.assertEqual(histogram.percentile(0.6), histogram.min_value)
+        self.assertEqual(histogram.count, 3)
+
+    def test_max_of_negative_values(self):
+        histogram = Histogram()
+        histogram.record(-0.5)
+        histogram.record(-0.25)
+        self.assertEqual(histogram.max, -0.25)
+
+    def test_huge_values_are_clamped(self):
+        histogram = Histogram(max_value=1.0)
+        histogram.record(1000.0)
+        self.assertEqual(histogram.percentile(0.5), 1000.0)
+
+    def test_reset(self):
+        histogram = Histogram()
+        histogram.record(0.1)
+        histogram.reset()
+        self.assertEqual(histogram.summary()['count'], 0)
+        self.assertEqual(histogram.percentile(0.5), 0.0)
+
+class TestRingBuffer(unittest.TestCase):
+    def test_keeps_most_recent_values_in_order(self):
+        ring = RingBuffer(3)
+        ring.append(1)
+        ring.append(2)
+        self.assertEqual(ring.values(), [1, 2])
+        ring.append(3)
+        ring.append(4)
+        self.assertEqual(ring.values(), [2, 3, 4])
+        self.assertEqual(ring.count, 4)
+
+class TestMetrics(unittest.TestCase):
+    def test_threads_can_record_at_once(self):
+        metrics = Metrics()
+        def record():
+            for i in range(20000):
+                metrics.record_phase('steps', 0.001)
+                metrics.record_lateness(0.001)
+        threads = [threading.Thread(target=record) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(metrics.phases['steps'].count, 80000)
+        self.assertEqual(metrics.lateness.count, 80000)
+        self.assertEqual(metrics.recent_lateness.count, 80000)
+
+class TestMetricsServer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'metrics.sock')
+        self.metrics = Metrics()
+        self.server = MetricsServer(self.metrics, self.path)
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.dir)
+
+    def test_connection_gets_snapshot(self):
+        self.metrics.record_lateness(0.002)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.path)
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        client.close()
+        snapshot = json.loads(data.decode('ascii'))
+        self.assertEqual(snapshot['lateness']['count'], 1)
+        self.assertEqual(snapshot['recent_lateness'], [0.002])
+
+class TestOSCQuery(unittest.TestCase):
+    def setUp(self):
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(('127.0.0.1', 0))
+        self.client.settimeout(1)
+        self.clock = VirtualClock(1000)
+        manta = Manta(receive_port=0,
+                      send_port=self.client.getsockname()[1], timeout=0,
+                      buffer_leds=True, bundle_output=True)
+        self.seq = MantaSeq(clock=self.clock,
+                            midi_source=CaptureBackend(self.clock),
+                            manta=manta)
+        # the LED enable message
+        self.client.recv(1024)
+
+    def tearDown(self):
+        self.seq._manta.osc_server.close()
+        self.client.close()
+
+    def test_query_is_answered_with_snapshot(self):
+        self.seq.enable_metrics()
+        self.client.sendto(encode_osc(OSC_ADDRESS),
+                           self.seq._manta.osc_server.socket.getsockname())
+        self.seq._manta.wait(1)
+        self.seq.process()
+        message = decodeOSC(self.client.recv(65536))
+        self.assertEqual(message[0], OSC_ADDRESS)
+        snapshot = json.loads(message[2])
+        self.assertEqual(set(snapshot['phases']), set(PHASES))
@@ -0,0 +1,58 @@
+import socket
+import unittest
+from manta import decodeOSC
+from clock import VirtualClock
+from midibackends import CaptureBackend, UDPBackend, open_backend
+
+class TestCaptureBackend(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock(10)
+        self.backend = CaptureBackend(self.clock)
+
+    def test_nothing_is_written_until_flush(self):
+        self.backend.send((0x90, 60, 100))
+        self.assertEqual(self.backend.sent, [])
+        self.clock.set(10.5)
+        self.backend.flush()
+        self.assertEqual(self.backend.sent, [(10.5, (0x90, 60, 100))])
+
+    def test_each_flush_is_one_write(self):
+        self.backend.send((0x90, 60, 100))
+        self.backend.send((0xB0, 1, 64))
+        self.backend.flush()
+        self.backend.flush()
+        self.backend.send((0x80, 60, 0))
+        self.backend.flush()
+        self.assertEqual(self.backend.writes, 2)
+        self.assertEqual([len(messages) for _, messages in
+                          self.backend.batches], [2, 1])
+
+class TestUDPBackend(unittest.TestCase):
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(1)
+        self.backend = UDPBackend(port=self.receiver.getsockname()[1])
+
+    def tearDown(self):
+        self.backend.close()
+        self.receiver.close()
+
+    def test_batch_is_sent_as_one_blob(self):
+        self.backend.send((0x90, 60, 100))
+        self.backend.send((0xB0, 1, 64))
+        self.backend.flush()
+        address, typetags, blob = decodeOSC(self.receiver.recv(4096))
+        self.assertEqual(address, '/midi')
+        self.assertEqual(typetags, ',b')
+        self.assertEqual(bytearray(blob), bytearray([0x90, 60, 100,
+                                                     0xB0, 1, 64]))
+
+class TestOpenBackend(unittest.TestCase):
+    def test_unknown_backend_raises(self):
+        self.assertRaises(ValueError, open_backend, 'carrier-pigeon')
+
+    def test_opens_named_backend(self):
+        backend = open_backend('udp')
+        backend.close()
+        self.assertTrue(isinstance(backend, UDPBackend))
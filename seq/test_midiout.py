@@ -0,0 +1,115 @@
+import time
+import unittest
+from clock import SystemClock, VirtualClock
+from midiout import ControllerCache, TimedMIDIOutput
+
+class RecordingMIDISource(object):
+    def __init__(self, clock):
+        self._clock = clock
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append((self._clock.now(), message))
+
+    def flush(self):
+        pass
+
+class TestControllerCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock(100)
+        self.source = RecordingMIDISource(self.clock)
+        self.cache = ControllerCache(self.source, self.clock)
+
+    def sent_messages(self):
+        return [message for _, message in self.source.sent]
+
+    def test_repeated_cc_values_are_dropped(self):
+        self.cache.send((0xB0, 1, 64))
+        self.cache.send((0xB0, 1, 64))
+        self.cache.send((0xB0, 1, 65))
+        self.cache.send((0xB1, 1, 65))
+        self.assertEqual(self.sent_messages(),
+                         [(0xB0, 1, 64), (0xB0, 1, 65), (0xB1, 1, 65)])
+        self.assertEqual(self.cache.suppressed_count, 1)
+
+    def test_notes_always_pass_through(self):
+        self.cache.send((0x90, 60, 100))
+        self.cache.send((0x90, 60, 100))
+        self.assertEqual(len(self.sent_messages()), 2)
+
+    def test_reset_resends_values(self):
+        self.cache.send((0xB0, 1, 64))
+        self.cache.reset()
+        self.cache.send((0xB0, 1, 64))
+        self.assertEqual(len(self.sent_messages()), 2)
+
+    def test_rate_limit_sends_latest_value(self):
+        self.cache.set_rate_limit(1, 10)
+        self.cache.send((0xB0, 1, 10))
+        self.cache.send((0xB0, 1, 11))
+        self.cache.send((0xB0, 1, 12))
+        self.assertEqual(self.sent_messages(), [(0xB0, 1, 10)])
+        self.assertAlmostEqual(self.cache.next_pending_timestamp(), 100.1)
+        self.cache.flush_pending(100.05)
+        self.assertEqual(len(self.sent_messages()), 1)
+        self.clock.set(100.1)
+        self.cache.flush_pending(self.clock.now())
+        self.assertEqual(self.sent_messages(), [(0xB0, 1, 10), (0xB0, 1, 12)])
+        self.assertEqual(self.cache.next_pending_timestamp(), None)
+
+    def test_rate_limit_drops_return_to_sent_value(self):
+        self.cache.set_rate_limit(1, 10)
+        self.cache.send((0xB0, 1, 10))
+        self.cache.send((0xB0, 1, 11))
+        self.cache.send((0xB0, 1, 10))
+        self.clock.set(101)
+        self.cache.flush_pending(self.clock.now())
+        self.assertEqual(self.sent_messages(), [(0xB0, 1, 10)])
+
+class TestTimedMIDIOutput(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock(100)
+        self.source = RecordingMIDISource(self.clock)
+        self.output = TimedMIDIOutput(self.source, self.clock)
+
+    def tearDown(self):
+        self.output.close()
+
+    def test_messages_are_held_until_due(self):
+        self.output.send_at(100.5, (0x90, 60, 100))
+        self.output.flush_due(self.clock.now())
+        self.assertEqual(self.source.sent, [])
+        self.clock.set(100.5)
+        self.output.flush_due(self.clock.now())
+        self.assertEqual(self.source.sent, [(100.5, (0x90, 60, 100))])
+
+    def test_messages_go_out_in_timestamp_order(self):
+        self.output.send_at(100.2, (0x90, 62, 100))
+        self.output.send_at(100.1, (0x90, 61, 100))
+        self.clock.set(101)
+        self.output.flush_due(self.clock.now())
+        self.assertEqual([m[1] for _, m in self.source.sent], [61, 62])
+
+    def test_close_sends_queued_messages(self):
+        self.output.send_at(100.2, (0x90, 60, 0))
+        self.output.send_at(100.1, (0x90, 61, 100))
+        self.output.close()
+        self.assertEqual([m for _, m in self.source.sent],
+                         [(0x90, 61, 100), (0x90, 60, 0)])
+        # so tearDown has something to close
+        self.output = TimedMIDIOutput(self.source, self.clock)
+
+class TestTimedMIDIOutputThread(unittest.TestCase):
+    def test_thread_sends_at_timestamp(self):
+        clock = SystemClock()
+        source = RecordingMIDISource(clock)
+        output = TimedMIDIOutput(source, clock)
+        output.start()
+        try:
+            timestamp = clock.now() + 0.02
+            output.send_at(timestamp, (0x90, 60, 100))
+            time.sleep(0.1)
+        finally:
+            output.close()
+        self.assertEqual(len(source.sent), 1)
+        self.assertTrue(source.sent[0][0] >= timestamp)
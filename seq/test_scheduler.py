@@ -0,0 +1,44 @@
+import unittest
+from scheduler import Scheduler
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+
+    def test_empty_scheduler_has_no_next_timestamp(self):
+        self.assertEqual(self.scheduler.next_timestamp(), None)
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_next_timestamp_is_earliest(self):
+        self.scheduler.schedule(3, 'c')
+        self.scheduler.schedule(1, 'a')
+        self.scheduler.schedule(2, 'b')
+        self.assertEqual(self.scheduler.next_timestamp(), 1)
+
+    def test_pop_due_only_returns_due_items_in_order(self):
+        self.scheduler.schedule(3, 'c')
+        self.scheduler.schedule(1, 'a')
+        self.scheduler.schedule(2, 'b')
+        self.assertEqual(list(self.scheduler.pop_due(2)), [(1, 'a'), (2, 'b')])
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertEqual(list(self.scheduler.pop_due(2)), [])
+
+    def test_equal_timestamps_keep_scheduling_order(self):
+        for item in range(5):
+            self.scheduler.schedule(1, item)
+        self.assertEqual([item for _, item in self.scheduler.pop_due(1)],
+                         list(range(5)))
+
+    def test_cancelled_items_are_not_returned(self):
+        handle = self.scheduler.schedule(1, 'a')
+        self.scheduler.schedule(2, 'b')
+        self.scheduler.cancel(handle)
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertEqual(self.scheduler.next_timestamp(), 2)
+        self.assertEqual(list(self.scheduler.pop_due(5)), [(2, 'b')])
+
+    def test_cancelling_popped_item_does_nothing(self):
+        handle = self.scheduler.schedule(1, 'a')
+        self.scheduler.pop_due(1)
+        self.scheduler.cancel(handle)
+        self.assertEqual(len(self.scheduler), 0)
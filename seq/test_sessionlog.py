@@ -0,0 +1,74 @@
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import unittest
+from clock import VirtualClock
+from manta import Manta, osc_prefix
+from sessionlog import SessionRecorder, read_session
+
+def pad_velocity_datagram(pad_num, velocity):
+    return (osc_prefix('/manta/velocity/pad', 'ii') +
+            struct.pack('>ii', pad_num, velocity))
+
+class SessionLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'session.log')
+        self.clock = VirtualClock(50)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+class TestSessionLog(SessionLogTest):
+    def test_records_read_back(self):
+        recorder = SessionRecorder(self.path, self.clock)
+        recorder.record(50.0, b'abcd')
+        recorder.record(50.5, b'efghijkl')
+        recorder.close()
+        self.assertEqual(list(read_session(self.path)),
+                         [(50.0, b'abcd'), (50.5, b'efghijkl')])
+
+    def test_cut_off_record_is_ignored(self):
+        recorder = SessionRecorder(self.path, self.clock)
+        recorder.record(50.0, b'abcd')
+        recorder.record(50.5, b'efghijkl')
+        recorder.close()
+        with open(self.path, 'r+b') as log:
+            log.truncate(os.path.getsize(self.path) - 2)
+        self.assertEqual(list(read_session(self.path)), [(50.0, b'abcd')])
+
+    def test_other_files_are_rejected(self):
+        with open(self.path, 'wb') as log:
+            log.write(b'not a log')
+        self.assertRaises(ValueError, list, read_session(self.path))
+
+class TestMantaRecording(SessionLogTest):
+    def setUp(self):
+        SessionLogTest.setUp(self)
+        self.manta = Manta(receive_port=0, timeout=0)
+        self.recorder = SessionRecorder(self.path, self.clock)
+        self.manta.recorder = self.recorder
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.address = self.manta.osc_server.socket.getsockname()
+
+    def tearDown(self):
+        self.sender.close()
+        self.manta.osc_server.close()
+        SessionLogTest.tearDown(self)
+
+    def test_datagrams_read_together_share_a_timestamp(self):
+        self.sender.sendto(pad_velocity_datagram(1, 100), self.address)
+        self.sender.sendto(pad_velocity_datagram(2, 100), self.address)
+        self.manta.wait(1)
+        self.manta.process()
+        self.clock.advance(1)
+        self.sender.sendto(pad_velocity_datagram(3, 100), self.address)
+        self.manta.wait(1)
+        self.manta.process()
+        self.recorder.close()
+        self.assertEqual(list(read_session(self.path)),
+                         [(50, pad_velocity_datagram(1, 100)),
+                          (50, pad_velocity_datagram(2, 100)),
+                          (51, pad_velocity_datagram(3, 100))])
@@ -111,3 +111,62 @@ class TestStepping(unittest.TestCase):
         self.seq.step_count = 10
         step = self.seq.step()
         self.assertEqual(step.note, 60)
+
+class TestLongSequences(unittest.TestCase):
+    def setUp(self):
+        self.seq = Seq(length=256)
+
+    def test_steps_past_16_can_be_selected_and_set(self):
+        self.seq.select_step(200)
+        self.seq.select_step(3)
+        self.seq.set_note(72)
+        self.assertTrue(self.seq.is_selected(200))
+        self.assertFalse(self.seq.is_selected(199))
+        self.assertEqual(self.seq.selected_indices(), [3, 200])
+        self.assertEqual(self.seq.steps[200].note, 72)
+        self.assertEqual(self.seq.steps[199].note, 0)
+
+    def test_step_views_write_through_to_columns(self):
+        self.seq.steps[100].velocity = 99
+        self.assertEqual(self.seq.columns['velocity'][100], 99)
+
+class TestBulkSetting(SeqTest):
+    def test_set_fields_sets_all_fields_on_selected_steps(self):
+        self.seq.select_step(2)
+        self.seq.select_step(9)
+        self.seq.set_fields(note=61, velocity=80, cc2=7)
+        for i in [2, 9]:
+            self.assertEqual(self.seq.steps[i].note, 61)
+            self.assertEqual(self.seq.steps[i].velocity, 80)
+            self.assertEqual(self.seq.steps[i].cc2, 7)
+        self.assertEqual(self.seq.steps[3].note, 0)
+
+    def test_set_fields_rejects_unknown_fields(self):
+        self.seq.select_step(2)
+        self.assertRaises(TypeError, self.seq.set_fields, pitch=61)
+
+    def test_unknown_setters_dont_exist(self):
+        self.assertRaises(AttributeError, getattr, self.seq, 'set_pitch')
+
+    def test_setters_follow_selection_changes(self):
+        self.seq.select_step(2)
+        self.seq.set_note(50)
+        self.seq.deselect_step(2)
+        self.seq.select_step(3)
+        self.seq.set_note(51)
+        self.assertEqual(self.seq.steps[2].note, 50)
+        self.assertEqual(self.seq.steps[3].note, 51)
+
+class TestSnapshot(SeqTest):
+    def test_snapshot_has_step_values(self):
+        self.seq.select_step(4)
+        self.seq.set_fields(note=62, velocity=90)
+        snapshot = self.seq.snapshot()
+        self.assertEqual(snapshot.steps[4].note, 62)
+        self.assertEqual(snapshot.steps[4].velocity, 90)
+
+    def test_snapshot_is_unaffected_by_later_edits(self):
+        snapshot = self.seq.snapshot()
+        self.seq.select_step(4)
+        self.seq.set_note(62)
+        self.assertEqual(snapshot.steps[4].note, 0)